@@ -8,6 +8,7 @@ Source0: _SOURCE
 Packager: Sarath Lakshman <slakshman@zynga.com>
 AutoReqProv: no
 Requires: jemalloc
+BuildRequires: gcc-c++, sqlite-devel, jemalloc-devel
 
 %description
 ZBase 1.9 backup and restore tools
@@ -16,6 +17,9 @@ ZBase 1.9 backup and restore tools
 %define _rpmfilename %%{NAME}-_COMMIT.%%{ARCH}.rpm
 %setup
 
+%build
+make -C src/backup-merge clean all
+
 %install
 mkdir -p $RPM_BUILD_ROOT/opt/zbase/zbase-backup/blobrestore_utils/
 mkdir -p $RPM_BUILD_ROOT/etc/init.d/
@@ -25,6 +29,11 @@ cp src/backup-merge/merge-incremental $RPM_BUILD_ROOT/opt/zbase/zbase-backup/
 cp src/vbs_agent/_vbs_agent.so $RPM_BUILD_ROOT/opt/zbase/zbase-backup/
 cp src/vbs_agent/vbs_agent.py $RPM_BUILD_ROOT/opt/zbase/zbase-backup/
 cp src/backuplib.py \
+src/mergelib.py \
+src/restorelib.py \
+src/catalog.py \
+src/journal.py \
+src/vbmap.py \
 src/config.py \
 src/consts.py \
 src/daily-merge \
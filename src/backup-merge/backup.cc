@@ -16,6 +16,7 @@
  *   limitations under the License.
  */
 
+#include <unistd.h>
 #include "backup.hh"
 #include "timing.hh"
 
@@ -396,19 +397,25 @@ bool Merge::walk_files(std::list <std::string> &files, bool validate) {
     }
 
     cv.getCheckpointList(checkpoints);
+    return true;
 }
 
-Merge::Merge(std::list <std::string> files, std::string output_file, int split, bool validate, std::string bfr_path):
+Merge::Merge(std::list <std::string> files, std::string output_file, int split, bool validate, std::string bfr_path,
+        std::string dedup):
     source_files(files), output_file_pattern(output_file), split_size(split), validation(validate), buffer_path(bfr_path) {
 
         std::stringstream cmd_setup_buffer;
         cmd_setup_buffer<<"rm -rf "<<buffer_path<<" && mkdir -p "<<buffer_path;
         if (system(cmd_setup_buffer.str().c_str())) {
-            std::cout<<"ERROR: Unable to setup work buffer ("<<cmd_setup_buffer<<")"<<std::endl;
+            std::cout<<"ERROR: Unable to setup work buffer ("<<cmd_setup_buffer.str()<<")"<<std::endl;
+            exit(1);
+        }
+        keyhash = createKeyDedup(dedup);
+        if (keyhash == NULL) {
+            std::cout<<"ERROR: Unknown dedup type "<<dedup<<std::endl;
             exit(1);
         }
         walk_files(source_files, validation);
-        keyhash = new HashTable;
 }
 
 Merge::~Merge() {
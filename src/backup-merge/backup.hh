@@ -363,7 +363,7 @@ class Merge {
     bool validation;
     int split_size;
     std::string output_file_pattern;
-    HashTable *keyhash;
+    KeyDedup *keyhash;
     std::list <std::string> source_files;
     std::list <Checkpoint> checkpoints;
     std::string buffer_path;
@@ -372,7 +372,8 @@ public:
     /**
      * Initialize
      */
-    Merge(std::list<std::string> files, std::string output_file, int split, bool validate, std::string bfr_path);
+    Merge(std::list<std::string> files, std::string output_file, int split, bool validate, std::string bfr_path,
+            std::string dedup="hash");
 
 
     /**
@@ -19,22 +19,111 @@
 #ifndef HT_HH
 #define HT_HH 1
 
+#include <stdint.h>
+#include <string.h>
+#include <string>
 #include <google/sparse_hash_set>
 
-class HashTable {
+/**
+ * Key dedup structure used by merge. The first add of a key returns true,
+ * the key is then treated as superseded in every later (older) file
+ */
+class KeyDedup {
 public:
-        bool add(std::string key) {
-            google::sparse_hash_set <std::string>::const_iterator it = cache.find(key);
-            if (it != cache.end()) {
-                return false;
-            } else {
-                cache.insert(key);
-                return true;
-            }
-        }
+    virtual ~KeyDedup() {}
+
+    /**
+     * Returns false if the key has already been added
+     */
+    virtual bool add(const std::string &key) = 0;
+
+    /**
+     * Number of keys held
+     */
+    virtual size_t size() = 0;
+};
+
+/**
+ * Exact dedup, holds a copy of every key
+ */
+class HashTable : public KeyDedup {
+public:
+    bool add(const std::string &key) {
+        return cache.insert(key).second;
+    }
+
+    size_t size() {
+        return cache.size();
+    }
 
 private:
     google::sparse_hash_set <std::string> cache;
 };
 
+/**
+ * Dedup on 64 bit key fingerprints (MurmurHash64A). Uses about 10 bytes per
+ * key whatever the key length, but two keys with the same fingerprint are
+ * taken as one: with n keys the chance of any collision is about n^2/2^65
+ * (7e-5 for 50M keys), and the colliding key would be dropped.
+ */
+class FingerprintTable : public KeyDedup {
+public:
+    bool add(const std::string &key) {
+        return cache.insert(fingerprint(key.data(), key.length())).second;
+    }
+
+    size_t size() {
+        return cache.size();
+    }
+
+    static uint64_t fingerprint(const char *key, size_t len) {
+        const uint64_t m = 0xc6a4a7935bd1e995ULL;
+        const int r = 47;
+        uint64_t h = 0x5bd1e995ULL ^ (len * m);
+        const char *end = key + (len & ~(size_t)7);
+
+        for (const char *p = key; p != end; p += 8) {
+            uint64_t k;
+            memcpy(&k, p, sizeof(k));
+            k *= m;
+            k ^= k >> r;
+            k *= m;
+            h ^= k;
+            h *= m;
+        }
+
+        const unsigned char *tail = (const unsigned char *) end;
+        switch (len & 7) {
+            case 7: h ^= uint64_t(tail[6]) << 48;
+            case 6: h ^= uint64_t(tail[5]) << 40;
+            case 5: h ^= uint64_t(tail[4]) << 32;
+            case 4: h ^= uint64_t(tail[3]) << 24;
+            case 3: h ^= uint64_t(tail[2]) << 16;
+            case 2: h ^= uint64_t(tail[1]) << 8;
+            case 1: h ^= uint64_t(tail[0]);
+                    h *= m;
+        }
+
+        h ^= h >> r;
+        h *= m;
+        h ^= h >> r;
+        return h;
+    }
+
+private:
+    google::sparse_hash_set <uint64_t> cache;
+};
+
+/**
+ * Create the dedup structure for a -d option value, NULL if unknown
+ */
+inline KeyDedup *createKeyDedup(const std::string &type) {
+    if (type == "hash") {
+        return new HashTable;
+    } else if (type == "fingerprint") {
+        return new FingerprintTable;
+    }
+    return NULL;
+}
+
 #endif
@@ -37,10 +37,11 @@ int main(int argc, char **argv) {
     std::list <std::string> files;
     std::fstream ifs;
     std::string inputfile, outputfile, workbuffdir;
+    std::string dedup("hash");
     std::string buffer;
     char *dirpath;
 
-    while ((c = getopt (argc, argv, "i:o:s:b:v")) != -1) {
+    while ((c = getopt (argc, argv, "i:o:s:b:d:v")) != -1) {
         switch (c) 
         {   
             case 'i':
@@ -58,6 +59,9 @@ int main(int argc, char **argv) {
             case 's':
                 split_size = atoi(optarg);
                 break;
+            case 'd':
+                dedup = optarg;
+                break;
             case 'v':
                 validation = true;
                 break;
@@ -71,7 +75,7 @@ int main(int argc, char **argv) {
     }
     
     if (required != 3) {
-        std::cout<<"Usage: "<<argv[0]<<" -i files.txt -o file-%.mbb -b /dev/shm/buffdir/ [-s 512] [-v]"<<std::endl;
+        std::cout<<"Usage: "<<argv[0]<<" -i files.txt -o file-%.mbb -b /dev/shm/buffdir/ [-s 512] [-d hash|fingerprint] [-v]"<<std::endl;
         exit(1);
     }
 
@@ -101,7 +105,7 @@ int main(int argc, char **argv) {
     }   
     std::cout<<std::endl;
 
-    Merge merge(files, outputfile, split_size, validation, workbuffdir);
+    Merge merge(files, outputfile, split_size, validation, workbuffdir, dedup);
     merge.process();
 
     return 0;
@@ -16,6 +16,7 @@
  *   limitations under the License.
  */
 
+#include <unistd.h>
 #include "sqlite-objects.hh"
 
 #define MAX_STEPS 10000
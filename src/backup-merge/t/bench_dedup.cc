@@ -0,0 +1,86 @@
+/* -*- Mode: C++; tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*- */
+
+/*
+ *   Copyright 2013 Zynga Inc.
+ *
+ *   Licensed under the Apache License, Version 2.0 (the "License");
+ *   you may not use this file except in compliance with the License.
+ *   You may obtain a copy of the License at
+ *
+ *       http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *   Unless required by applicable law or agreed to in writing, software
+ *   distributed under the License is distributed on an "AS IS" BASIS,
+ *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ *   See the License for the specific language governing permissions and
+ *   limitations under the License.
+ */
+
+/*
+ * Benchmark: memory and throughput of the merge key dedup structures
+ * Usage: bench_dedup hash|fingerprint [operations] [distinct_keys]
+ *
+ * Keys are added the way a master merge sees them: newest file first, with
+ * older files repeating keys that are already superseded.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <sys/time.h>
+#include <iostream>
+#include "../hashtable.hh"
+
+static size_t rss_kb() {
+    size_t pages(0), resident(0);
+    FILE *fp = fopen("/proc/self/statm", "r");
+    if (fp) {
+        if (fscanf(fp, "%zu %zu", &pages, &resident) != 2) {
+            resident = 0;
+        }
+        fclose(fp);
+    }
+    return resident * (sysconf(_SC_PAGESIZE) / 1024);
+}
+
+static double now() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1000000.0;
+}
+
+int main(int argc, char **argv) {
+    if (argc < 2) {
+        std::cout<<"Usage: "<<argv[0]<<" hash|fingerprint [operations] [distinct_keys]"<<std::endl;
+        exit(1);
+    }
+
+    uint64_t operations = argc > 2 ? strtoull(argv[2], NULL, 10) : 50000000;
+    uint64_t distinct_keys = argc > 3 ? strtoull(argv[3], NULL, 10) : operations / 2;
+    KeyDedup *keyhash = createKeyDedup(argv[1]);
+    if (keyhash == NULL) {
+        std::cout<<"ERROR: Unknown dedup type "<<argv[1]<<std::endl;
+        exit(1);
+    }
+
+    char key[64];
+    uint64_t added(0);
+    size_t rss_start = rss_kb();
+    double start = now();
+    for (uint64_t i = 0; i < operations; i++) {
+        uint64_t id = (i * 2654435761ULL) % distinct_keys;
+        int len = snprintf(key, sizeof(key), "user_%012llu_state", (unsigned long long) id);
+        if (keyhash->add(std::string(key, len))) {
+            added++;
+        }
+    }
+    double elapsed = now() - start;
+    size_t rss = rss_kb() - rss_start;
+
+    printf("%-12s %llu ops %llu keys %8.2f sec %10.0f ops/sec %8zu KB %6.1f bytes/key\n",
+            argv[1], (unsigned long long) operations, (unsigned long long) added,
+            elapsed, operations / elapsed, rss, rss * 1024.0 / (added ? added : 1));
+
+    delete keyhash;
+    return 0;
+}
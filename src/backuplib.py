@@ -20,8 +20,10 @@ import struct
 import sqlite3
 import os
 import select
+import socket
 import datetime
 import consts
+import util
 import pdb
 import time
 
@@ -29,6 +31,16 @@ MBB_VERSION = "2"
 TIMEOUT = 0
 TXN_SIZE = 32768
 EXT_LEN_WITHOUT_QTIME = 16
+TAP_READ_BUFSIZE = 4 * 1024 * 1024
+INSERT_BATCH_SIZE = 1024
+RECORD_OVERHEAD = 48        # Approximate per-row cost of the integer columns
+SPLIT_HEADROOM = 64         # MB beyond the split size before sqlite reports full
+INDEX_RECORD_OVERHEAD = 24  # Approximate per-row cost of the (vbucket_id, key) index
+
+try:
+    _memoryview = memoryview
+except NameError: # python 2.6
+    _memoryview = None
 
 class ConnectException(Exception):
     def __str__(self):
@@ -61,6 +73,86 @@ def readTap(mc):
         val = data[extlen+keylen:]
     return cmd, opaque, cas, vbucketId, key, ext, val
 
+class TapStreamReader:
+    """
+    Buffered TAP frame reader
+
+    Reads from the socket into a large bytearray and parses as many
+    frames as are available per recv call. Values are returned as buffer
+    views into the read buffer. Bytes handed out are never overwritten,
+    so a view stays valid for as long as it is referenced.
+    """
+
+    def __init__(self, sock, bufsize=TAP_READ_BUFSIZE):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = bytearray(bufsize)
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        """
+        Return True if a complete frame is already buffered
+        """
+        avail = self.end - self.start
+        if avail < memcacheConstants.MIN_RECV_PACKET:
+            return False
+        remaining = struct.unpack_from(">I", self.buf, self.start + 8)[0]
+        return avail >= memcacheConstants.MIN_RECV_PACKET + remaining
+
+    def _recv(self):
+        if _memoryview is not None:
+            n = self.sock.recv_into(_memoryview(self.buf)[self.end:])
+        else:
+            data = self.sock.recv(len(self.buf) - self.end)
+            n = len(data)
+            self.buf[self.end:self.end + n] = data
+        if n == 0:
+            raise EOFError("Got empty data (remote died?).")
+        self.end += n
+
+    def _fill(self, need):
+        if self.end - self.start >= need:
+            return
+
+        if self.start + need > len(self.buf):
+            # Move the partial frame to a fresh buffer instead of compacting
+            # in place, views into the old buffer may still be in use
+            remaining = self.end - self.start
+            buf = bytearray(max(need, self.bufsize))
+            buf[0:remaining] = self.buf[self.start:self.end]
+            self.buf = buf
+            self.start = 0
+            self.end = remaining
+
+        while self.end - self.start < need:
+            self._recv()
+
+    def read(self):
+        """
+        Read the next frame. Returns the same tuple as readTap()
+        """
+        hdrlen = memcacheConstants.MIN_RECV_PACKET
+        if self.end - self.start < hdrlen:
+            self._fill(hdrlen)
+        magic, cmd, keylen, extlen, dtype, vbucketId, remaining, opaque, cas = \
+                struct.unpack_from(memcacheConstants.RES_PKT_FMT, self.buf, self.start)
+        assert (magic in (memcacheConstants.RES_MAGIC_BYTE,
+                memcacheConstants.REQ_MAGIC_BYTE)), "Got magic: %d" % magic
+
+        if self.end - self.start < hdrlen + remaining:
+            self._fill(hdrlen + remaining)
+        offset = self.start + hdrlen
+        self.start = offset + remaining
+
+        buf = self.buf
+        ext = str(buf[offset:offset + extlen])
+        offset += extlen
+        key = str(buf[offset:offset + keylen])
+        offset += keylen
+        val = buffer(buf, offset, remaining - extlen - keylen)
+        return cmd, opaque, cas, vbucketId, key, ext, val
+
 def encodeTAPConnectOpts(opts, backfill=False):
     header = 0
     val = []
@@ -71,6 +163,11 @@ def encodeTAPConnectOpts(opts, backfill=False):
                                    opts[op]))
         elif op == memcacheConstants.TAP_FLAG_LIST_VBUCKETS:
             val.append(_encodeVBucketList(opts[op]))
+        elif backfill and op == memcacheConstants.TAP_FLAG_CHECKPOINT and isinstance(opts[op], list):
+            # (vbucket, checkpoint id) of each vbucket
+            val.append(struct.pack(">H", len(opts[op])))
+            for vbucketId, checkpoint_id in opts[op]:
+                val.append(struct.pack(">HQ", vbucketId, checkpoint_id))
         elif backfill and op == memcacheConstants.TAP_FLAG_CHECKPOINT:
             if opts[op][2] >= 0:
                 val.append(struct.pack(">HHQ", opts[op][0], opts[op][1], opts[op][2]))
@@ -86,6 +183,129 @@ def _encodeVBucketList(vbl):
     return ''.join(vals)
 
 
+class CheckpointCursors:
+    """
+    In process management of named checkpoint cursors on one server
+
+    A TAP_CONNECT turns its connection into a TAP stream, so each
+    registration uses a connection of its own. Deregistrations share a
+    persistent connection that is reopened if the server drops it.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+        self.mc = None
+
+    def close(self):
+        if self.mc:
+            self.mc.close()
+            self.mc = None
+
+    def register(self, tapname, checkpoint_id, vbucketId):
+        """Register tapname on vbucketId, after its closed checkpoint checkpoint_id"""
+        self.register_vbuckets(tapname, {vbucketId: checkpoint_id})
+
+    def register_vbuckets(self, tapname, checkpoints):
+        """
+        Register tapname on the vbuckets of checkpoints, a dict of vbucket id
+        and closed checkpoint to start after. The server takes a TAP_CONNECT
+        of a registered name as a new registration, so all the vbuckets of a
+        cursor go in one.
+        """
+        vbuckets = sorted(checkpoints.keys())
+        mc = mc_bin_client.MemcachedClient(self.host, self.port)
+        try:
+            ext, val = encodeTAPConnectOpts({
+              memcacheConstants.TAP_FLAG_CHECKPOINT: [(x, int(checkpoints[x])) for x in vbuckets],
+              memcacheConstants.TAP_FLAG_SUPPORT_ACK: '',
+              memcacheConstants.TAP_FLAG_REGISTERED_CLIENT: 0x00,
+              memcacheConstants.TAP_FLAG_BACKFILL: 0xffffffff,
+              memcacheConstants.TAP_FLAG_CKSUM: '',
+              memcacheConstants.TAP_FLAG_LIST_VBUCKETS: vbuckets
+            }, True)
+            mc._sendCmd(memcacheConstants.CMD_TAP_CONNECT, tapname, val, 0, ext)
+            cmd, opaque, cas, vbucket, key, ext, val = readTap(mc)
+            if cmd != memcacheConstants.CMD_TAP_OPAQUE:
+                raise Exception("ERROR: could not register name: " + tapname)
+        finally:
+            mc.close()
+
+    def deregister(self, tapname):
+        """Deregister tapname on all the vbuckets"""
+        for attempt in (0, 1):
+            if not self.mc:
+                self.mc = mc_bin_client.MemcachedClient(self.host, self.port)
+            try:
+                self.mc.deregister_tap_client(tapname)
+                return
+            except (socket.error, EOFError):
+                self.close()
+                if attempt:
+                    raise
+
+    def repoint(self, tapname, checkpoint_id, vbucketId):
+        """Move tapname on vbucketId to after the closed checkpoint checkpoint_id"""
+        self.deregister(tapname)
+        self.register(tapname, checkpoint_id, vbucketId)
+
+class CheckpointStats:
+    """
+    Per vbucket index of a server's checkpoint stats
+
+    The stats are fetched once per refresh(), and lookups are answered
+    from the index.
+    """
+
+    CURSOR_SUFFIX = ':cursor_checkpoint_id'
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+        self.vbuckets = {}
+
+    def refresh(self):
+        mc = mc_bin_client.MemcachedClient(self.host, self.port)
+        try:
+            stats = mc.stats('checkpoint')
+        finally:
+            mc.close()
+
+        vbuckets = {}
+        for key, val in stats.items():
+            if not key.startswith('vb_'):
+                continue
+            vbucketId, sep, name = key[3:].partition(':')
+            try:
+                vbucketId = int(vbucketId)
+            except ValueError:
+                continue
+            if not vbucketId in vbuckets:
+                vbuckets[vbucketId] = ({}, {})
+            vb_stats, cursors = vbuckets[vbucketId]
+            if name.endswith(self.CURSOR_SUFFIX):
+                cursors[name[:-len(self.CURSOR_SUFFIX)]] = val
+            else:
+                vb_stats[name] = val
+        self.vbuckets = vbuckets
+
+    def get_stat(self, vbucketId, name, default=None):
+        if not vbucketId in self.vbuckets:
+            return default
+        return self.vbuckets[vbucketId][0].get(name, default)
+
+    def get_state(self, vbucketId):
+        return self.get_stat(vbucketId, 'state')
+
+    def is_backupable(self, vbucketId):
+        """True when the vbucket is active or replica"""
+        return self.get_state(vbucketId) in ('active', 'replica')
+
+    def has_cursor(self, vbucketId, tapname):
+        if not vbucketId in self.vbuckets:
+            return False
+        return tapname in self.vbuckets[vbucketId][1]
+
 def parseTapExt(ext):
     if len(ext) == 8:
         flg = exp = cksum_len = 0
@@ -107,14 +327,98 @@ def add_record(cursor, stmt, fields):
         result = False
     return result
 
-def create_backup_db(backup_file_name, max_backup_size, split_backup, deduplicate):
+class SplitWriter:
+    """
+    Batched cpoint_op writer for a backup split
+
+    Records are queued and written with executemany() in batches, and
+    committed every txn_size records. Whether the split is full is decided
+    from the predicted file size, using the page growth observed for the
+    bytes written so far, instead of waiting for sqlite to fail an insert.
+    The file size is only read after a commit: the sqlite3 module commits
+    the open transaction before a pragma.
+    """
+
+    def __init__(self, db, max_size, txn_size=TXN_SIZE, batch_size=INSERT_BATCH_SIZE):
+        self.db = db
+        self.cursor = db.cursor()
+        self.max_size = max_size
+        self.txn_size = txn_size
+        self.batch_size = batch_size
+        self.page_size = db.execute("pragma page_size").fetchone()[0]
+        self.batch = []
+        self.batch_bytes = 0
+        self.uncommitted = 0
+        self.base_size = self.used_size = self._file_size()
+        self.written_bytes = 0
+        self.pending_bytes = 0
+        self.written_records = 0
+        self.reserved = 0
+        self.ratio = 2.0
+
+    def _file_size(self):
+        return self.db.execute("pragma page_count").fetchone()[0] * self.page_size
+
+    def add(self, record, size, reserve=0, force=False):
+        """
+        Queue a record of given size in bytes
+        reserve is space the record will need later on, when the split is sealed
+        Returns False without queueing it if the record would overflow the split,
+        unless force is set: a record that did not fit into the previous split
+        is always taken by the next one
+        """
+        batch_bytes = self.batch_bytes + size
+        reserved = self.reserved + reserve
+        if not force and self.used_size + reserved + (self.pending_bytes + batch_bytes) * self.ratio > self.max_size:
+            return False
+
+        self.batch.append(record)
+        self.batch_bytes = batch_bytes
+        self.reserved = reserved
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        self.cursor.executemany(tap_stmt, self.batch)
+        self.uncommitted += len(self.batch)
+        self.pending_bytes += self.batch_bytes
+        self.written_records += len(self.batch)
+        self.batch = []
+        self.batch_bytes = 0
+
+        if self.uncommitted >= self.txn_size:
+            self.commit()
+
+    def commit(self):
+        if self.batch:
+            self.flush()
+        self.db.commit()
+        self.uncommitted = 0
+        if self.pending_bytes:
+            self.written_bytes += self.pending_bytes
+            self.pending_bytes = 0
+            self.used_size = self._file_size()
+            if self.used_size > self.base_size:
+                self.ratio = float(self.used_size - self.base_size) / self.written_bytes
+
+    def close(self):
+        self.cursor.close()
+
+def create_backup_db(backup_file_name, max_backup_size, split_backup, deduplicate,
+        profile=consts.SQLITE_WRITE_PROFILE, deferred_index=False):
     db = None
     db = sqlite3.connect(backup_file_name) # TODO: Revisit isolation level
     db.text_factory = str
+    if profile:
+        util.apply_sqlite_profile(db, profile)
     cur = db.execute("pragma user_version").fetchall()[0][0] # File's version.
     if (int(cur) != 0):
         raise Exception("ERROR: unexpected db user version: " + str(cur))
-    if deduplicate:
+    if deduplicate and not deferred_index:
         db.executescript("""
         BEGIN;
         CREATE TABLE cpoint_op
@@ -145,9 +449,38 @@ def create_backup_db(backup_file_name, max_backup_size, split_backup, deduplicat
         db_page_size = db.execute("pragma page_size").fetchone()[0]
         db_max_page_count = max_backup_size / db_page_size
         db.execute("pragma max_page_count=%d" % (db_max_page_count))
-        db.execute("pragma journal_mode=MEMORY")
+        if not profile:
+            db.execute("pragma journal_mode=MEMORY")
     return db
 
+def seal_backup_db(db):
+    """
+    Deduplicate and index a backup db created with deferred_index
+    Rows are inserted in stream order, so the highest rowid of a key holds
+    its latest (cpoint_id, seq) mutation, as INSERT OR REPLACE would keep.
+    """
+    db.executescript("""
+    BEGIN;
+    DELETE FROM cpoint_op WHERE rowid NOT IN
+    (SELECT max(rowid) FROM cpoint_op GROUP BY vbucket_id, key);
+    CREATE UNIQUE INDEX K ON cpoint_op(vbucket_id, key);
+    COMMIT;
+    """)
+
+def write_split_meta(filepath, ops, logger):
+    """
+    Write the metadata and checksum sidecars of a closed split, readers
+    fall back to the split itself without them
+    """
+    try:
+        util.write_split_meta(filepath, ops)
+    except Exception, e:
+        logger.log("Warning: Unable to write metadata of %s (%s)" %(filepath, str(e)))
+    try:
+        util.write_checksum(filepath)
+    except Exception, e:
+        logger.log("Warning: Unable to write checksum of %s (%s)" %(filepath, str(e)))
+
 
 class BackupFactory:
     """
@@ -155,7 +488,7 @@ class BackupFactory:
     """
 
     def __init__(self, base_filepath, backup_type, tapname, vbid_list, logger, host, port,
-            txn_size=None):
+            txn_size=None, sqlite_profile=consts.SQLITE_WRITE_PROFILE, deferred_index=False):
         self.base_filepath = base_filepath
         self.backup_type = backup_type
         self.logger = logger
@@ -165,11 +498,12 @@ class BackupFactory:
         self.full_backup = False
         self.backfill_chk_start = False
         self.current_checkpoint_id = 0
-        self.update_count = 0
         self.source = tapname
         self.complete = False
         self.host = host
         self.port = port
+        self.sqlite_profile = sqlite_profile
+        self.deferred_index = deferred_index
 
         if txn_size:
             self.txn_size = txn_size
@@ -223,7 +557,8 @@ class BackupFactory:
 
         self.mc._sendCmd(memcacheConstants.CMD_TAP_CONNECT, tapname, val, 0, ext)
         self.sinput = [self.mc.s]
-        self.op_records = []
+        self.reader = TapStreamReader(self.mc.s)
+        self.pending = [] # Records carried over to the next split
 
         self.vbmap = {} # Key is vbucketId, value is [checkpointId, seq].
 
@@ -245,11 +580,25 @@ class BackupFactory:
     def get_current_split(self):
         return self.current_split
 
+    def _close_split(self, db, cursor, writer, start):
+        writer.commit()
+        writer.close()
+        cursor.close()
+        seal_time = 0
+        if self.deferred_index:
+            seal_start = time.time()
+            seal_backup_db(db)
+            seal_time = time.time() - seal_start
+        db.close()
+        write_split_meta(self.current_split, writer.written_records, self.logger)
+        self.logger.log("Closed Backup file : %s (seal time: %.2f sec, total time: %.2f sec)"
+                %(self.current_split, seal_time, time.time() - start))
+
     def create_next_split(self, buffer_path):
         if self.complete:
             return None
 
-        commits_count = 0
+        start = time.time()
 
         filepath = self._get_next_file(buffer_path)
         self.current_split = filepath
@@ -264,7 +613,8 @@ class BackupFactory:
                     raise Exception ("FAILED: Creating Backup directory %s (%s)" %(backup_dir, e.strerror))
 
         self.logger.log("Creating Backup file : %s" %(filepath))
-        db = create_backup_db(filepath, consts.SPLIT_SIZE, True, True)
+        db = create_backup_db(filepath, consts.SPLIT_SIZE + SPLIT_HEADROOM, True, True,
+                self.sqlite_profile, self.deferred_index)
         self.split_backup_files.append((buffer_path, filepath))
         c = db.cursor()
         if self.current_checkpoint_id > 0:
@@ -277,31 +627,21 @@ class BackupFactory:
 
             db.commit()
 
-        ## Insert all the records that belong to the rollbacked transaction.
-        failed = False
-        for record in self.op_records:
-            result = add_record(c, tap_stmt, record)
-            if result == False:
-                failed = True
-        if failed == True:
-            db.rollback()
-            for record in self.op_records[:-1]:
-                result = add_record(c, tap_stmt, record)
-            self.op_records = [self.op_records[-1]]
-            self.update_count = 1
-            db.commit()
-            db.close()
-            self.split_no += 1
-            return filepath
+        writer = SplitWriter(db, consts.SPLIT_SIZE * 1024 * 1024, self.txn_size)
+
+        ## Insert the records which did not fit into the previous split.
+        for record, size, reserve in self.pending:
+            writer.add(record, size, reserve, True)
+        self.pending = []
 
         last_checkpoint_id = -1
         while True:
-            if TIMEOUT > 0:
+            if TIMEOUT > 0 and not self.reader.pending():
                 iready, oready, eready = select.select(self.sinput, [], [], TIMEOUT)
                 if (not iready) and (not oready) and (not eready):
                     raise Exception("EXIT: timeout after " + str(TIMEOUT) + " seconds of inactivity")
 
-            cmd, opaque, cas, vbucketId, key, ext, val = readTap(self.mc)
+            cmd, opaque, cas, vbucketId, key, ext, val = self.reader.read()
 
             needAck = False
 
@@ -319,9 +659,7 @@ class BackupFactory:
                         if result == False:
                             raise Exception("ERROR: Unable to write checkpoint states"
                                                                 "to backup file")
-                    db.commit()
-                    self.update_count = 0
-                    self.op_records = []
+                    writer.commit()
                     self.current_checkpoint_id = i
                     self.backfill_chk_start = True
 
@@ -342,41 +680,30 @@ class BackupFactory:
                 if cksum_len > 0:
                     cksum_offset = len(val) - cksum_len
                     cksum = val[cksum_offset:]
-                    val = val[:cksum_offset]
-
-                val = sqlite3.Binary(val)
-                self.op_records.append((vbucketId, checkpointId, seq, cmdOp,key, flg, exp, cas, cksum, val))
-                result = add_record(c, tap_stmt, (vbucketId, checkpointId, seq, cmdOp,
-                                                  key, flg, exp, cas, cksum, val))
-                self.update_count = self.update_count + 1
-                if result == False:
+                    val = buffer(val, 0, cksum_offset)
+
+                record = (vbucketId, checkpointId, seq, cmdOp, key, flg, exp, cas, cksum, val)
+                size = len(key) + len(val) + len(cksum) + RECORD_OVERHEAD
+                reserve = 0
+                if self.deferred_index:
+                    reserve = len(key) + INDEX_RECORD_OVERHEAD
+                if not writer.add(record, size, reserve):
                     ## The current backup db file is full
-                    try:
-                        db.rollback()
-                        if commits_count == 0:
-                            for record in self.op_records[:-1]:
-                                result = add_record(c, tap_stmt, record)
-                            db.commit()
-                            self.op_records = [self.op_records[-1]]
-                            self.update_count = 1
-                    except sqlite3.Error, e: ## Can't find the better error for rollback failure.
-                        self.logger.log("WARNING: Insertion transaction was already rollbacked: " + e.args[0])
-                    c.close()
-                    db.close()
+                    self.pending.append((record, size, reserve))
+                    self._close_split(db, c, writer, start)
                     self.split_no += 1
                     return filepath
 
             elif cmd == memcacheConstants.CMD_TAP_CHECKPOINT_START:
                 if len(ext) > 0:
                     eng_length, flags, ttl, flg, exp, needAck, cksum = parseTapExt(ext)
-                checkpoint_id = struct.unpack(">Q", val)
+                checkpoint_id = struct.unpack_from(">Q", val)
                 checkpointStartExists = False
                 self.current_checkpoint_id = checkpoint_id[0]
 
                 # While backfill, if it receives START, it indiciates backup is complete.
                 if self.backfill_chk_start:
-                    if self.update_count > 0:
-                        db.commit()
+                    self._close_split(db, c, writer, start)
                     self.complete = True
                     return filepath
                 elif last_checkpoint_id > 0 and last_checkpoint_id == checkpoint_id[0] - 1:
@@ -392,18 +719,16 @@ class BackupFactory:
                 if checkpointStartExists == False:
                     self.vbmap[vbucketId] = [checkpoint_id[0], 0]
                     t = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+                    writer.commit()
                     result = add_record(c, chkpoint_stmt,
                                         (vbucketId, checkpoint_id[0], -1, self.source, t))
                     if result == False:
                         ## The current backup db file is full and closed.
-                        c.close()
-                        db.close()
+                        self._close_split(db, c, writer, start)
                         self.split_no += 1
                         return filepath
                     else:
                         db.commit()
-                        self.op_records = []
-                        self.update_count = 0
                     last_checkpoint_id = checkpoint_id[0]
 
             elif cmd == memcacheConstants.CMD_TAP_CHECKPOINT_END:
@@ -415,13 +740,7 @@ class BackupFactory:
                     eng_length, flags, ttl, flg, exp, needAck, cksum = parseTapExt(ext)
                     opaque_opcode = struct.unpack(">I" , val[0:eng_length])
                     if opaque_opcode[0] == memcacheConstants.TAP_OPAQUE_OPEN_CHECKPOINT:
-                        if self.update_count > 0:
-                            db.commit()
-                            self.op_records = []
-                            self.update_count = 0
-
-                        db.commit()
-                        self.update_count = 0
+                        self._close_split(db, c, writer, start)
                         self.complete = True
                         return filepath
 
@@ -437,16 +756,259 @@ class BackupFactory:
             else:
                 raise Exception("ERROR: unhandled cmd " + str(cmd))
 
-            if self.update_count == self.txn_size:
-                db.commit()
-                commits_count += 1
-                self.op_records = []
-                self.update_count = 0
-
             if needAck:
                 self.mc._sendMsg(cmd, '', '', opaque,
                             vbucketId=0,
                             fmt=memcacheConstants.RES_PKT_FMT,
                             magic=memcacheConstants.RES_MAGIC_BYTE)
 
+class VBucketSplits:
+    """
+    Split files of one vbucket in a multiplexed backup
+    """
+
+    def __init__(self, vbucketId, base_filepath, buffer_path, logger, source,
+            txn_size, sqlite_profile, deferred_index):
+        self.vbucketId = vbucketId
+        self.base_filepath = base_filepath
+        self.buffer_path = buffer_path
+        self.logger = logger
+        self.source = source
+        self.txn_size = txn_size
+        self.sqlite_profile = sqlite_profile
+        self.deferred_index = deferred_index
+        self.split_no = 0
+        self.split_backup_files = []
+        self.checkpoints = []
+        self.checkpoint_id = 0
+        self.seq = 0
+        self.last_checkpoint_id = -1
+        self.pending = []
+        self.db = None
+        self.complete = False
+
+    def _get_next_file(self):
+        path = os.path.join(self.buffer_path, self.base_filepath)
+        return path.replace('%', str(self.split_no).zfill(5))
+
+    def list_splits(self):
+        return self.split_backup_files
+
+    def open_split(self):
+        filepath = self._get_next_file()
+        if os.path.exists(filepath):
+            raise Exception("File already exists")
+        backup_dir = os.path.dirname(filepath)
+        if not os.path.exists(backup_dir):
+            try:
+                os.makedirs(backup_dir)
+            except Exception, e:
+                raise Exception ("FAILED: Creating Backup directory %s (%s)" %(backup_dir, e.strerror))
+
+        self.logger.log("Creating Backup file : %s" %(filepath))
+        self.start = time.time()
+        self.db = create_backup_db(filepath, consts.SPLIT_SIZE + SPLIT_HEADROOM, True, True,
+                self.sqlite_profile, self.deferred_index)
+        self.split_backup_files.append(filepath)
+        self.cursor = self.db.cursor()
+        if self.checkpoint_id > 0:
+            t = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+            add_record(self.cursor, chkpoint_stmt, (self.vbucketId, self.checkpoint_id, -1, self.source, t))
+            self.db.commit()
+
+        self.writer = SplitWriter(self.db, consts.SPLIT_SIZE * 1024 * 1024, self.txn_size)
+        for record, size, reserve in self.pending:
+            self.writer.add(record, size, reserve, True)
+        self.pending = []
+
+    def close_split(self):
+        self.writer.commit()
+        self.writer.close()
+        self.cursor.close()
+        seal_time = 0
+        if self.deferred_index:
+            seal_start = time.time()
+            seal_backup_db(self.db)
+            seal_time = time.time() - seal_start
+        self.db.close()
+        self.db = None
+        write_split_meta(self.split_backup_files[-1], self.writer.written_records, self.logger)
+        self.logger.log("Closed Backup file : %s (seal time: %.2f sec, total time: %.2f sec)"
+                %(self.split_backup_files[-1], seal_time, time.time() - self.start))
+        self.split_no += 1
+
+    def add_mutation(self, cmdName, cmdOp, key, flg, exp, cas, cksum, val):
+        if self.checkpoint_id == 0:
+            raise Exception("ERROR: received %s without checkpoint in vbucket: %s"
+                    %(cmdName, self.vbucketId))
+
+        self.seq += 1
+        record = (self.vbucketId, self.checkpoint_id, self.seq, cmdOp, key, flg, exp, cas, cksum, val)
+        size = len(key) + len(val) + len(cksum) + RECORD_OVERHEAD
+        reserve = 0
+        if self.deferred_index:
+            reserve = len(key) + INDEX_RECORD_OVERHEAD
+        if not self.writer.add(record, size, reserve):
+            self.pending.append((record, size, reserve))
+            self.close_split()
+            self.open_split()
+
+    def start_checkpoint(self, checkpoint_id):
+        if checkpoint_id == self.checkpoint_id:
+            return
+        if self.last_checkpoint_id > 0 and self.last_checkpoint_id != checkpoint_id - 1:
+            raise Exception("Checkpoints received are not continous. cpoint_id:%d " \
+                    "received after cpoint_id:%d in vbucket: %s" %(checkpoint_id,
+                        self.last_checkpoint_id, self.vbucketId))
+
+        self.checkpoint_id = checkpoint_id
+        self.seq = 0
+        self.writer.commit()
+        t = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        if add_record(self.cursor, chkpoint_stmt,
+                (self.vbucketId, checkpoint_id, -1, self.source, t)):
+            self.db.commit()
+        else:
+            ## The current split is full, the next one records the checkpoint
+            self.close_split()
+            self.open_split()
+        self.checkpoints.append(checkpoint_id)
+        self.last_checkpoint_id = checkpoint_id
+
+    def finish(self):
+        if self.db:
+            self.close_split()
+        self.complete = True
+
+    def abort(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+        for filepath in self.split_backup_files:
+            for path in [filepath] + util.sidecar_paths(filepath):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+class MultiBackupFactory:
+    """
+    Incremental backup of several vbuckets over a single TAP connection
+
+    The stream is demultiplexed by vbucket id into per vbucket split files.
+    The backup is complete once every vbucket has reached its open checkpoint.
+    """
+
+    def __init__(self, base_filepath, tapname, backup_paths, logger, host, port,
+            txn_size=None, sqlite_profile=consts.SQLITE_WRITE_PROFILE, deferred_index=False):
+        self.logger = logger
+        if not txn_size:
+            txn_size = TXN_SIZE
+
+        self.vbuckets = {}
+        for vbucketId, buffer_path in backup_paths.items():
+            self.vbuckets[vbucketId] = VBucketSplits(vbucketId, base_filepath, buffer_path,
+                    logger, tapname, txn_size, sqlite_profile, deferred_index)
+
+        self.mc = mc_bin_client.MemcachedClient(host, port)
+        ext, val = encodeTAPConnectOpts({
+          memcacheConstants.TAP_FLAG_CHECKPOINT: '',
+          memcacheConstants.TAP_FLAG_SUPPORT_ACK: '',
+          memcacheConstants.TAP_FLAG_REGISTERED_CLIENT: 0x01, # "value > 0" means "closed checkpoints only"
+          memcacheConstants.TAP_FLAG_BACKFILL: 0xffffffff,
+          memcacheConstants.TAP_FLAG_CKSUM: '',
+          memcacheConstants.TAP_FLAG_LIST_VBUCKETS: sorted(backup_paths.keys())
+        })
+
+        self.mc._sendCmd(memcacheConstants.CMD_TAP_CONNECT, tapname, val, 0, ext)
+        self.sinput = [self.mc.s]
+        self.reader = TapStreamReader(self.mc.s)
+
+    def __del__(self):
+        if self.mc:
+            self.mc.close()
+
+    def list_splits(self, vbucketId):
+        return self.vbuckets[vbucketId].list_splits()
+
+    def get_checkpoints(self, vbucketId):
+        return self.vbuckets[vbucketId].checkpoints
+
+    def abort(self):
+        for splits in self.vbuckets.values():
+            splits.abort()
+
+    def _get_vbucket(self, cmdName, vbucketId):
+        if not vbucketId in self.vbuckets:
+            raise Exception("%s with unknown vbucketId: %s" %(cmdName, vbucketId))
+        return self.vbuckets[vbucketId]
+
+    def run(self):
+        """
+        Stream all the vbuckets until each one has reached its open checkpoint
+        """
+        for splits in self.vbuckets.values():
+            splits.open_split()
+
+        remaining = len(self.vbuckets)
+        while remaining:
+            if TIMEOUT > 0 and not self.reader.pending():
+                iready, oready, eready = select.select(self.sinput, [], [], TIMEOUT)
+                if (not iready) and (not oready) and (not eready):
+                    raise Exception("EXIT: timeout after " + str(TIMEOUT) + " seconds of inactivity")
+
+            cmd, opaque, cas, vbucketId, key, ext, val = self.reader.read()
+
+            needAck = False
+
+            if (cmd == memcacheConstants.CMD_TAP_MUTATION or
+                cmd == memcacheConstants.CMD_TAP_DELETE or
+                cmd == memcacheConstants.CMD_TAP_FLUSH):
+                cmdName, cmdOp = cmdInfo[cmd]
+                splits = self._get_vbucket(cmdName, vbucketId)
+                eng_length, flags, ttl, flg, exp, needAck, cksum_len = parseTapExt(ext)
+                cksum = ""
+                if cksum_len > 0:
+                    cksum_offset = len(val) - cksum_len
+                    cksum = val[cksum_offset:]
+                    val = buffer(val, 0, cksum_offset)
+
+                ## Checkpoints closed after a vbucket completed go to the next backup
+                if not splits.complete:
+                    splits.add_mutation(cmdName, cmdOp, key, flg, exp, cas, cksum, val)
+
+            elif cmd == memcacheConstants.CMD_TAP_CHECKPOINT_START:
+                if len(ext) > 0:
+                    eng_length, flags, ttl, flg, exp, needAck, cksum = parseTapExt(ext)
+                splits = self._get_vbucket('checkpoint start', vbucketId)
+                if not splits.complete:
+                    splits.start_checkpoint(struct.unpack_from(">Q", val)[0])
+
+            elif cmd == memcacheConstants.CMD_TAP_CHECKPOINT_END:
+                if len(ext) > 0:
+                    eng_length, flags, ttl, flg, exp, needAck, cksum = parseTapExt(ext)
+
+            elif cmd == memcacheConstants.CMD_TAP_OPAQUE:
+                if len(ext) > 0:
+                    eng_length, flags, ttl, flg, exp, needAck, cksum = parseTapExt(ext)
+                    opaque_opcode = struct.unpack(">I" , val[0:eng_length])
+                    if opaque_opcode[0] == memcacheConstants.TAP_OPAQUE_OPEN_CHECKPOINT:
+                        splits = self._get_vbucket('open checkpoint', vbucketId)
+                        if not splits.complete:
+                            splits.finish()
+                            remaining -= 1
+
+            elif cmd == memcacheConstants.CMD_TAP_CONNECT:
+                self.abort()
+                self.mc.close()
+                self.mc = None
+                raise ConnectException
+
+            elif cmd == memcacheConstants.CMD_NOOP:
+                pass
+            else:
+                raise Exception("ERROR: unhandled cmd " + str(cmd))
 
+            if needAck:
+                self.mc._sendMsg(cmd, '', '', opaque,
+                            vbucketId=0,
+                            fmt=memcacheConstants.RES_PKT_FMT,
+                            magic=memcacheConstants.RES_MAGIC_BYTE)
@@ -37,7 +37,7 @@ sys.path.insert(0, PYTHON_PATH)
 
 import consts
 from mc_bin_client import MemcachedClient
-from util import getcommandoutput, zruntime_readkey
+from util import getcommandoutput, zruntime_readkey, apply_sqlite_profile
 from config import Config
 
 def exit(*x):
@@ -340,10 +340,12 @@ class KeyStore:
     Class for writing restored KeyStore
     """
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, profile=None):
         self.filepath = filepath
         self.db = sqlite3.connect(self.filepath)
         self.read_cursor = None
+        if profile:
+            apply_sqlite_profile(self.db, profile)
         self.db.executescript("""
         BEGIN;
         CREATE TABLE IF NOT EXISTS restored_keys
@@ -0,0 +1,229 @@
+#!/usr/bin/env python26
+#Description: Per vbucket catalog of the backup files of a storage server
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import glob
+import time
+import json
+import fcntl
+import consts
+import util
+
+DAY_EPOCH = 60*60*24
+
+class CatalogError(Exception):
+    pass
+
+def catalog_path(vb_path):
+    return os.path.join(vb_path, consts.CATALOG_FILE)
+
+def read_split_index(split_index):
+    """
+    Catalog entry of a split index: [name, size, first checkpoint,
+    last checkpoint, mtime] of each backup file it lists, from their
+    metadata sidecars
+    """
+    dirname = os.path.dirname(split_index)
+    files = []
+    for name in open(split_index).read().split():
+        path = os.path.join(dirname, name)
+        try:
+            meta = util.get_split_meta(path, True)
+        except Exception, e:
+            raise CatalogError("Unable to read %s listed in %s (%s)" %(path, split_index, str(e)))
+        if len(meta['checkpoints']) == 0:
+            raise CatalogError("%s has no checkpoints" %path)
+        files.append([name, meta['size'], meta['checkpoints'][0][0], meta['checkpoints'][-1][1],
+                meta['mtime']])
+    return files
+
+def add_split_index(vb_path, split_index, files=None):
+    """
+    Record a complete split index and its files in the vbucket catalog.
+    Called by the writers of backup files once the split index is written.
+    """
+    if files == None:
+        files = read_split_index(split_index)
+    record = {'index': os.path.relpath(split_index, vb_path), 'files': files}
+    return util.appendToFile_Locked(catalog_path(vb_path), [json.dumps(record)])
+
+def split_index_name(backup_file):
+    return "%s.split" %"-".join(os.path.basename(backup_file).split('-')[:-1])
+
+
+class Catalog:
+    """
+    Restore plan of a vbucket from its catalog
+
+    The catalog is an append only file of split index records kept in the
+    vbucket directory. Records are checked against the files on disk when
+    the plan is built: split indexes that are gone are dropped, and split
+    indexes missing from the catalog (written before it existed or by an
+    older writer) are read and added, so the plan matches what listing the
+    directories would find.
+
+    Backup files listed in the manifest.del of their directory are left
+    out one by one. A split index with only some of its files left out, or
+    a backup file that no split index lists, failed the split verification
+    of the listing walk; the first fails the plan, the second is not part
+    of it.
+    """
+
+    def __init__(self, vb_path, logger=None):
+        self.vb_path = vb_path
+        self.logger = logger
+        self.path = catalog_path(vb_path)
+
+    def log(self, msg):
+        if self.logger:
+            self.logger.log(msg)
+
+    def load(self):
+        entries = {}
+        lines = 0
+        if os.path.exists(self.path):
+            for line in open(self.path):
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    entries[record['index']] = record['files']
+                except (ValueError, KeyError), e:
+                    # A record cut short by a crash
+                    continue
+        return entries, lines
+
+    def compact(self, keep):
+        """
+        Rewrite the catalog with the records of the split indexes in keep
+        """
+        lock = open("%s.lock" %self.path, 'w')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            # Records appended since the catalog was read are kept
+            current, lines = self.load()
+            tmp_file = "%s.%d" %(self.path, os.getpid())
+            f = open(tmp_file, 'w')
+            for index, files in current.items():
+                if index in keep:
+                    f.write("%s\n" %json.dumps({'index': index, 'files': files}))
+            f.close()
+            os.rename(tmp_file, self.path)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            lock.close()
+
+    def is_valid(self, dirname, files):
+        for entry in files:
+            # Records written before the mtime was kept are read again
+            if len(entry) != 5:
+                return False
+            name, size, first, last, mtime = entry
+            try:
+                st = os.stat(os.path.join(dirname, name))
+            except OSError:
+                return False
+            if st.st_size != size or int(st.st_mtime) != mtime:
+                return False
+        return True
+
+    def excluded(self, dirname):
+        """
+        Names of the backup files of a directory listed in its manifest.del
+        """
+        manifest = os.path.join(dirname, consts.DEL_MANIFEST)
+        if not os.path.exists(manifest):
+            return set()
+        return set(map(os.path.basename, open(manifest).read().split()))
+
+    def scan(self, subdir, entries, added):
+        """
+        Backup files of the split indexes of a directory as [path, size,
+        first checkpoint, last checkpoint], path relative to the vbucket
+        """
+        dirname = os.path.join(self.vb_path, subdir)
+        excluded = self.excluded(dirname)
+        result = []
+        for split_index in glob.glob(os.path.join(dirname, "*.split")):
+            index = os.path.relpath(split_index, self.vb_path)
+            files = entries.get(index)
+            if files == None or not self.is_valid(dirname, files):
+                files = read_split_index(split_index)
+                add_split_index(self.vb_path, split_index, files)
+                entries[index] = files
+                added.append(index)
+            kept = filter(lambda x: not x[0] in excluded, files)
+            if len(kept) and len(kept) != len(files):
+                raise CatalogError("%s is partly listed in %s" %(split_index, consts.DEL_MANIFEST))
+            for name, size, first, last, mtime in kept:
+                result.append([os.path.join(subdir, name), size, first, last])
+        return result
+
+    def is_complete(self, subdir):
+        return os.path.exists(os.path.join(self.vb_path, subdir, "done"))
+
+    def plan(self, now=None):
+        """
+        Backup files to restore, newest first, as zbase-restore would find
+        them by listing: incremental, then periodic and master backups
+        """
+        if now == None:
+            now = time.time()
+
+        entries, lines = self.load()
+        added = []
+
+        incremental = self.scan(consts.INCR_DIRNAME, entries, added)
+
+        master = []
+        master_epoch = now
+        for attempt in xrange(consts.MAX_BACKUP_SEARCH_TRIES):
+            subdir = os.path.join(consts.MASTER_DIRNAME, epoch2date(master_epoch))
+            if self.is_complete(subdir):
+                master = self.scan(subdir, entries, added)
+            if len(master):
+                master_epoch += DAY_EPOCH
+                break
+            master_epoch -= DAY_EPOCH
+
+        periodic = []
+        for date_epoch in xrange(int(master_epoch), int(now) + DAY_EPOCH, DAY_EPOCH):
+            subdir = os.path.join(consts.PERIODIC_DIRNAME, epoch2date(date_epoch))
+            if self.is_complete(subdir):
+                periodic.extend(self.scan(subdir, entries, added))
+
+        if len(added):
+            self.log("Info: Added %d split indexes to catalog %s" %(len(added), self.path))
+
+        # Drop the records of backups removed by merges and the coalescer
+        # once they are most of the catalog
+        known = set()
+        for subdir in [consts.INCR_DIRNAME, consts.MASTER_DIRNAME + '/*', consts.PERIODIC_DIRNAME + '/*']:
+            for split_index in glob.glob(os.path.join(self.vb_path, subdir, "*.split")):
+                known.add(os.path.relpath(split_index, self.vb_path))
+        if lines + len(added) > 2 * len(known) + 16:
+            self.compact(known)
+
+        plan = {}
+        for name, files in (('incremental', incremental), ('periodic', periodic), ('master', master)):
+            files.sort(key=lambda x: util.natural_sortkey(x[0]))
+            files.reverse()
+            plan[name] = files
+        return plan
+
+def epoch2date(epoch):
+    lt = time.gmtime(epoch)
+    return time.strftime('%Y-%m-%d',lt)
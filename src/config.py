@@ -27,6 +27,19 @@ class Config:
         self.log_level = consts.DEFAULT_LOGLEVEL
         self.syslog_tag = consts.SYSLOG_TAG
         self.zbase_db_paths = consts.DB_PATHS
+        self.backup_sqlite_profile = consts.SQLITE_WRITE_PROFILE
+        self.blobrestore_sqlite_profile = consts.SQLITE_WRITE_PROFILE
+        self.backup_deferred_index = False
+        self.vbuckets_per_stream = consts.VBUCKETS_PER_STREAM
+        self.journal_flush_interval = consts.JOURNAL_FLUSH_INTERVAL
+        self.daily_merge_engine = consts.MERGE_ENGINE
+        self.master_merge_engine = consts.MERGE_ENGINE
+        self.daily_merge_dedup = consts.MERGE_DEDUP
+        self.master_merge_dedup = consts.MERGE_DEDUP
+        self.file_server_mode = consts.FILE_SERVER_MODE
+        self.file_server_backlog = consts.FILE_SERVER_BACKLOG
+        self.file_server_workers = consts.FILE_SERVER_WORKERS
+        self.file_server_dm_cache_ttl = consts.FILE_SERVER_DM_CACHE_TTL
 
     def read(self):
         self.config.read(self.conf_file)
@@ -48,6 +61,32 @@ class Config:
             self.master_backup_interval_days = 0
 
         self.upload_interval_mins = int(self.config.get('backup', 'upload_interval'))
+
+        try:
+            self.backup_sqlite_profile = self.config.get('backup', 'sqlite_profile')
+        except:
+            self.backup_sqlite_profile = consts.SQLITE_WRITE_PROFILE
+
+        try:
+            self.backup_deferred_index = self.config.getboolean('backup', 'deferred_index')
+        except:
+            self.backup_deferred_index = False
+
+        try:
+            self.vbuckets_per_stream = int(self.config.get('backup', 'vbuckets_per_stream'))
+        except:
+            self.vbuckets_per_stream = consts.VBUCKETS_PER_STREAM
+
+        try:
+            self.journal_flush_interval = int(self.config.get('backup', 'journal_flush_interval'))
+        except:
+            self.journal_flush_interval = consts.JOURNAL_FLUSH_INTERVAL
+
+        try:
+            self.blobrestore_sqlite_profile = self.config.get('blobrestore', 'sqlite_profile')
+        except:
+            self.blobrestore_sqlite_profile = consts.SQLITE_WRITE_PROFILE
+
         log_level = self.config.get('log', 'level')
         if log_level in ['INFO', 'DEBUG']:
             self.log_level = log_level
@@ -74,6 +113,27 @@ class Config:
         self.hostname = hostname
 
         self.download_retries = int(self.config.get('restore', 'download_retries'))
+
+        try:
+            self.download_streams = int(self.config.get('restore', 'download_streams'))
+        except:
+            self.download_streams = consts.DOWNLOAD_STREAMS
+
+        try:
+            self.restore_applier = self.config.get('restore', 'applier')
+        except:
+            self.restore_applier = consts.RESTORE_APPLIER
+
+        try:
+            self.restore_dedup = self.config.getboolean('restore', 'dedup')
+        except:
+            self.restore_dedup = consts.RESTORE_DEDUP
+
+        try:
+            self.restore_parallel_vbuckets = int(self.config.get('restore', 'parallel_vbuckets'))
+        except:
+            self.restore_parallel_vbuckets = consts.RESTORE_PARALLEL_VBUCKETS
+
         self.upload_retries = int(self.config.get('backup', 'upload_retries'))
 
 
@@ -116,4 +176,44 @@ class Config:
         except:
             self.master_mem_threshold = consts.MASTERJOB_MEM_THRESHOLD
 
+        try:
+            self.daily_merge_engine = self.config.get('daily_merge', 'engine')
+        except:
+            self.daily_merge_engine = consts.MERGE_ENGINE
+
+        try:
+            self.master_merge_engine = self.config.get('master_merge', 'engine')
+        except:
+            self.master_merge_engine = consts.MERGE_ENGINE
+
+        try:
+            self.daily_merge_dedup = self.config.get('daily_merge', 'dedup')
+        except:
+            self.daily_merge_dedup = consts.MERGE_DEDUP
+
+        try:
+            self.master_merge_dedup = self.config.get('master_merge', 'dedup')
+        except:
+            self.master_merge_dedup = consts.MERGE_DEDUP
+
+        try:
+            self.file_server_mode = self.config.get('file_server', 'mode')
+        except:
+            self.file_server_mode = consts.FILE_SERVER_MODE
+
+        try:
+            self.file_server_backlog = int(self.config.get('file_server', 'backlog'))
+        except:
+            self.file_server_backlog = consts.FILE_SERVER_BACKLOG
+
+        try:
+            self.file_server_workers = int(self.config.get('file_server', 'workers'))
+        except:
+            self.file_server_workers = consts.FILE_SERVER_WORKERS
+
+        try:
+            self.file_server_dm_cache_ttl = int(self.config.get('file_server', 'dm_cache_ttl'))
+        except:
+            self.file_server_dm_cache_ttl = consts.FILE_SERVER_DM_CACHE_TTL
+
 
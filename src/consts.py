@@ -16,7 +16,8 @@
 #   limitations under the License.
 
 SYSLOG_TAG = 'zbasebackup'
-MBRESTORE_PID_FILE = '/var/run/mbrestore.pid'
+MBRESTORE_PID_FILE = '/var/run/mbrestore_vb_%d.pid'
+MBRESTORE_HOST_LOCK = '/var/run/mbrestore.lock'
 MBBACKUP_PID_FILE = '/var/run/zbbackup.pid'
 SCHEDULER_PID_FILE = '/var/run/backup_merge.pid'
 BLOBRESTORED_PID_FILE = '/var/run/blobrestored.pid'
@@ -37,11 +38,15 @@ PATH_MBRESTORE_EXEC = '/opt/zbase/lib/python/mbadm-online-restore'
 PATH_MBTAP_REGISTER_EXEC = '/opt/zbase/lib/python/mbadm-tap-registration'
 PATH_COUNTKEYS_EXEC = '/opt/zbase/zbase-backup/count_backup_keys.sh'
 PATH_MBMERGE_EXEC = '/opt/zbase/zbase-backup/merge-incremental'
+MERGE_ENGINE = 'merge-incremental'
+MERGE_DEDUP = 'hash'
 DEFAULT_LOGLEVEL = 'INFO'
 MERGE_CMD = "/opt/zbase/zbase-backup/merge.py"
 BACKUP_ROOT = "/dev/shm"
 SPLIT_UPLOAD_CMD = "/opt/zbase/zbase-backup/misc/split_backup.py"
 SPLIT_SIZE = 1024
+SQLITE_WRITE_PROFILE = 'bulk-once'
+VBUCKETS_PER_STREAM = 1
 DEL_COMMAND = "del"
 BLOBRESTORE_JOBS_DIR = '/home/storageserver/jobs/'
 BLOBRESTORE_PROCESSED_JOBS_DIR = '/home/storageserver/processed_jobs/'
@@ -57,12 +62,14 @@ MIN_INCR_BACKUPS_COUNT = 15
 BAD_DISK_FILE = '/var/tmp/disk_mapper/bad_disk'
 DIRTY_DISK_FILE = 'dirty'
 TO_BE_DELETED_FILE = 'to_be_deleted'
+JOURNAL_FLUSH_INTERVAL = 5
 PATH_DAILY_MERGE = '/opt/zbase/zbase-backup/daily-merge'
 PATH_MASTER_MERGE = '/opt/zbase/zbase-backup/master-merge'
 MAX_MASTERJOBS = 1
 MAX_DAILYJOBS = 5
 DAILYJOB_MEM_THRESHOLD = 10240
 MASTERJOB_MEM_THRESHOLD = 15360
+MERGE_MEMORY_MODEL = '/var/tmp/merge_memory_model'
 ZRT_URL = 'https://api.runtime.zynga.com:8994'
 BLOBRESTORE_API_PATH = 'api?action=get_vb_mapping'
 PADDING_ZEROS = 3
@@ -72,6 +79,7 @@ LOCAL_BACKUP_PATH = '/db_localbackup/'
 LOCAL_BACKUP_COUNT = 5
 DISKMAPPER_HOSTCONFIG = '/var/tmp/diskmapper_hostconfig'
 DEL_MANIFEST = 'manifest.del'
+CATALOG_FILE = 'catalog'
 PROMOTE_MANIFEST = '.promoting'
 CONNECT_RETRIES = 20
 PATH_MBFLUSHCTL = "/opt/zbase/lib/python/mbflushctl"
@@ -80,8 +88,22 @@ SS_API_PATH = 'api?action=get_ss_mapping&storage_server=%s'
 PATH_MBVBUCKET_CTL = '/opt/zbase/lib/python/mbvbucketctl'
 BACKUP_RETRIES = 10
 BACKUP_INTERVAL = 3600
+VBMAP_MAX_VBUCKETS = 65536
+VBMAP_MAX_SERVERS = 1024
+VBMAP_SERVER_LEN = 64
+VBMAP_PATH_LEN = 128
 LAST_CHECKPOINT_FILE = 'last_cpoint'
 SS_PORT = 22122
+FILE_SERVER_MODE = 'threaded'
+FILE_SERVER_BACKLOG = 128
+FILE_SERVER_WORKERS = 8
+FILE_SERVER_DM_CACHE_TTL = 300
+DOWNLOAD_STREAMS = 1
+RESTORE_APPLIER = 'mbadm-online-restore'
+RESTORE_DEDUP = True
+RESTORE_PARALLEL_VBUCKETS = 1
+CHECKSUM_SUFFIX = '.md5'
+SPLIT_META_SUFFIX = '.meta'
 RESTORE_CMD = "zbase-restore"
 RESTORE_CMD_ABS = "/opt/zbase/zbase-backup/zbase-restore"
 TAP_REGISTERATION = '/opt/zbase/zbase-backup/mbadm-tap-registration'
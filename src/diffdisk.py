@@ -16,10 +16,22 @@
 
 import os
 import sys
+import stat
+import time
+import fnmatch
+import marshal
 from util import getcommandoutput
 
+# Files tracked for copying to the secondary disk
+FILE_PATTERNS = ["*.mbb", "*.split", "manifest.del", "done", "complete", "done-*", "merged-*"]
+# Directories modified this close to a scan are listed again by the next
+# one, a change within the mtime granularity would not be noticed otherwise
+MTIME_SLACK = 2
+SNAPSHOT_HEADER = 'diffdisk snapshot 1\n'
+
 def list_files(dirname):
-    status, output = getcommandoutput('find %s -type f \( -name "*.mbb" -o -name "*.split" -o -name "manifest.del" -o -name "done" -o -name "complete" -o -name "done-*" -o -name "merged-*" \)' %dirname)
+    status, output = getcommandoutput('find %s -type f \( %s \)' %(dirname,
+                " -o ".join(map(lambda x: '-name "%s"' %x, FILE_PATTERNS))))
     if status == 0:
         return [ x for x in output.split('\n') if x != '']
     else:
@@ -46,24 +58,143 @@ def diff_list(l1, l2):
             l1.remove(f)
 
     new, removed = list(set(l2) - set(l1)), list(set(l1) - set(l2))
+    return order_new(new), removed
+
+def order_new(new):
+    """
+    New files in the order they are to be copied, backups before the
+    markers saying they are complete
+    """
     newlist = []
+    new = sorted(new)
     for ftype in [".mbb", ".split", "merged-", "done", "complete", "done-", "manifest.del"]:
-        for line in sorted(new[:]):
-            if ftype in line:
-                if ftype == "done" and not line.endswith("done"):
-                    continue
+        rest = []
+        for line in new:
+            if ftype in line and (ftype != "done" or line.endswith("done")):
                 newlist.append(line)
-                new.remove(line)
+            else:
+                rest.append(line)
+        new = rest
+
+    return newlist
+
+def is_tracked(name):
+    for pattern in FILE_PATTERNS:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+def list_dir(path):
+    """
+    Tracked files and subdirectories of a directory, as find would see them
+    """
+    files, subdirs = [], []
+    for name in os.listdir(path):
+        try:
+            mode = os.lstat(os.path.join(path, name)).st_mode
+        except OSError:
+            continue
+        if stat.S_ISDIR(mode):
+            subdirs.append(name)
+        elif stat.S_ISREG(mode) and is_tracked(name):
+            files.append(name)
+    return files, subdirs
+
+def read_snapshot(filename):
+    """
+    Directory snapshot of the last dirdiff, {path: [mtime, files, subdirs]}.
+    A manifest of an older version, the plain list of files, is returned
+    as a list.
+    """
+    if not os.path.exists(filename):
+        return {}
+    f = open(filename, 'rb')
+    try:
+        if f.read(len(SNAPSHOT_HEADER)) != SNAPSHOT_HEADER:
+            return read_list(filename)
+        return marshal.load(f)
+    finally:
+        f.close()
+
+def write_snapshot(filename, snapshot):
+    tmp_file = "%s.%d" %(filename, os.getpid())
+    f = open(tmp_file, 'wb')
+    f.write(SNAPSHOT_HEADER)
+    marshal.dump(snapshot, f)
+    f.close()
+    os.rename(tmp_file, filename)
+
+def scan(root, snapshot):
+    """
+    Walk root, listing only the directories modified since the snapshot
+    was taken. Adding, removing or renaming a file changes the mtime of its
+    directory; the others are taken from the snapshot. Returns the new
+    snapshot and the files added and removed.
+    """
+    start = time.time()
+    dirs = {}
+    new, removed = [], []
+    pending = [root]
+    while pending:
+        path = pending.pop()
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+
+        entry = snapshot.get(path)
+        if entry != None and entry[0] == st.st_mtime:
+            mtime, files, subdirs = entry
+        else:
+            try:
+                files, subdirs = list_dir(path)
+            except OSError:
+                continue
+            old_files = []
+            if entry != None:
+                old_files = entry[1]
+            new.extend(map(lambda x: os.path.join(path, x), set(files) - set(old_files)))
+            removed.extend(map(lambda x: os.path.join(path, x), set(old_files) - set(files)))
+            mtime = st.st_mtime
+            if mtime >= start - MTIME_SLACK:
+                mtime = None
+
+        dirs[path] = [mtime, files, subdirs]
+        pending.extend(map(lambda x: os.path.join(path, x), subdirs))
 
-    return newlist, removed
+    for path, (mtime, files, subdirs) in snapshot.items():
+        if not path in dirs:
+            removed.extend(map(lambda x: os.path.join(path, x), files))
+
+    return dirs, new, removed
 
 def dirdiff(basedir, dirname, manifest=".diffdata"):
-    dirty, deleted = set([]), set([])
-    curr_files = list_files(os.path.join(basedir, dirname))
-    recent_list = read_list(os.path.join(basedir, manifest))
-    dirty, deleted = diff_list(recent_list, curr_files)
-    write_list(os.path.join(basedir, manifest), curr_files)
+    """
+    Files added to and removed from basedir/dirname since the last call
+    """
+    root = os.path.join(basedir, dirname)
+    manifest_file = os.path.join(basedir, manifest)
+    snapshot = read_snapshot(manifest_file)
+
+    if isinstance(snapshot, list):
+        recent_list = snapshot
+        snapshot, new, removed = scan(root, {})
+        curr_files = []
+        for path, (mtime, files, subdirs) in snapshot.items():
+            curr_files.extend(map(lambda x: os.path.join(path, x), files))
+        dirty, deleted = diff_list(recent_list, curr_files)
+    else:
+        snapshot, new, removed = scan(root, snapshot)
+        # If a manifest.del appears, always add to list
+        for path, (mtime, files, subdirs) in snapshot.items():
+            if "manifest.del" in files and not os.path.join(path, "manifest.del") in new:
+                new.append(os.path.join(path, "manifest.del"))
+        dirty = order_new(new)
+        deleted = filter(lambda x: not "manifest.del" in x, removed)
 
+    write_snapshot(manifest_file, snapshot)
     return dirty, deleted
 
 if __name__ == '__main__':
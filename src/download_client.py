@@ -23,6 +23,8 @@ import socket
 from sendfile import sendfile
 import commands
 import string
+import hashlib
+import json
 
 #globals
 
@@ -37,17 +39,47 @@ ENOEXIST = "-1\r\nFile not found\r\n"
 INVALID_TYPE = "-1\r\nInvalid type\r\n"
 
 CRLF = "\r\n"
+RECV_BUFFER_SIZE = 1024 * 1024
+MIN_RANGE_SIZE = 64 * 1024 * 1024
+CHECKSUM_RETRIES = 2
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    f = open(path, "rb")
+    while True:
+        data = f.read(RECV_BUFFER_SIZE)
+        if data == '':
+            break
+        md5.update(data)
+    f.close()
+    return md5
 
 class download_client:
 
-    def __init__(self, host, port):
+    """
+    Client of the storage server file server
+
+    With keepalive the connection is kept open between requests, and
+    pipeline() sends several requests before reading their responses.
+    A connection the server closed while idle is reopened once.
+    """
+
+    def __init__(self, host, port, keepalive=False):
 
         self.server_address = (host, port)
+        self.keepalive = keepalive
         self.is_connected = False
+        self.sock = None
+        self.rbuf = ""
+        self.recv_buffer = None
+        self.digest = None
 
 
     def connect(self):
 
+        if self.is_connected:
+            return True
+
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect(self.server_address)
@@ -55,67 +87,180 @@ class download_client:
             print >> sys.stderr, "Cannot connect to" , self.server_address, str(e)
             return False
 
+        self.is_connected = True
+        self.rbuf = ""
         return True
 
-    def read_data(self):
-        expected = -1
-        received = 0
-        buffer = ""
+    def close(self):
 
-        try:
-            while True:
-                data = self.sock.recv(65535)
-                if len(data) == 0:
-                    # connection close
-                    return "Error"
-                if expected == -1:
-                    offset = string.index(data, "\r\n")
-                    resp_line = data[:offset]
-                    expected = int(resp_line)
-                    data = data[offset + len(CRLF):]
-
-                if expected == -1:
-                    return buffer
-
-                if expected == 0:
-                    return "Success"
-
-                received += len(data)
-                buffer += data
-
-                if received >= expected:
-                    break
-
-            if buffer[-2:] == CRLF:
-                buffer = buffer[:-2]
-            elif buffer[-1:] == CRLF:
-                buffer = buffer[:-1]
+        if self.sock != None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.is_connected = False
 
+    def recv_more(self):
+        data = self.sock.recv(65535)
+        if len(data) == 0:
+            raise EOFError
+        return data
+
+    def read_line(self):
+        while not CRLF in self.rbuf:
+            self.rbuf += self.recv_more()
+        line, self.rbuf = self.rbuf.split(CRLF, 1)
+        return line
+
+    def read_bytes(self, length):
+        chunks = [self.rbuf]
+        received = len(self.rbuf)
+        while received < length:
+            data = self.recv_more()
+            chunks.append(data)
+            received += len(data)
+
+        data = "".join(chunks)
+        self.rbuf = data[length:]
+        return data[:length]
+
+    def read_into(self, output, length):
+        """
+        Write length bytes of the response to the output file through a
+        reusable buffer, so memory use does not grow with the file size
+        """
+        pending = self.rbuf[:length]
+        self.rbuf = self.rbuf[length:]
+        output.write(pending)
+        if self.digest != None:
+            self.digest.update(pending)
+        remaining = length - len(pending)
+
+        if remaining > 0 and self.recv_buffer == None:
+            self.recv_buffer = bytearray(RECV_BUFFER_SIZE)
+
+        while remaining > 0:
+            # Never read past the payload, the next response may follow it
+            received = self.sock.recv_into(self.recv_buffer, min(remaining, RECV_BUFFER_SIZE))
+            if received == 0:
+                raise EOFError
+            data = buffer(self.recv_buffer, 0, received)
+            output.write(data)
+            if self.digest != None:
+                self.digest.update(data)
+            remaining -= received
+
+    def read_data(self, trailer=False, output=None):
+        """
+        Read one response. Returns the payload, "Success" for an empty
+        response, "" for an error response and "Error" if the connection
+        was closed. trailer is set for responses that end with CRLF after
+        the payload (DOWNLOAD, GETCHECKPOINT). With an output file the
+        payload is written to it and "Success" is returned.
+        """
+
+        try:
+            expected = int(self.read_line())
+            if expected == -1:
+                # error message
+                self.read_line()
+                return ""
+
+            if output != None:
+                self.read_into(output, expected)
+                buffer = "Success"
+            else:
+                buffer = self.read_bytes(expected)
+
+            if trailer:
+                self.read_bytes(len(CRLF))
+
+            if expected == 0:
+                return "Success"
+
+        except EOFError:
+            self.close()
+            return "Error"
         except Exception, e:
             errormsg = "error receiving data " + str(e)
-            buffer = ""
             print(errormsg)
+            self.close()
+            return ""
 
         return buffer
 
-    def list(self, vb_id, extra=None):
+    def request(self, send_cmd, trailer=False, output=None, digest=None):
+        """
+        Send a command and read its response, None if connect failed
+        With a digest, the payload written to output is added to a copy of
+        it that is left in self.digest
+        """
 
-        status = self.connect()
-        if status == False:
-            return -1
+        if output != None:
+            start = output.tell()
 
-        if extra != None:
-            send_cmd = "LIST " + str(vb_id) + " " + extra
-        else:
-            send_cmd = "LIST " + str(vb_id)
+        for attempt in range(2):
+            reused = self.is_connected
+            if self.connect() == False:
+                return None
+
+            if output != None and attempt > 0:
+                output.seek(start)
+            self.digest = None
+            if digest != None:
+                self.digest = digest.copy()
+
+            try:
+                self.sock.sendall(send_cmd + CRLF)
+            except Exception, e:
+                print >> sys.stderr, "exception occured", str(e)
+
+            buffer = self.read_data(trailer, output)
+            if not self.keepalive:
+                self.close()
+
+            # An idle kept alive connection may have been closed by the server
+            if buffer != "Error" or not reused:
+                break
+
+        return buffer
+
+    def pipeline(self, requests):
+        """
+        Send several commands at once and return their responses in order
+        requests is a list of (command, trailer), see read_data
+        """
+
+        if self.connect() == False:
+            return None
 
         try:
-            self.sock.sendall(send_cmd)
+            self.sock.sendall("".join([cmd + CRLF for cmd, trailer in requests]))
         except Exception, e:
             print >> sys.stderr, "exception occured", str(e)
 
-        buffer = self.read_data()
-        self.sock.close()
+        responses = []
+        for cmd, trailer in requests:
+            if self.is_connected:
+                responses.append(self.read_data(trailer))
+            else:
+                responses.append("Error")
+
+        if not self.keepalive:
+            self.close()
+        return responses
+
+    def list(self, vb_id, extra=None):
+
+        if extra != None:
+            send_cmd = "LIST " + str(vb_id) + " " + extra
+        else:
+            send_cmd = "LIST " + str(vb_id)
+
+        buffer = self.request(send_cmd)
+        if buffer == None:
+            return -1
         if "Error" in buffer:
             return -1, None
         elif "Success" in buffer:
@@ -125,19 +270,11 @@ class download_client:
 
     def remove(self, vb_id, extra):
 
-        status = self.connect()
-        if status == False:
-            return -1
-
         send_cmd = "REMOVE " + str(vb_id) + " " + extra
 
-        try:
-            self.sock.sendall(send_cmd)
-        except Exception, e:
-            print >> sys.stderr, "exception occured", str(e)
-
-        buffer = self.read_data()
-        self.sock.close()
+        buffer = self.request(send_cmd)
+        if buffer == None:
+            return -1
         if "Success" in buffer:
             return True
         else:
@@ -145,19 +282,11 @@ class download_client:
 
     def add_lock(self, vb_id, extra):
 
-        status = self.connect()
-        if status == False:
-            return -1
-
         send_cmd = "ADDLOCK " + str(vb_id) + " " + extra
 
-        try:
-            self.sock.sendall(send_cmd)
-        except Exception, e:
-            print >> sys.stderr, "exception occured", str(e)
-
-        buffer = self.read_data()
-        self.sock.close()
+        buffer = self.request(send_cmd)
+        if buffer == None:
+            return -1
         if "Success" in buffer:
             return True
         else:
@@ -165,19 +294,11 @@ class download_client:
 
     def pause_coalescer(self, vb_id):
 
-        status = self.connect()
-        if status == False:
-            return -1
-
         send_cmd = "PAUSECOALESCER " + str(vb_id) + " "
 
-        try:
-            self.sock.sendall(send_cmd)
-        except Exception, e:
-            print >> sys.stderr, "exception occured", str(e)
-
-        buffer = self.read_data()
-        self.sock.close()
+        buffer = self.request(send_cmd)
+        if buffer == None:
+            return -1
         if "Success" in buffer:
             return True
         else:
@@ -185,77 +306,221 @@ class download_client:
 
     def resume_coalescer(self, vb_id):
 
-        status = self.connect()
-        if status == False:
-            return -1
-
         send_cmd = "RESUMECOALESCER " + str(vb_id) + " "
 
-        try:
-            self.sock.sendall(send_cmd)
-        except Exception, e:
-            print >> sys.stderr, "exception occured", str(e)
-
-        buffer = self.read_data()
-        self.sock.close()
+        buffer = self.request(send_cmd)
+        if buffer == None:
+            return -1
         if "Success" in buffer:
             return True
         else:
             return False
 
-    def download(self, vb_id, filename, output_file=None):
+    def download(self, vb_id, filename, output_file=None, resume=False, offset=0, length=None, verify=True):
+        """
+        Download a file, or length bytes of it from offset
+        With resume, an existing output file is completed from its size.
+        A whole file is checked against the checksum of the server, when it
+        has one, and downloaded again at once if it does not match.
+        """
 
-        status = self.connect()
-        if status == False:
-            return -1, None
+        checksum = None
+        if verify and offset == 0 and length == None:
+            checksum = self.get_checksum(vb_id, filename)
+
+        for attempt in range(CHECKSUM_RETRIES):
+            status, buffer, digest = self._download(vb_id, filename, output_file, resume,
+                    offset, length, checksum != None)
+            if status != 0 or checksum == None or digest == checksum:
+                return status, buffer
+
+            print >> sys.stderr, "checksum mismatch for %s (%s, expected %s)" %(filename, digest, checksum)
+            # The part kept by a resume may be the corrupt one
+            resume = False
+
+        if output_file != None and os.path.exists(output_file):
+            os.unlink(output_file)
+        return -1, None
+
+    def _download(self, vb_id, filename, output_file, resume, offset, length, verify):
 
         send_cmd = "DOWNLOAD " + str(vb_id) + " " + filename
+        digest = None
+
+        if output_file == None:
+            if offset > 0 or length != None:
+                send_cmd += " %d" %offset
+            if length != None:
+                send_cmd += " %d" %length
+            buffer = self.request(send_cmd, True)
+            if buffer == None or len(buffer) == 0:
+                return -1, None, None
+            if verify:
+                digest = hashlib.md5(buffer).hexdigest()
+            return 0, buffer, digest
+
+        if verify:
+            digest = hashlib.md5()
 
         try:
-            self.sock.sendall(send_cmd)
+            if resume and os.path.exists(output_file):
+                output = open(output_file, "r+b")
+                if verify:
+                    digest = file_md5(output_file)
+                output.seek(0, 2)
+                offset = output.tell()
+            elif offset > 0 or length != None:
+                # A range of the file, written at the same offset
+                output = open(output_file, "r+b")
+                output.seek(offset)
+            else:
+                output = open(output_file, "wb")
         except Exception, e:
-            print >> sys.stderr, "exception occured", str(e)
+            print ("failed to write", str(e))
+            return -1, None, None
 
-        buffer = self.read_data()
-        self.sock.close()
+        if offset > 0 or length != None:
+            send_cmd += " %d" %offset
+        if length != None:
+            send_cmd += " %d" %length
 
-        if len(buffer) > 0 and output_file != None:
-            try:
-                file = open(output_file, "w+")
-                file.write(buffer)
-                file.close()
-            except Exception, e:
-                print ("failed to write", str(e))
-        else:
-            return -1, None
+        try:
+            buffer = self.request(send_cmd, True, output, digest)
+            if buffer == "" and offset > 0 and resume:
+                # Server without ranges, or the file changed, start over
+                output.seek(0)
+                output.truncate()
+                if verify:
+                    digest = hashlib.md5()
+                buffer = self.request("DOWNLOAD " + str(vb_id) + " " + filename, True, output, digest)
+            received = output.tell() - offset
+        finally:
+            output.close()
+
+        if buffer != "Success" or (length != None and received != length):
+            return -1, None, None
+
+        if verify:
+            digest = self.digest.hexdigest()
 
         #if the output file is specified then dont return the buffer
-        if output_file != None and os.path.getsize(output_file) > 0:
-            return 0, "download successful"
+        if os.path.getsize(output_file) > 0:
+            return 0, "download successful", digest
         else:
-            return 0, buffer
+            return -1, None, None
 
-    def get_checkpoint(self, vb_id):
+    def get_checksum(self, vb_id, filename):
+        """
+        md5 of a file on the server, None if the server cannot tell
+        """
+
+        buffer = self.request("CHECKSUM " + str(vb_id) + " " + filename)
+        if buffer in (None, "", "Error", "Success"):
+            return None
+        return buffer
+
+    def get_catalog(self, vb_id):
+        """
+        Restore plan of a vbucket, {'incremental': files, 'periodic': files,
+        'master': files} with files as [path, size, first checkpoint, last
+        checkpoint] newest first. None if the server has no catalog.
+        """
+
+        buffer = self.request("CATALOG " + str(vb_id))
+        if buffer in (None, "", "Error", "Success"):
+            return None
+        try:
+            return json.loads(buffer)
+        except ValueError:
+            return None
 
-        status = self.connect()
-        if status == False:
+    def get_filesize(self, vb_id, filename):
+
+        buffer = self.request("FILESIZE " + str(vb_id) + " " + filename)
+        try:
+            return int(buffer)
+        except (TypeError, ValueError):
+            return -1
+
+    def download_ranges(self, vb_id, filename, output_file, streams, min_range_size=MIN_RANGE_SIZE):
+        """
+        Download a file as streams byte ranges over separate connections
+        Files smaller than two ranges are downloaded in one piece. The
+        assembled file is checked against the checksum of the server.
+        """
+
+        size = self.get_filesize(vb_id, filename)
+        if size < 0:
             return -1, None
 
-        send_cmd = "GETCHECKPOINT " + str(vb_id)
+        streams = max(1, min(streams, size / min_range_size))
+        if streams == 1:
+            return self.download(vb_id, filename, output_file)
+
+        checksum = self.get_checksum(vb_id, filename)
 
         try:
-            self.sock.sendall(send_cmd)
+            output = open(output_file, "wb")
+            output.truncate(size)
+            output.close()
         except Exception, e:
-            print >> sys.stderr, "exception occured", str(e)
+            print ("failed to write", str(e))
+            return -1, None
+
+        range_size = (size + streams - 1) / streams
+        results = []
+        lock = threading.Lock()
+
+        def download_range(offset, length):
+            client = download_client(self.server_address[0], self.server_address[1])
+            status, msg = client.download(vb_id, filename, output_file, offset=offset, length=length,
+                    verify=False)
+            lock.acquire()
+            results.append(status)
+            lock.release()
+
+        threads = []
+        for offset in range(0, size, range_size):
+            t = threading.Thread(target=download_range, args=(offset, min(range_size, size - offset)))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        if len(results) != len(threads) or -1 in results or os.path.getsize(output_file) != size:
+            return -1, None
+
+        if checksum != None and file_md5(output_file).hexdigest() != checksum:
+            print >> sys.stderr, "checksum mismatch for %s, downloading it in one piece" %filename
+            return self.download(vb_id, filename, output_file)
+
+        return 0, "download successful"
 
-        buffer = self.read_data()
-        self.sock.close()
+    def get_checkpoint(self, vb_id):
+
+        buffer = self.request("GETCHECKPOINT " + str(vb_id), True)
+        if buffer == None:
+            return -1, None
 
         if len(buffer) > 0:
             return 0, buffer
         else:
             return -1, None
 
+    def get_checkpoints(self, vb_list):
+        """
+        Pipelined GETCHECKPOINT for several vbuckets, returns {vb_id: checkpoint or None}
+        """
+
+        responses = self.pipeline([("GETCHECKPOINT " + str(vb_id), True) for vb_id in vb_list])
+        checkpoints = {}
+        for i in range(len(vb_list)):
+            checkpoints[vb_list[i]] = None
+            if responses != None and responses[i] not in ("", "Error"):
+                checkpoints[vb_list[i]] = responses[i]
+
+        return checkpoints
+
 if __name__ == '__main__':
 
     download_instance = download_client("172.21.13.73", 22122)
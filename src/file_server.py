@@ -18,13 +18,20 @@ import sys, os
 import thread, threading
 from logger import Logger
 from time import sleep
+import time
 import pdb
 import socket
+import select
+import errno
+import fcntl
+import collections
+import Queue
 from sendfile import sendfile
 import commands
 import json
 import consts
 import util
+from catalog import Catalog
 #from util import pause_coalscer, resume_coalescer
 
 #globals
@@ -40,14 +47,277 @@ ENOEXIST = "-1\r\nFile not found\r\n"
 INVALID_TYPE = "-1\r\nInvalid type\r\n"
 INTERROR = "-1\r\nInternal Error\r\n"
 ISDIR = "-1\r\nRequested download is a directory\r\n"
+INVALID_RANGE = "-1\r\nInvalid range\r\n"
+NOCHECKSUM = "-1\r\nChecksum not available\r\n"
+
+CRLF = "\r\n"
+# Bytes of a file sent to a connection before the event loop moves on to
+# the next ready one
+SEND_CHUNK_SIZE = 1024 * 1024
+
+
+def split_commands(pending, data):
+    """
+    Split data received on a connection into complete commands and the
+    unterminated rest. Clients keeping a connection open terminate each
+    command with CRLF and may send several at once; data without a CRLF on
+    an idle connection is a single command from an older client.
+    """
+    data = pending + data
+    if pending == '' and not CRLF in data:
+        return [data.rstrip()], ''
+
+    lines = data.split(CRLF)
+    return [l.strip() for l in lines[:-1] if l.strip() != ''], lines[-1]
+
+
+class TransferError(Exception):
+    pass
+
+
+class EventConnection:
+    """
+    Connection of the event mode. Workers handling its requests queue the
+    responses with send() and send_file(), and the event loop writes them
+    with flush() without blocking.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        # unterminated command received so far
+        self.pending = ''
+        # strings and [fd, offset, count] of files to send
+        self.output = collections.deque()
+        self.closing = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        if len(data):
+            self.output.append(data)
+        return len(data)
+
+    def send_file(self, file, offset, count):
+        # the handler closes its file once the response is queued
+        if count > 0:
+            self.output.append([os.dup(file.fileno()), offset, count])
+        return count
+
+    def has_output(self):
+        return len(self.output) > 0
+
+    def flush(self):
+        """
+        Write the queued output until the socket is full or SEND_CHUNK_SIZE
+        bytes of a file have been sent. Returns True once all is written.
+        """
+        file_sent = 0
+        while len(self.output):
+            item = self.output[0]
+            try:
+                if not isinstance(item, list):
+                    n = self.sock.send(item)
+                    if n < len(item):
+                        self.output[0] = item[n:]
+                        return False
+                    self.output.popleft()
+                else:
+                    if file_sent >= SEND_CHUNK_SIZE:
+                        return False
+                    fd, offset, count = item
+                    n = sendfile(self.sock.fileno(), fd, offset, min(count, SEND_CHUNK_SIZE))
+                    if n == 0:
+                        raise TransferError("File truncated while sending")
+                    file_sent += n
+                    item[1] += n
+                    item[2] -= n
+                    if item[2] == 0:
+                        os.close(fd)
+                        self.output.popleft()
+            except (socket.error, OSError), e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+
+        return True
+
+    def close(self):
+        for item in self.output:
+            if isinstance(item, list):
+                os.close(item[0])
+        self.output.clear()
+        self.sock.close()
+
+
+class DiskMapperCache:
+    """
+    vbucket to disk mapping of the disk mapper
+
+    The mapping of all the vbuckets of this storage server is fetched in one
+    get_ss_mapping call and kept for ttl seconds. A vbucket missing from it
+    is looked up with get_vb_mapping and cached until the next refresh.
+    A ttl of 0 disables caching.
+    """
+
+    def __init__(self, disk_mapper, ttl, logger):
+        self.disk_mapper = disk_mapper
+        self.ttl = ttl
+        self.logger = logger
+        self.ip_address = socket.gethostbyname(socket.gethostname())
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.expires = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def fetch(self, url):
+        query_cmd = "curl -s \"%s\"" %url
+        status, output = commands.getstatusoutput(query_cmd)
+
+        if status > 0:
+            print "Failed to execute command %s. Output %s" %(query_cmd, output)
+            return None
+
+        try:
+            return json.loads(output)
+        except Exception, e:
+            print >> sys.stderr, " Could not json parse output", str(e)
+            return None
+
+    def fetch_vb_mapping(self, vb_id):
+        return self.fetch("http://" + self.disk_mapper + "/api?action=get_vb_mapping&&vbucket=vb_" + vb_id)
+
+    def refresh(self):
+        """
+        Reload the mapping of all the vbuckets of this storage server
+        """
+        response = self.fetch("http://%s/%s" %(self.disk_mapper, consts.SS_API_PATH %self.ip_address))
+        entries = {}
+        if response != None:
+            try:
+                for key, conf in response.items():
+                    vb_id = key.split('_')[-1]
+                    vb_group = conf.get('vb_group')
+                    if vb_group == None:
+                        vb_group = conf['path_name'].rstrip('/').split('/')[-2]
+                    entries[vb_id] = {'disk': conf['disk'], 'type': conf['type'], 'vb_group': vb_group}
+            except Exception, e:
+                self.logger.log("Failure: Unable to parse disk mapping (%s)" %str(e))
+                entries = {}
+
+        self.lock.acquire()
+        self.entries = entries
+        self.expires = time.time() + self.ttl
+        self.refreshes += 1
+        self.lock.release()
+        self.logger.log("Info: Disk mapping cache loaded with %d vbuckets" %len(entries))
+
+    def get(self, vb_id):
+        if self.ttl == 0:
+            return self.fetch_vb_mapping(vb_id)
+
+        self.lock.acquire()
+        expired = time.time() >= self.expires
+        if expired:
+            # Let other requests use the old entries until the refresh is done
+            self.expires = time.time() + self.ttl
+        self.lock.release()
+        if expired:
+            self.refresh()
+
+        self.lock.acquire()
+        response = self.entries.get(vb_id)
+        if response != None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.lock.release()
+
+        if response == None:
+            response = self.fetch_vb_mapping(vb_id)
+            if response != None:
+                self.lock.acquire()
+                self.entries[vb_id] = response
+                self.lock.release()
+
+        return response
+
+    def invalidate(self, vb_id=None):
+        """
+        Drop the mapping of a vbucket, or of all vbuckets and reload them
+        with the next request
+        """
+        self.lock.acquire()
+        if vb_id == None:
+            self.entries = {}
+            self.expires = 0
+        elif vb_id in self.entries:
+            del self.entries[vb_id]
+        self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        stats = {'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes,
+                'vbuckets': len(self.entries), 'ttl': self.ttl}
+        self.lock.release()
+        return stats
+
+
+class ChecksumWorker:
+    """
+    Thread computing the missing checksum sidecars of the files that were
+    asked for, one at a time
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        worker = threading.Thread(target=self.run)
+        worker.setDaemon(True)
+        worker.start()
+
+    def add(self, file_path):
+        self.lock.acquire()
+        try:
+            if file_path in self.pending:
+                return
+            self.pending.add(file_path)
+        finally:
+            self.lock.release()
+        self.queue.put(file_path)
+
+    def run(self):
+        while True:
+            file_path = self.queue.get()
+            try:
+                if util.read_checksum(file_path) == None:
+                    util.write_checksum(file_path)
+            except (IOError, OSError), e:
+                self.logger.log("Failure: Unable to save checksum of %s (%s)" %(file_path, str(e)))
+            self.lock.acquire()
+            self.pending.discard(file_path)
+            self.lock.release()
 
 
 class FileServer:
 
-    def __init__(self, disk_mapper, host=None, port=None):
+    THREADED = "threaded"
+    EVENT = "event"
+
+    def __init__(self, disk_mapper, host=None, port=None, mode=THREADED,
+            backlog=consts.FILE_SERVER_BACKLOG, workers=consts.FILE_SERVER_WORKERS,
+            dm_cache_ttl=consts.FILE_SERVER_DM_CACHE_TTL):
 
 
         self.disk_mapper = disk_mapper
+        self.mode = mode
+        self.backlog = backlog
+        self.workers = workers
 
         if host != None:
             self.host = host
@@ -65,9 +335,12 @@ class FileServer:
         self.sock.bind(server_address)
         self.logger = Logger("RestoreDaemon", "INFO")
         self.logger.log("Info: ===== Starting restore daemon ====== ")
+        self.dm_cache = DiskMapperCache(disk_mapper, dm_cache_ttl, self.logger)
+        self.checksums = ChecksumWorker(self.logger)
 
     def request_thread(self, connection, client_address):
 
+        pending = ''
         while 1:
             data = connection.recv(4096)
             if data == '':
@@ -75,34 +348,23 @@ class FileServer:
                 connection.close()
                 return
 
-            data = data.rstrip()
-            try:
-                response_len = self.handle_cmd(connection, data)
-            except Exception, e:
-                connection.send("-1\r\n" + str(e) + "\r\n")
-                continue
+            requests, pending = split_commands(pending, data)
+            for request in requests:
+                try:
+                    response_len = self.handle_cmd(connection, request)
+                except Exception, e:
+                    connection.send("-1\r\n" + str(e) + "\r\n")
+                    continue
 
-            if response_len == -1:
-                connection.close()
-                return
+                if response_len == -1:
+                    connection.close()
+                    return
 
 
     def query_dm(self, vb_id):
 
         #query the disk_mapper and get the disk path
-        vb_query_cmd = "curl -s \"http://" + self.disk_mapper + "/api?action=get_vb_mapping&&vbucket=vb_" + vb_id + "\""
-        status, output = commands.getstatusoutput(vb_query_cmd)
-
-        if status > 0:
-            print "Failed to execute command %s. Output %s" %(vb_query_cmd, output)
-            return None
-
-        try:
-            response = json.loads(output)
-            return response
-        except Exception, e:
-            print >> sys.stderr, " Could not json parse output", str(e)
-            return None
+        return self.dm_cache.get(vb_id)
 
     def get_disk_path(self, vb_id):
 
@@ -114,6 +376,14 @@ class FileServer:
             return None
 
         disk_path = "/"+ response["disk"] + "/" + response["type"] + "/" + response["vb_group"] + "/" + "vb_" + vb_id + "/"
+        if not os.path.isdir(disk_path):
+            # The vbucket may have moved since it was cached
+            self.dm_cache.invalidate(vb_id)
+            response = self.query_dm(vb_id)
+            if response == None:
+                return None
+            disk_path = "/"+ response["disk"] + "/" + response["type"] + "/" + response["vb_group"] + "/" + "vb_" + vb_id + "/"
+
         return disk_path
 
     def get_disk_basepath(self, vb_id):
@@ -131,24 +401,186 @@ class FileServer:
 
     def start(self):
 
-        self.sock.listen(1)
+        self.sock.listen(self.backlog)
+
+        if self.mode == FileServer.EVENT:
+            return self.start_event_loop()
 
         while True:
             connection, client_address = self.sock.accept()
             print >>sys.stderr, 'connection from', client_address
             thread.start_new_thread(self.request_thread, (connection, client_address))
 
+    def start_event_loop(self):
+        """
+        Serve all the connections from one epoll loop. Requests are handed
+        to a small pool of worker threads, which queue their responses on
+        the connection (EventConnection). The loop writes the responses to
+        the non-blocking sockets, files with sendfile a chunk at a time, so
+        a transfer holds no thread and a slow client holds nothing but its
+        connection. A connection is armed with EPOLLONESHOT for one request
+        or one chunk at a time.
+        """
+
+        self.epoll = select.epoll()
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        self.ready_queue = Queue.Queue()
+        self.done_queue = Queue.Queue()
+        # Workers wake the loop up through a pipe once a response is queued
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        fcntl.fcntl(self.wakeup_r, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.event_worker)
+            worker.setDaemon(True)
+            worker.start()
+
+        self.sock.setblocking(0)
+        self.epoll.register(self.sock.fileno(), select.EPOLLIN)
+        self.epoll.register(self.wakeup_r, select.EPOLLIN)
+        self.logger.log("Info: Serving requests with %d workers, backlog %d" %(self.workers, self.backlog))
+
+        while True:
+            try:
+                events = self.epoll.poll()
+            except IOError, e:
+                # Interrupted by a signal
+                continue
+
+            for fd, event in events:
+                if fd == self.sock.fileno():
+                    self.accept_connections()
+                elif fd == self.wakeup_r:
+                    self.write_responses()
+                elif event & (select.EPOLLERR | select.EPOLLHUP):
+                    self.close_connection(fd)
+                elif self.connections[fd].has_output():
+                    self.write_connection(fd)
+                else:
+                    self.read_connection(fd)
+
+    def accept_connections(self):
+
+        while True:
+            try:
+                connection, client_address = self.sock.accept()
+            except socket.error, e:
+                return
+
+            connection.setblocking(0)
+            self.connections_lock.acquire()
+            self.connections[connection.fileno()] = EventConnection(connection, client_address)
+            self.connections_lock.release()
+            self.epoll.register(connection.fileno(), select.EPOLLIN | select.EPOLLONESHOT)
+
+    def close_connection(self, fd):
+
+        self.connections_lock.acquire()
+        connection = self.connections.pop(fd)
+        self.connections_lock.release()
+        try:
+            self.epoll.unregister(fd)
+        except IOError:
+            pass
+        connection.close()
+
+    def read_connection(self, fd):
+
+        connection = self.connections[fd]
+        try:
+            data = connection.sock.recv(4096)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.epoll.modify(fd, select.EPOLLIN | select.EPOLLONESHOT)
+                return
+            data = ''
+
+        if data == '':
+            self.close_connection(fd)
+            return
+
+        requests, connection.pending = split_commands(connection.pending, data)
+        if len(requests):
+            self.ready_queue.put((fd, requests))
+        else:
+            self.epoll.modify(fd, select.EPOLLIN | select.EPOLLONESHOT)
+
+    def write_connection(self, fd):
+
+        connection = self.connections[fd]
+        try:
+            done = connection.flush()
+        except (socket.error, OSError, IOError, TransferError), e:
+            self.logger.log("Failure: Sending to %s failed (%s)" %(str(connection.address), str(e)))
+            self.close_connection(fd)
+            return
+
+        if not done:
+            self.epoll.modify(fd, select.EPOLLOUT | select.EPOLLONESHOT)
+        elif connection.closing:
+            self.close_connection(fd)
+        else:
+            self.epoll.modify(fd, select.EPOLLIN | select.EPOLLONESHOT)
+
+    def write_responses(self):
+
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError:
+            pass
+
+        while True:
+            try:
+                fd = self.done_queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.write_connection(fd)
+
+    def event_worker(self):
+
+        while True:
+            fd, requests = self.ready_queue.get()
+            self.connections_lock.acquire()
+            connection = self.connections[fd]
+            self.connections_lock.release()
+
+            for request in requests:
+                try:
+                    response_len = self.handle_cmd(connection, request)
+                except Exception, e:
+                    connection.send("-1\r\n" + str(e) + "\r\n")
+                    response_len = 0
+
+                if response_len == -1:
+                    connection.closing = True
+                    break
 
+            self.done_queue.put(fd)
+            os.write(self.wakeup_w, 'x')
 
-    #LIST vb_id filename
+
+    #DOWNLOAD vb_id filename [offset [length]]
     def handle_download(self, connection=None, data=None, checkpoint_only=False):
 
         data = data.split()
+        offset = 0
+        length = None
 
         if checkpoint_only == False:
-            if len(data) != 3:
+            if len(data) < 3 or len(data) > 5:
                 return connection.send(INVALID_SYNTAX)
             filename = data[2]
+            try:
+                if len(data) > 3:
+                    offset = int(data[3])
+                if len(data) > 4:
+                    length = int(data[4])
+            except ValueError:
+                return connection.send(INVALID_SYNTAX)
+            if offset < 0 or (length != None and length < 0):
+                return connection.send(INVALID_SYNTAX)
         else:
             if len(data) != 2:
                 return connection.send(INVALID_SYNTAX)
@@ -176,14 +608,114 @@ class FileServer:
         print ("info sending file %s" %file_path)
         file = open(file_path, "rb")
         size = os.stat(file_path).st_size
-        response_line = str(size) + '\r\n'
+        if offset > size:
+            file.close()
+            return connection.send(INVALID_RANGE)
+
+        count = size - offset
+        if length != None:
+            count = min(count, length)
+
+        response_line = str(count) + '\r\n'
         sent = connection.send(response_line)
-        sent += sendfile(connection.fileno(), file.fileno(), 0, size)
+        sent += self.send_file(connection, file, offset, count)
         sent += connection.send('\r\n')
         file.close()
 
         return sent
 
+    def send_file(self, connection, file, offset, count):
+
+        if self.mode == FileServer.EVENT:
+            # sent by the event loop
+            return connection.send_file(file, offset, count)
+
+        # sendfile sends at most 2GB per call
+        sent = 0
+        while sent < count:
+            n = sendfile(connection.fileno(), file.fileno(), offset + sent, count - sent)
+            if n == 0:
+                raise Exception("File truncated while sending")
+            sent += n
+
+        return sent
+
+    #FILESIZE vb_id filename
+    def handle_filesize(self, connection=None, data=None):
+
+        data = data.split()
+        if len(data) != 3:
+            return connection.send(INVALID_SYNTAX)
+
+        vb_id = str(data[1]).zfill(2)
+        filename = data[2]
+
+        base_path = self.get_disk_path(vb_id)
+        if base_path == None:
+            return connection.send(INTERROR)
+
+        file_path = base_path + filename
+        if os.path.isfile(file_path) == False:
+            return connection.send(ENOEXIST)
+
+        return self.send_data(connection, str(os.stat(file_path).st_size))
+
+    def get_checksum(self, file_path):
+        """
+        md5 of a file from the sidecar written along with it, None if it has
+        none yet. The md5 of such a file is computed in the background
+        instead of reading it in a request worker.
+        """
+
+        digest = util.read_checksum(file_path)
+        if digest == None:
+            self.checksums.add(file_path)
+        return digest
+
+    #CHECKSUM vb_id filename
+    def handle_checksum(self, connection=None, data=None):
+
+        data = data.split()
+        if len(data) != 3:
+            return connection.send(INVALID_SYNTAX)
+
+        vb_id = str(data[1]).zfill(2)
+        filename = data[2]
+
+        base_path = self.get_disk_path(vb_id)
+        if base_path == None:
+            return connection.send(INTERROR)
+
+        file_path = base_path + filename
+        if os.path.isfile(file_path) == False:
+            return connection.send(ENOEXIST)
+
+        digest = self.get_checksum(file_path)
+        if digest == None:
+            return connection.send(NOCHECKSUM)
+
+        return self.send_data(connection, digest)
+
+    #CATALOG vb_id
+    def handle_catalog(self, connection=None, data=None):
+
+        data = data.split()
+        if len(data) != 2:
+            return connection.send(INVALID_SYNTAX)
+
+        vb_id = str(data[1]).zfill(2)
+        base_path = self.get_disk_path(vb_id)
+        if base_path == None:
+            return connection.send(INTERROR)
+
+        try:
+            plan = Catalog(base_path, self.logger).plan()
+        except Exception, e:
+            self.logger.log("Failure: Unable to build restore plan of %s (%s)" %(base_path, str(e)))
+            return connection.send("-1\r\n" + str(e) + "\r\n")
+
+        return self.send_data(connection, json.dumps(plan))
+
     def handle_lock(self, connection=None, data=None):
 
         data = data.split()
@@ -295,6 +827,32 @@ class FileServer:
         return return_len
 
 
+    #CACHESTATS
+    def handle_cache_stats(self, connection=None, data=None):
+
+        stats = self.dm_cache.stats()
+        formatted_output = ""
+        for name in sorted(stats.keys()):
+            formatted_output += "%s %s\r\n" %(name, stats[name])
+
+        return self.send_data(connection, formatted_output)
+
+    #INVALIDATE [vb_id]
+    def handle_invalidate(self, connection=None, data=None):
+
+        data = data.split()
+        if len(data) == 1:
+            self.dm_cache.invalidate()
+        elif len(data) == 2:
+            vb_id = data[1].lstrip('0')
+            if vb_id == "":
+                vb_id = '0'
+            self.dm_cache.invalidate(vb_id)
+        else:
+            return connection.send(INVALID_SYNTAX)
+
+        return connection.send("0\r\n")
+
     def handle_remove(self, connection=None, data=None):
 
         data = data.split()
@@ -313,7 +871,7 @@ class FileServer:
         if os.path.exists(file_path) == False:
             return connection.send(ENOEXIST)
 
-        delete_cmd = "rm -f " + file_path
+        delete_cmd = "rm -f " + file_path + " " + file_path + consts.CHECKSUM_SUFFIX + " " + file_path + consts.SPLIT_META_SUFFIX
         print ("Executing command %s" %delete_cmd)
 
         status,output = commands.getstatusoutput(delete_cmd)
@@ -336,6 +894,12 @@ class FileServer:
             return self.handle_remove(connection, data)
         elif "DOWNLOAD" in data:
             return self.handle_download(connection, data)
+        elif "FILESIZE" in data:
+            return self.handle_filesize(connection, data)
+        elif "CHECKSUM" in data:
+            return self.handle_checksum(connection, data)
+        elif "CATALOG" in data:
+            return self.handle_catalog(connection, data)
         elif "ADDLOCK" in data:
             return self.handle_lock(connection, data)
         elif "GETCHECKPOINT" in data:
@@ -344,19 +908,27 @@ class FileServer:
             return self.handle_pause(connection, data)
         elif "RESUMECOALESCER" in data:
             return self.handle_resume(connection, data)
+        elif "CACHESTATS" in data:
+            return self.handle_cache_stats(connection, data)
+        elif "INVALIDATE" in data:
+            return self.handle_invalidate(connection, data)
         else:
             return connection.send(INVALID_COMMAND)
 
 
 if __name__ == '__main__':
 
-    if len(sys.argv) != 2:
-        print ("Usage file_server.py disk_mapper")
+    if len(sys.argv) != 2 and len(sys.argv) != 3:
+        print ("Usage file_server.py disk_mapper [threaded|event]")
         sys.exit(1)
     else:
         disk_mapper = sys.argv[1]
 
-    server_instance = FileServer(disk_mapper, "0.0.0.0", 22122)
+    mode = FileServer.THREADED
+    if len(sys.argv) == 3:
+        mode = sys.argv[2]
+
+    server_instance = FileServer(disk_mapper, "0.0.0.0", 22122, mode)
     server_instance.start()
 
 
@@ -26,15 +26,13 @@ import socket
 import commands
 import util
 from util import getcommandoutput
+from vbmap import VBucketMap
 
 #globals
 
 doneEvent = threading.Event()
 doneEvent.clear()
 
-mapLock = threading.Lock()
-currentVbsMap = {}
-
 class InitBackupDaemon:
 
     """
@@ -43,6 +41,8 @@ class InitBackupDaemon:
         to this server
         2. initialize connection to the VBS and maintain an updated mapping of
         vbuckets to the server
+        The mapping is kept in a VBucketMap, shared with the backup processes
+        forked after it.
 
     """
 
@@ -59,7 +59,8 @@ class InitBackupDaemon:
         """
 
         self.logger = Logger("vBucketBackupd", "INFO")
-        v_thread = vbs_thread(vbs_host, self.logger)
+        self.vbmap = VBucketMap()
+        v_thread = vbs_thread(vbs_host, self.logger, self.vbmap)
         v_thread.start()
 
         # wait till the vbs array has been populated before returning
@@ -124,21 +125,28 @@ class InitBackupDaemon:
             self.logger.log(" Fatal: Failed to get disk mapping ")
             return None
 
+        try:
+            changed = self.vbmap.update_paths(dm_map)
+        except ValueError, e:
+            self.logger.log(" Fatal: Failed to update disk paths of the vbucket map (%s)" %str(e))
+            return None
+        if changed > 0:
+            self.logger.log("Info: %d vbucket disk paths changed, vbucket map version %d"
+                    %(changed, self.vbmap.get_version()))
+
         vb_disk_map = []
-        mapLock.acquire()
+        vb_servers = self.vbmap.get_servers()
 
         for vb_id in dm_map.keys():
-            global currentVbsMap
             try:
                 vb_record = {}
                 vb_record['vb_id'] = vb_id
                 vb_record['path'] = dm_map[vb_id]
-                vb_record['server'] = currentVbsMap[vb_id]
+                vb_record['server'] = vb_servers[vb_id]
                 vb_disk_map.append(vb_record)
             except:
                 continue
 
-        mapLock.release()
         return vb_disk_map
 
 
@@ -155,10 +163,11 @@ class InitBackupDaemon:
 
 class vbs_thread(threading.Thread):
 
-    def __init__ (self, vbs_host, logger):
+    def __init__ (self, vbs_host, logger, vbmap):
 
         self.vbs_host = vbs_host
         self.logger = logger
+        self.vbmap = vbmap
         self.thread_id = "VBS thread"
         self.vbs_map_ready = 0
         threading.Thread.__init__(self)
@@ -183,6 +192,7 @@ class vbs_thread(threading.Thread):
             self.logger.log("Fatal: Failed to connect to VBS server %s" %vbs_host)
             sys.exit(-1)
 
+        last_map_string = None
         while (1):
             sleep(5)
             #dummy stuff TODO
@@ -191,16 +201,20 @@ class vbs_thread(threading.Thread):
                 self.logger.log("Failure: Cannot get vbucket map")
                 continue
 
+            # the map is only parsed again once the VBS has sent a new one
+            if vbs_map_string == last_map_string:
+                continue
+
             try:
-                vbs_map_string = json.loads(vbs_map_string)
-                server_config = vbs_map_string[0]['vBucketServerMap']
+                vbs_map = json.loads(vbs_map_string)
+                server_config = vbs_map[0]['vBucketServerMap']
                 vb_list = server_config['vBucketMap']
                 server_list = server_config['serverList']
             except:
                 self.logger.log("Failure: Unable to parse vbucket map")
+                continue
 
-            vb_id = 0
-            vbs_map = {}
+            vbs_map = []
             for server_id in vb_list:
                 # need to connect to the replica vbucket
                 index = 0
@@ -210,22 +224,22 @@ class vbs_thread(threading.Thread):
                 serv_index = server_id[index]
                 # Skip vbuckets or servers in maintenance stages
                 if serv_index >= 0 and server_list[serv_index] != "0.0.0.0":
-                    vbs_map[vb_id] = server_list[serv_index]
+                    vbs_map.append(server_list[serv_index])
+                else:
+                    vbs_map.append(None)
 
-                vb_id = vb_id + 1
-
-            self.update_map(vbs_map)
+            try:
+                changed = self.vbmap.update_servers(vbs_map)
+            except ValueError, e:
+                self.logger.log("Failure: Unable to update vbucket map (%s)" %str(e))
+                continue
+            last_map_string = vbs_map_string
+            if changed > 0 and self.vbs_map_ready == 1:
+                self.logger.log("Info: %d vbuckets changed server, vbucket map version %d"
+                        %(changed, self.vbmap.get_version()))
 
             if self.vbs_map_ready == 0:
                 doneEvent.set()
                 doneEvent.clear()
                 self.vbs_map_ready = 1
 
-
-    def update_map(self, vbs_map):
-
-        mapLock.acquire(True)
-        global currentVbsMap
-        currentVbsMap = vbs_map
-        mapLock.release()
-
@@ -0,0 +1,210 @@
+#!/usr/bin/env python26
+#Description: Batched writer and tail reader of the dirty and to_be_deleted files of a disk
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import threading
+import consts
+import util
+
+class JournalWriter:
+    """
+    Batched appends to a journal of a disk, its dirty or to_be_deleted file
+
+    Paths added by any thread are kept in order without duplicates and
+    appended with one locked write every interval seconds, or on flush().
+    The merge schedulers add the files of the jobs that complete and flush
+    them before starting more. Records are newline terminated paths
+    written whole, so a JournalReader can tail the journal. Paths that
+    could not be written are kept for the next flush.
+
+    Paths that must be in the journal before the caller goes on, such as
+    the files of a backup before its checkpoint is recorded, are appended
+    with write().
+    """
+
+    def __init__(self, filename, interval=consts.JOURNAL_FLUSH_INTERVAL, logger=None):
+        self.filename = filename
+        self.interval = interval
+        self.logger = logger
+        # Held while writing too, so that batches are appended in order
+        self.lock = threading.RLock()
+        self.pending = []
+        self.pending_set = set()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.flushes = 0
+
+    def add(self, paths):
+        self.lock.acquire()
+        try:
+            for path in paths:
+                if not path in self.pending_set:
+                    self.pending_set.add(path)
+                    self.pending.append(path)
+        finally:
+            self.lock.release()
+
+    def discard(self, paths):
+        """
+        Drop paths that are not written yet
+        """
+        self.lock.acquire()
+        try:
+            paths = set(paths) & self.pending_set
+            if len(paths):
+                self.pending = filter(lambda x: not x in paths, self.pending)
+                self.pending_set -= paths
+        finally:
+            self.lock.release()
+
+    def has_pending(self):
+        return len(self.pending) > 0
+
+    def write(self, paths):
+        """
+        Append paths, with the ones pending, before returning. Returns False
+        if they could not be written, they are then kept for the next flush.
+        """
+        self.lock.acquire()
+        try:
+            self.add(paths)
+            return self.flush()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Append the pending paths, returns False if they could not be written
+        """
+        self.lock.acquire()
+        try:
+            if len(self.pending) == 0:
+                return True
+            if not util.appendToFile_Locked(self.filename, self.pending):
+                if self.logger:
+                    self.logger.log("Warning: failed to update %s, %d entries pending"
+                            %(self.filename, len(self.pending)))
+                return False
+            self.pending = []
+            self.pending_set = set()
+            self.flushes += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def start(self):
+        if self.thread == None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.interval)
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        return self.flush()
+
+
+class JournalReader:
+    """
+    Tail of a journal: the paths appended since the last read()
+
+    A consumer such as the copy daemon keeps the offset of what it has
+    processed instead of reading the whole journal every time. Only whole
+    records are returned. The journal is read from the start again once
+    it has been truncated or replaced.
+    """
+
+    def __init__(self, filename, offset=0):
+        self.filename = filename
+        self.offset = offset
+        self.inode = None
+
+    def read(self):
+        try:
+            f = open(self.filename)
+        except IOError:
+            return []
+        try:
+            st = os.fstat(f.fileno())
+            if (self.inode != None and st.st_ino != self.inode) or st.st_size < self.offset:
+                self.offset = 0
+            self.inode = st.st_ino
+            f.seek(self.offset)
+            data = f.read()
+        finally:
+            f.close()
+
+        end = data.rfind('\n') + 1
+        self.offset += end
+        return filter(lambda x: x != "", data[:end].split('\n'))
+
+
+writers = {}
+writers_lock = threading.Lock()
+
+def get_writer(filename, interval=consts.JOURNAL_FLUSH_INTERVAL, logger=None):
+    """
+    Started writer of a journal, shared by everything in the process
+    """
+    writers_lock.acquire()
+    try:
+        if not filename in writers:
+            writers[filename] = JournalWriter(filename, interval, logger)
+            writers[filename].start()
+        return writers[filename]
+    finally:
+        writers_lock.release()
+
+def has_pending(filename):
+    """
+    Check if a journal of the process has paths that are not written yet
+    """
+    writer = writers.get(filename)
+    return writer != None and writer.has_pending()
+
+def has_entries(filename):
+    """
+    Check if a journal holds any path, without reading all of it
+    """
+    try:
+        f = open(filename)
+    except IOError:
+        return False
+    try:
+        while True:
+            data = f.read(4096)
+            if data == '':
+                return False
+            if data.strip() != '':
+                return True
+    finally:
+        f.close()
+
+def flush_all():
+    """
+    Append the pending paths of all the journals of the process, returns
+    False if any could not be written
+    """
+    status = True
+    for writer in writers.values():
+        if not writer.flush():
+            status = False
+    return status
@@ -336,6 +336,46 @@ class MemcachedClient(object):
 
         return failed
 
+    def addMulti(self, items):
+        """Multi-add (using addq), all commands sent in one write.
+
+        Give me (vbucket, key, exp, flags, val, cksum) tuples, cksum may be
+        None. Returns (index, MemcachedError) of the items that failed."""
+
+        items = list(items)
+        terminal = len(items) + 10
+        msgs = []
+        for opaque, (vbucket, key, exp, flags, val, cksum) in enumerate(items):
+            if cksum:
+                extra = struct.pack(memcacheConstants.SET_PKT_FMT_WITH_CKSUM, flags, exp, len(cksum))
+                val = cksum + val
+                dtype = 1
+            else:
+                extra = struct.pack(SET_PKT_FMT, flags, exp)
+                dtype = 0
+            msgs.append(struct.pack(REQ_PKT_FMT, REQ_MAGIC_BYTE,
+                memcacheConstants.CMD_ADDQ, len(key), len(extra), dtype, vbucket,
+                len(key) + len(extra) + len(val), opaque, 0))
+            msgs.append(extra)
+            msgs.append(key)
+            msgs.append(val)
+
+        msgs.append(struct.pack(REQ_PKT_FMT, REQ_MAGIC_BYTE,
+            memcacheConstants.CMD_NOOP, 0, 0, 0, 0, 0, terminal, 0))
+        self.s.sendall("".join(msgs))
+
+        # Handle the response
+        failed = []
+        done = False
+        while not done:
+            cmd, errcode, opaque, cas, keylen, extralen, rv = self._recvMsg()
+            if opaque == terminal:
+                done = True
+            elif errcode != 0:
+                failed.append((opaque, MemcachedError(errcode, rv)))
+
+        return failed
+
     def stats(self, sub=''):
         """Get stats."""
         opaque=self.r.randint(0, 2**32)
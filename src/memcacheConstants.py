@@ -11,6 +11,7 @@ CMD_GET = 0
 CMD_SET = 1
 CMD_SETQ = 0x11
 CMD_ADD = 2
+CMD_ADDQ = 0x12
 CMD_REPLACE = 3
 CMD_DELETE = 4
 CMD_INCR = 5
@@ -193,5 +194,7 @@ EXTRA_HDR_SIZES=dict(
 ERR_UNKNOWN_CMD = 0x81
 ERR_NOT_FOUND = 0x1
 ERR_EXISTS = 0x2
+ERR_ENOMEM = 0x82
+ERR_TMPFAIL = 0x86
 ERR_AUTH = 0x20
 ERR_AUTH_CONTINUE = 0x21
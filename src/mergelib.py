@@ -0,0 +1,265 @@
+#!/usr/bin/env python26
+#Description: Streaming k-way merge of backup files
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+import heapq
+import shutil
+import sqlite3
+import consts
+import backuplib
+import util
+
+READ_BATCH_SIZE = 256
+EXIT_MERGEFAIL = 1
+EXIT_COPYFAIL = 2   # Same exit code as merge-incremental, callers mark the disk bad
+
+class MergeError(Exception):
+    pass
+
+class CopyError(Exception):
+    pass
+
+def genfilename(pattern, split_no):
+    return pattern.replace('%', str(split_no).zfill(5), 1)
+
+def read_checkpoints(files, validate):
+    """
+    Collect the checkpoint states of files given newest first
+
+    Checkpoints have to be continuous within a file and, when validate is
+    set, between consecutive files, as merge-incremental checks them.
+    """
+    checkpoints = []
+    seen = set()
+    last_vbmap = None
+    last_file = None
+    for path in files:
+        db = sqlite3.connect(path)
+        db.text_factory = str
+        rows = db.execute("SELECT vbucket_id, cpoint_id, prev_cpoint_id, state, source, updated_at "
+                "FROM cpoint_state ORDER BY cpoint_id DESC").fetchall()
+        db.close()
+
+        vbmap = {}
+        for row in rows:
+            cpoints = vbmap.setdefault(row[0], [])
+            if len(cpoints) and cpoints[-1] != row[1] + 1:
+                raise MergeError("ERROR: Checkpoint validation failed within the file, %s" %path)
+            cpoints.append(row[1])
+
+        repeated = False
+        if last_vbmap != None:
+            for vbucketId, cpoints in vbmap.items():
+                if not vbucketId in last_vbmap:
+                    continue
+                last_cpoints = last_vbmap[vbucketId]
+                if last_cpoints == cpoints:
+                    repeated = True
+                elif last_cpoints[-1] in (cpoints[0], cpoints[0] + 1):
+                    pass
+                elif validate:
+                    raise MergeError("ERROR: VB:%d Checkpoint mismatch between files %s (%d) and %s (%d)."
+                            %(vbucketId, path, cpoints[0], last_file, last_cpoints[-1]))
+
+        last_vbmap = vbmap
+        last_file = path
+        if not repeated:
+            for row in rows:
+                if not (row[0], row[1]) in seen:
+                    seen.add((row[0], row[1]))
+                    checkpoints.append(row)
+
+    return checkpoints
+
+def read_operations(path, batch_size=READ_BATCH_SIZE):
+    """
+    Yield the cpoint_op rows of a backup file ordered by (vbucket_id, key),
+    newest mutation of a key first. Rows are (vbucket_id, key, cpoint_id, seq, op, flg, exp, cas, cksum, val)
+    """
+    db = sqlite3.connect(path)
+    db.text_factory = str
+    cksum = "cksum"
+    if int(db.execute("pragma user_version").fetchone()[0]) < int(backuplib.MBB_VERSION):
+        cksum = "NULL"
+    cursor = db.execute("SELECT vbucket_id, key, cpoint_id, seq, op, flg, exp, cas, %s, val "
+            "FROM cpoint_op ORDER BY vbucket_id, key, cpoint_id DESC, seq DESC" %cksum)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+        db.close()
+
+class SplitOutput:
+    """
+    Merge output written as split files of at most split_size MB
+
+    Each split is built in the buffer path and moved to its destination
+    once it is complete.
+    """
+
+    def __init__(self, output_pattern, split_size, buffer_path, checkpoints, logger,
+            profile=consts.SQLITE_WRITE_PROFILE):
+        self.output_pattern = output_pattern
+        self.split_size = split_size
+        self.buffer_path = buffer_path
+        self.checkpoints = checkpoints
+        self.logger = logger
+        self.profile = profile
+        self.split_no = 0
+        self.db = None
+        self.op_count = 0
+        self.tmp_file = os.path.join(buffer_path, "output-backup-%d.mbb" %os.getpid())
+
+    def open(self):
+        self.output_file = genfilename(self.output_pattern, self.split_no)
+        self.logger.log("Info. Creating backup file - %s" %self.output_file)
+        if os.path.exists(self.tmp_file):
+            os.unlink(self.tmp_file)
+        self.db = backuplib.create_backup_db(self.tmp_file, self.split_size + backuplib.SPLIT_HEADROOM,
+                True, False, self.profile)
+        self.db.executemany("INSERT into cpoint_state"
+                "(vbucket_id, cpoint_id, prev_cpoint_id, state, source, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)", self.checkpoints)
+        self.db.commit()
+        self.writer = backuplib.SplitWriter(self.db, self.split_size * 1024 * 1024)
+
+    def add(self, record, size):
+        if not self.writer.add(record, size):
+            self.close()
+            self.split_no += 1
+            self.open()
+            self.writer.add(record, size, 0, True)
+        self.op_count += 1
+
+    def close(self):
+        self.writer.commit()
+        self.writer.close()
+        self.db.execute("CREATE INDEX K ON cpoint_op(vbucket_id, key)")
+        self.db.commit()
+        self.db.close()
+        self.db = None
+        try:
+            shutil.move(self.tmp_file, self.output_file)
+        except (IOError, OSError), e:
+            raise CopyError("ERROR: File copy failed (%s to %s: %s)" %(self.tmp_file,
+                        self.output_file, str(e)))
+        backuplib.write_split_meta(self.output_file, self.writer.written_records, self.logger)
+
+    def abort(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+        if os.path.exists(self.tmp_file):
+            os.unlink(self.tmp_file)
+
+class StreamingMerge:
+    """
+    k-way merge of backup files that keeps the newest version of each key
+
+    Every input is read ordered by (vbucket_id, key) and the inputs are
+    merged through a heap holding one row per input, so memory grows with
+    the number of inputs rather than with the number of keys. Inputs are
+    given newest first, as for merge-incremental, and the heap orders equal
+    keys by input rank; within an input the row with the highest
+    (cpoint_id, seq) comes first.
+    """
+
+    def __init__(self, files, output_pattern, split_size, buffer_path, validate, logger,
+            profile=consts.SQLITE_WRITE_PROFILE):
+        self.files = files
+        self.output_pattern = output_pattern
+        self.split_size = split_size
+        self.buffer_path = buffer_path
+        self.validate = validate
+        self.logger = logger
+        self.profile = profile
+        self.read_count = 0
+
+    def _next(self, rank, rows, last):
+        for row in rows:
+            self.read_count += 1
+            if (row[0], row[1]) < last:
+                raise MergeError("ERROR: %s is not ordered by vbucket_id, key" %self.files[rank])
+            return (row[0], row[1], rank, row, rows)
+        return None
+
+    def run(self):
+        if not os.path.exists(self.buffer_path):
+            os.makedirs(self.buffer_path)
+
+        checkpoints = read_checkpoints(self.files, self.validate)
+        output = SplitOutput(self.output_pattern, self.split_size, self.buffer_path,
+                checkpoints, self.logger, self.profile)
+        start = time.time()
+        try:
+            heap = []
+            for rank, path in enumerate(self.files):
+                self.logger.log("Info. Processing file - %s" %path)
+                entry = self._next(rank, read_operations(path), (0, ''))
+                if entry:
+                    heap.append(entry)
+            heapq.heapify(heap)
+
+            output.open()
+            last = None
+            while heap:
+                entry = heap[0]
+                vbucketId, key, rank, row, rows = entry
+                if (vbucketId, key) != last:
+                    last = (vbucketId, key)
+                    val = row[9]
+                    cksum = row[8]
+                    size = len(key) + len(val or '') + len(cksum or '') + backuplib.RECORD_OVERHEAD
+                    output.add((vbucketId, row[2], row[3], row[4], key, row[5], row[6], row[7],
+                                cksum, val), size)
+
+                entry = self._next(rank, rows, (vbucketId, key))
+                if entry:
+                    heapq.heapreplace(heap, entry)
+                else:
+                    heapq.heappop(heap)
+
+            output.close()
+        except:
+            output.abort()
+            raise
+
+        self.logger.log("Info. Merged %d files: read %d operations, wrote %d operations in %d splits (%.2f sec)"
+                %(len(self.files), self.read_count, output.op_count, output.split_no + 1,
+                    time.time() - start))
+
+def merge_files(files, output_pattern, split_size, buffer_path, validate, logger,
+        profile=consts.SQLITE_WRITE_PROFILE):
+    """
+    Run a streaming merge, returning an exit status like merge-incremental
+    """
+    try:
+        StreamingMerge(files, output_pattern, split_size, buffer_path, validate,
+                logger, profile).run()
+    except CopyError, e:
+        logger.log("Err. %s" %str(e))
+        return EXIT_COPYFAIL
+    except Exception, e:
+        logger.log("Err. %s" %str(e))
+        return EXIT_MERGEFAIL
+    return 0
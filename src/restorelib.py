@@ -0,0 +1,300 @@
+#!/usr/bin/env python26
+#Description: Download to restore handoff of zbase-restore
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import math
+import socket
+import struct
+import sqlite3
+import hashlib
+import threading
+import backuplib
+import memcacheConstants
+from mc_bin_client import MemcachedClient
+
+# Weight of the latest sample in the download and restore time averages
+SMOOTHING = 0.3
+APPLY_BATCH_SIZE = 1000
+APPLY_RETRIES = 10
+APPLY_RETRY_INTERVAL = 0.1
+
+class ApplyError(Exception):
+    pass
+
+class AppliedKeys:
+    """
+    Keys already applied by a restore, as 64 bit fingerprints by vbucket
+
+    Memory use does not depend on the key length, about 70 bytes a key. Two
+    keys sharing a fingerprint would make the restore skip the older one of
+    them, the chance of that is about n^2 / 2^65 for n keys remembered of a
+    vbucket: 3e-6 for 10 million keys, 3e-4 for 100 million.
+    """
+
+    unpack = struct.Struct('<q').unpack
+
+    def __init__(self):
+        self.vbuckets = {}
+        self.count = 0
+
+    def fingerprint(self, key):
+        return self.unpack(hashlib.md5(key).digest()[:8])[0]
+
+    def contains(self, vbucket_id, fingerprint):
+        keys = self.vbuckets.get(vbucket_id)
+        return keys != None and fingerprint in keys
+
+    def add(self, vbucket_id, fingerprint):
+        keys = self.vbuckets.get(vbucket_id)
+        if keys == None:
+            keys = self.vbuckets[vbucket_id] = set()
+        keys.add(fingerprint)
+        self.count += 1
+
+class ReorderBuffer:
+    """
+    Downloaded backup files handed to the restore in shard order
+
+    Download threads put() files as they complete, in any order, and the
+    restore thread get()s them strictly in shard order, woken up as soon as
+    the next shard lands. Downloads are kept within a window ahead of the
+    restore cursor (the shard being restored). The window is sized from the
+    average download and restore times so that the next file is ready when
+    the restore needs it, without holding more buffers than that:
+
+        window = ceil(download_time / restore_time) + 1
+
+    bounded by max_window, the number of download buffers.
+    """
+
+    def __init__(self, max_window):
+        self.cond = threading.Condition()
+        self.ready = {}
+        self.cursor = 0
+        self.max_window = max_window
+        self.window = max_window
+        self.download_time = None
+        self.restore_time = None
+        self.restore_waits = 0
+
+    def average(self, current, sample):
+        if current == None:
+            return sample
+        return SMOOTHING * sample + (1 - SMOOTHING) * current
+
+    def reserve(self, shard):
+        """
+        Block a download until shard is within the window
+        """
+        self.cond.acquire()
+        while shard >= self.cursor + self.window:
+            self.cond.wait()
+        self.cond.release()
+
+    def put(self, shard, item, elapsed):
+        """
+        Add a downloaded shard, elapsed is the time its download took
+        """
+        self.cond.acquire()
+        self.ready[shard] = item
+        self.download_time = self.average(self.download_time, elapsed)
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def get(self):
+        """
+        Wait for the shard at the restore cursor and return it
+        """
+        self.cond.acquire()
+        if not self.cursor in self.ready:
+            self.restore_waits += 1
+        while not self.cursor in self.ready:
+            self.cond.wait()
+        item = self.ready.pop(self.cursor)
+        self.cond.release()
+        return item
+
+    def done(self, elapsed):
+        """
+        Move the cursor past a restored shard, elapsed is the time its
+        restore took. Returns the new window.
+        """
+        self.cond.acquire()
+        self.cursor += 1
+        self.restore_time = self.average(self.restore_time, elapsed)
+        if self.download_time != None and self.restore_time > 0:
+            window = int(math.ceil(self.download_time / self.restore_time)) + 1
+            self.window = min(self.max_window, max(2, window))
+        self.cond.notifyAll()
+        window = self.window
+        self.cond.release()
+        return window
+
+
+class RestoreApplier:
+    """
+    Restore backup files into zbase over a single memcached connection
+
+    The cpoint_op rows of a file are read newest first and sent as batches
+    of pipelined quiet adds, so a key keeps the value of the newest backup
+    file it is found in and anything written to the server since the
+    restore started. Deleted keys are remembered to keep older versions of
+    them out. Files have to be applied newest first, the order zbase-restore
+    downloads them in.
+
+    With dedup every applied key is remembered, so the older versions of a
+    key further down the backup chain are not sent to the server at all.
+    """
+
+    def __init__(self, host, port, logger, batch_size=APPLY_BATCH_SIZE, dedup=False):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.batch_size = batch_size
+        self.dedup = dedup
+        self.mc = None
+        self.applied = AppliedKeys()
+        # vbucket_id -> [added, skipped, deduplicated, seconds]
+        self.stats = {}
+        self.bytes_deduplicated = 0
+
+    def connect(self):
+        if self.mc == None:
+            self.mc = MemcachedClient(self.host, self.port)
+            # Batches end with a small NOOP, do not let it wait for an ack
+            self.mc.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.mc
+
+    def close(self):
+        if self.mc != None:
+            self.mc.close()
+            self.mc = None
+
+    def send(self, items):
+        """
+        Add a batch of (vbucket, key, exp, flags, val, cksum), retrying the
+        ones the server is temporarily unable to take. Returns the number of
+        keys that already existed by vbucket.
+        """
+        existing = {}
+        for attempt in range(APPLY_RETRIES):
+            try:
+                failed = self.connect().addMulti(items)
+            except Exception, e:
+                self.close()
+                raise ApplyError("Sending keys to %s:%d failed (%s)" %(self.host, self.port, str(e)))
+
+            retry = []
+            for index, e in failed:
+                if e.status == memcacheConstants.ERR_EXISTS:
+                    vbucket_id = items[index][0]
+                    existing[vbucket_id] = existing.get(vbucket_id, 0) + 1
+                elif e.status in (memcacheConstants.ERR_TMPFAIL, memcacheConstants.ERR_ENOMEM):
+                    retry.append(items[index])
+                else:
+                    raise ApplyError("Restoring key %s failed (%s)" %(items[index][1], str(e)))
+
+            if len(retry) == 0:
+                return existing
+            items = retry
+            time.sleep(APPLY_RETRY_INTERVAL)
+
+        raise ApplyError("Server is out of memory, %d keys could not be restored" %len(items))
+
+    def apply(self, backup_file, oldest=False):
+        """
+        Restore a backup file, returning {vbucket_id: (added, skipped,
+        deduplicated, seconds)} for the vbuckets found in it. Keys of the
+        files of the oldest backup of the chain, a merged backup holding a
+        key in one file only, need not be remembered.
+        """
+        db = sqlite3.connect(backup_file)
+        db.text_factory = str
+        cksum = "cksum"
+        if int(db.execute("pragma user_version").fetchone()[0]) < int(backuplib.MBB_VERSION):
+            cksum = "NULL"
+        # Rows are appended in checkpoint order, the newest mutation is last
+        cursor = db.execute("SELECT vbucket_id, op, key, flg, exp, %s, val FROM cpoint_op "
+                "ORDER BY rowid DESC" %cksum)
+
+        file_stats = {}
+        try:
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+
+                start = time.time()
+                items = []
+                counts = {}
+                for vbucket_id, op, key, flg, exp, cksum, val in rows:
+                    c = counts.setdefault(vbucket_id, [0, 0, 0])
+                    fingerprint = self.applied.fingerprint(key)
+                    if self.applied.contains(vbucket_id, fingerprint):
+                        c[2] += 1
+                        if val != None:
+                            self.bytes_deduplicated += len(key) + len(val)
+                        continue
+
+                    if op == 'd' or (self.dedup and not oldest):
+                        self.applied.add(vbucket_id, fingerprint)
+                    if op == 'd':
+                        c[1] += 1
+                    else:
+                        items.append((vbucket_id, key, exp, flg, str(val or ''), cksum))
+                        c[0] += 1
+
+                existing = {}
+                if len(items):
+                    existing = self.send(items)
+                elapsed = time.time() - start
+
+                for vbucket_id, count in existing.items():
+                    counts[vbucket_id][0] -= count
+                    counts[vbucket_id][1] += count
+                for vbucket_id, (added, skipped, deduplicated) in counts.items():
+                    s = file_stats.setdefault(vbucket_id, [0, 0, 0, 0.0])
+                    s[0] += added
+                    s[1] += skipped
+                    s[2] += deduplicated
+                    s[3] += elapsed * (added + skipped + deduplicated) / len(rows)
+        finally:
+            cursor.close()
+            db.close()
+
+        for vbucket_id, (added, skipped, deduplicated, seconds) in file_stats.items():
+            s = self.stats.setdefault(vbucket_id, [0, 0, 0, 0.0])
+            s[0] += added
+            s[1] += skipped
+            s[2] += deduplicated
+            s[3] += seconds
+            self.logger.log("Info. VB:%d restored %d keys, skipped %d, older versions %d from %s (%.2f sec, %d keys/sec)"
+                    %(vbucket_id, added, skipped, deduplicated, backup_file, seconds,
+                        keys_per_sec(added + skipped + deduplicated, seconds)))
+
+        return file_stats
+
+    def complete(self):
+        """
+        Tell the server the restore is done
+        """
+        self.connect().restore_complete()
+
+def keys_per_sec(keys, seconds):
+    if seconds <= 0:
+        return keys
+    return keys / seconds
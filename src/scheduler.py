@@ -22,8 +22,141 @@ import shlex
 import datetime
 import glob
 import os
+import json
 import consts
 import diffdisk
+import journal
+
+def getAvailableMemory():
+    """
+    Return memory in MB that can be used without swapping
+    """
+    info = {}
+    for line in open('/proc/meminfo'):
+        fields = line.split()
+        info[fields[0].rstrip(':')] = int(fields[1])
+
+    if 'MemAvailable' in info:
+        return info['MemAvailable'] / 1024
+    return (info['MemFree'] + info.get('Buffers', 0) + info.get('Cached', 0)) / 1024
+
+def getProcessRSS(pid):
+    """
+    Return resident memory in KB of a process, 0 once it is gone
+    """
+    try:
+        for line in open('/proc/%d/status' %pid):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+def getChildPids(pid):
+    """
+    Return the pids of the children of a process, from the children files
+    of its threads. Kernels older than 3.5 have none.
+    """
+    children = []
+    try:
+        tasks = os.listdir('/proc/%d/task' %pid)
+    except OSError:
+        return children
+    for tid in tasks:
+        try:
+            children.extend(map(int, open('/proc/%d/task/%s/children' %(pid, tid)).read().split()))
+        except (IOError, OSError, ValueError):
+            continue
+    return children
+
+def getProcessTreeRSS(pid):
+    """
+    Return resident memory in MB of a process and its descendants. Only
+    the process itself is counted where the kernel does not list children.
+    """
+    rss = 0
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+        rss += getProcessRSS(pid)
+        pending.extend(getChildPids(pid))
+    return rss / 1024
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+class MemoryModel:
+    """
+    Peak memory of past merge jobs, kept per job type and vbucket location
+    A job is expected to use the median of its recent peaks plus headroom.
+    Locations that have not been merged yet are expected to use the median
+    of the locations of the same job type, so that one outlier does not
+    raise the estimate of every job.
+    """
+
+    HISTORY = 5
+    HEADROOM = 1.2
+
+    def __init__(self, path, default, logger):
+        self.path = path
+        self.default = default
+        self.logger = logger
+        self.peaks = self.load()
+
+    def load(self):
+        try:
+            f = open(self.path)
+            peaks = json.loads(f.read())
+            f.close()
+            return peaks
+        except IOError:
+            return {}
+        except Exception, e:
+            self.logger.error("Unable to read merge memory model %s (%s)" %(self.path, str(e)))
+            return {}
+
+    def save(self):
+        try:
+            tmp_path = "%s.tmp" %self.path
+            f = open(tmp_path, 'w')
+            f.write(json.dumps(self.peaks))
+            f.close()
+            os.rename(tmp_path, self.path)
+        except Exception, e:
+            self.logger.error("Unable to save merge memory model %s (%s)" %(self.path, str(e)))
+
+    def getKey(self, job):
+        return "%d:%s" %(job.btype, job.getLocation())
+
+    def predict(self, job):
+        """
+        Return expected peak memory in MB of a merge job
+        """
+        key = self.getKey(job)
+        if key in self.peaks:
+            return int(median(self.peaks[key]) * MemoryModel.HEADROOM)
+
+        prefix = "%d:" %job.btype
+        peaks = [median(v) for k, v in self.peaks.items() if k.startswith(prefix)]
+        if len(peaks):
+            return int(median(peaks) * MemoryModel.HEADROOM)
+        return self.default
+
+    def record(self, job, peak):
+        """
+        Add the peak memory of a completed job to the model
+        """
+        # Pick up the peaks saved by the other scheduler
+        self.peaks.update(self.load())
+        key = self.getKey(job)
+        history = self.peaks.get(key, [])
+        history.append(peak)
+        self.peaks[key] = history[-MemoryModel.HISTORY:]
+        self.save()
+
 
 class MergeJob:
     """
@@ -33,9 +166,10 @@ class MergeJob:
     DAILYJOB = 0
     MASTERJOB = 1
 
-    def __init__(self, btype, location, date, logger):
+    def __init__(self, btype, location, date, logger, journal_flush_interval=consts.JOURNAL_FLUSH_INTERVAL):
         self.btype = btype
         self.logger = logger
+        self.journal_flush_interval = journal_flush_interval
         if location[-1] == '/':
             location = location[:-1]
 
@@ -44,6 +178,8 @@ class MergeJob:
         self.path = None
         self.process = None
         self.running = False
+        self.rss = 0
+        self.peak_rss = 0
 
     def __eq__(self, obj):
         return obj.btype == self.btype and obj.location == self.location \
@@ -118,11 +254,11 @@ class MergeJob:
             self.logger.error("Unable to generate dirty and deleted files list for disk:%s" %self.getDisk())
             return False
 
-        if appendToFile_Locked(dirty_filename, dirtylist) and appendToFile_Locked(deleted_filename, deletedlist):
-            return True
-        else:
-            self.logger.error("Unable to mark %s to dirtyfile and add deleted files, %s" %(self.path, dirty_filename))
-            return False
+        # Batched with the files of the other jobs that complete, the
+        # scheduler flushes them before it starts more jobs
+        journal.get_writer(dirty_filename, self.journal_flush_interval, self.logger).add(dirtylist)
+        journal.get_writer(deleted_filename, self.journal_flush_interval, self.logger).add(deletedlist)
+        return True
 
     def isRunning(self):
         return self.running
@@ -135,16 +271,37 @@ class MergeJob:
         diffdisk.dirdiff(self.getDisk(), "primary")
         self.process = Popen(self.getCommand(), stdout=PIPE, stderr=PIPE, preexec_fn=os.setsid)
 
+    def sampleMemory(self):
+        """
+        Update current and peak memory usage of the merge process and its children
+        """
+        if self.process and self.running:
+            # Only the processes of this job are read, not all of /proc
+            self.rss = getProcessTreeRSS(self.process.pid)
+            self.peak_rss = max(self.peak_rss, self.rss)
+
     def isProcessComplete(self):
         """
         Check if merge process is complete
         """
-        if self.process.poll() is not None:
-            self.running = False
+        if self.process.returncode is not None:
             return True
-        else:
+
+        pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+        if pid == 0:
             return False
 
+        # Reaped here for its resource usage, so Popen is given the status
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        # Peak of the merge and of the children it waited for, e.g.
+        # merge-incremental, as kept by the kernel
+        self.peak_rss = max(self.peak_rss, rusage.ru_maxrss / 1024)
+        self.running = False
+        return True
+
     def getStatus(self):
         """
         Return status of merge job
@@ -168,11 +325,13 @@ class MergeJob:
         """
         Mark the job as complete
         If the job is successful, mark it as dirty
+        Returns False if the files to be copied could not be found
         """
         self.markComplete()
         if self.getStatus() == "SUCCESS":
             if os.path.exists(os.path.join(self.path, "done")):
-                self.markForCopy()
+                return self.markForCopy()
+        return True
 
 
 class BaseScheduler:
@@ -193,6 +352,7 @@ class BaseScheduler:
         self.disks = []
         self.jobs = []
         self.current_execjobs = []
+        self.memory_model = MemoryModel(consts.MERGE_MEMORY_MODEL, consts.SPLIT_SIZE*2, logger)
         self.type = "Base Scheduler" #To be implemented by derived class
         self.initialize()
 
@@ -248,10 +408,9 @@ class BaseScheduler:
         """
         Check if the a disk is being used
         """
-        if os.path.exists(os.path.join(disk, consts.DIRTY_DISK_FILE)):
-            data = open(os.path.join(disk, consts.DIRTY_DISK_FILE), 'r').read().strip()
-            if data != "":
-                return True
+        dirty_filename = os.path.join(disk, consts.DIRTY_DISK_FILE)
+        if journal.has_pending(dirty_filename) or journal.has_entries(dirty_filename):
+            return True
 
         if os.system('ps -eo comm | grep "aria2c" | grep "%s" > /dev/null 2>&1' %disk) == 0:
             return True
@@ -287,13 +446,20 @@ class BaseScheduler:
         slotfree=False
         while True:
             print len(self.current_execjobs)
-            for j in self.current_execjobs:
+            for j in self.current_execjobs[:]:
+                j.sampleMemory()
                 if j.isProcessComplete():
-                    j.postExecutionSteps()
-                    self.logger.info("(%s) Completed execution of job [ DISK:%s VBUCKET:%s STATUS:%s ]" %(self.type, j.getDisk(), j.getVBucket(), j.getStatus()))
+                    if not j.postExecutionSteps():
+                        self.logger.error("(%s) Files of job [ DISK:%s VBUCKET:%s ] not marked for copy" %(self.type, j.getDisk(), j.getVBucket()))
+                    self.logger.info("(%s) Completed execution of job [ DISK:%s VBUCKET:%s STATUS:%s PEAK_RSS:%dMB ]" %(self.type, j.getDisk(), j.getVBucket(), j.getStatus(), j.peak_rss))
+                    if j.getStatus() == "SUCCESS" and j.peak_rss > 0:
+                        self.memory_model.record(j, j.peak_rss)
                     self.current_execjobs.remove(j)
                     slotfree=True
 
+            if slotfree and not journal.flush_all():
+                self.logger.error("(%s) Unable to write the pending dirty and deleted files" %self.type)
+
             if completeAll == False:
                 if slotfree or len(self.current_execjobs)==0:
                     break
@@ -321,11 +487,23 @@ class BaseScheduler:
 
     def getFreeMemory(self):
         """
-        Return current system free memory
+        Return system free memory less the memory the running jobs are
+        still expected to grow into
         """
-        mem = os.popen("free -m").readlines()[1].split()
-        free = int(mem[3]) + int(mem[-1]) - len(self.current_execjobs)*consts.SPLIT_SIZE*2
-        return free
+        reserved = 0
+        for j in self.current_execjobs:
+            reserved += max(self.memory_model.predict(j) - j.rss, 0)
+        return getAvailableMemory() - reserved
+
+    def hasMemory(self, job, threshold):
+        """
+        Check if the job fits in memory next to the running jobs and leaves
+        threshold MB free. A job is always admitted when none is running,
+        the prediction may not fit the host at all.
+        """
+        if len(self.current_execjobs) == 0:
+            return True
+        return self.getFreeMemory() - self.memory_model.predict(job) >= threshold
 
 
     def execute(self, date):
@@ -404,6 +582,9 @@ class BaseScheduler:
                 time.sleep(1)
 
         self.waitForProcessSlot(True)
+        if not journal.flush_all():
+            self.logger.error("(%s) Unable to write the pending dirty and deleted files" %self.type)
+            ret = False
 
         if skipped == True:
             ret = False
@@ -442,7 +623,8 @@ class DailyMergeScheduler(BaseScheduler):
                 addhost = True
 
             if addhost:
-                job = MergeJob(MergeJob.DAILYJOB, h, date, self.logger)
+                job = MergeJob(MergeJob.DAILYJOB, h, date, self.logger,
+                        self.config.journal_flush_interval)
                 if job not in self.current_execjobs:
                     if self.isDiskBusy(d):
                         jobs.insert(0, job)
@@ -452,7 +634,7 @@ class DailyMergeScheduler(BaseScheduler):
 
     def canSchedule(self, job):
 
-        if self.getFreeMemory() < self.config.daily_mem_threshold:
+        if not self.hasMemory(job, self.config.daily_mem_threshold):
             return BaseScheduler.NOMEMORY
 
         if len(self.current_execjobs) < self.config.parallel_daily_jobs:
@@ -491,7 +673,8 @@ class MasterMergeScheduler(BaseScheduler):
                 addhost = True
 
             if addhost:
-                job = MergeJob(MergeJob.MASTERJOB, h, date, self.logger)
+                job = MergeJob(MergeJob.MASTERJOB, h, date, self.logger,
+                        self.config.journal_flush_interval)
                 if job not in self.current_execjobs:
                     if self.isDiskBusy(d):
                         jobs.insert(0, job)
@@ -501,12 +684,12 @@ class MasterMergeScheduler(BaseScheduler):
 
     def canSchedule(self, job):
 
-        if self.getFreeMemory() < self.config.master_mem_threshold:
-            return BaseScheduler.NOMEMORY
-
         if self.startdate != datetime.date.today():
             return BaseScheduler.SKIP
 
+        if not self.hasMemory(job, self.config.master_mem_threshold):
+            return BaseScheduler.NOMEMORY
+
         if len(self.current_execjobs) < self.config.parallel_master_jobs:
             if self.isDiskBusy(job.getDisk()):
                 return BaseScheduler.IGNORE
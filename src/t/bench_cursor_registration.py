@@ -0,0 +1,84 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: cursor handling of a failed backup cycle (register temporary
+# cursor, re-point backup cursor, delete temporary cursor) for every vbucket,
+# through mbadm-tap-registration vs CheckpointCursors.
+# Needs a running server. Usage: bench_cursor_registration.py [host:port] [vbuckets]
+
+import sys
+sys.path.insert(0,'../')
+import time
+import commands
+import consts
+from backuplib import CheckpointCursors
+
+CURSOR = "bench_backup_cursor_vb_%d"
+TEMP_CURSOR = "bench_temporary_cursor_vb_%d"
+
+def run_tool(host, port, args):
+    cmd = "python26 %s -h %s:%s %s" %(consts.TAP_REGISTERATION, host, port, args)
+    status, output = commands.getstatusoutput(cmd)
+    if status > 0:
+        raise Exception("Command: %s Output %s" %(cmd, output))
+
+def cycle_tool(host, port, vbuckets):
+    for vb in xrange(vbuckets):
+        run_tool(host, port, "-r %s -l 1 -v %d" %(TEMP_CURSOR %vb, vb))
+        run_tool(host, port, "-d %s" %(CURSOR %vb))
+        run_tool(host, port, "-r %s -l 1 -v %d" %(CURSOR %vb, vb))
+        run_tool(host, port, "-d %s" %(TEMP_CURSOR %vb))
+
+def cycle_api(host, port, vbuckets):
+    cursors = CheckpointCursors(host, port)
+    for vb in xrange(vbuckets):
+        cursors.register(TEMP_CURSOR %vb, 1, vb)
+        cursors.repoint(CURSOR %vb, 1, vb)
+        cursors.deregister(TEMP_CURSOR %vb)
+    cursors.close()
+
+def setup(host, port, vbuckets):
+    cursors = CheckpointCursors(host, port)
+    for vb in xrange(vbuckets):
+        cursors.register(CURSOR %vb, 1, vb)
+    cursors.close()
+
+def teardown(host, port, vbuckets):
+    cursors = CheckpointCursors(host, port)
+    for vb in xrange(vbuckets):
+        cursors.deregister(CURSOR %vb)
+    cursors.close()
+
+
+if __name__ == '__main__':
+    host, port = "127.0.0.1", 11211
+    vbuckets = 256
+    if len(sys.argv) > 1:
+        host, port = sys.argv[1].split(':')
+    if len(sys.argv) > 2:
+        vbuckets = int(sys.argv[2])
+
+    setup(host, port, vbuckets)
+    try:
+        for name, cycle in (("mbadm-tap-registration", cycle_tool),
+                ("CheckpointCursors", cycle_api)):
+            start = time.time()
+            cycle(host, port, vbuckets)
+            elapsed = time.time() - start
+            print "%-24s %4d vbuckets %8.2f sec %8.2f ms/vbucket" %(name, vbuckets,
+                    elapsed, elapsed * 1000 / vbuckets)
+    finally:
+        teardown(host, port, vbuckets)
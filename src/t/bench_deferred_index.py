@@ -0,0 +1,70 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: deduplicated split with primary key vs deferred index build
+# Usage: bench_deferred_index.py [directory] [record_count] [distinct_keys] [value_size]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import tempfile
+import backuplib
+
+
+def write_split(directory, deferred_index, count, distinct_keys, value_size):
+    fd, path = tempfile.mkstemp(suffix='.mbb', dir=directory)
+    os.close(fd)
+    os.unlink(path)
+    val = 'v' * value_size
+    start = time.time()
+    db = backuplib.create_backup_db(path, 4096, True, True, deferred_index=deferred_index)
+    writer = backuplib.SplitWriter(db, 4096 * 1024 * 1024)
+    for i in xrange(count):
+        # Spread keys the way hashed keys arrive, not in index order
+        key = "key_%010d" %((i * 2654435761) % distinct_keys)
+        writer.add((0, 1, i, 'm', key, 0, 0, i, '', buffer(val)), len(key) + len(val))
+    writer.commit()
+    writer.close()
+    seal_start = time.time()
+    if deferred_index:
+        backuplib.seal_backup_db(db)
+    end = time.time()
+    rows = db.execute("SELECT count(*) FROM cpoint_op").fetchone()[0]
+    db.close()
+    os.unlink(path)
+    return rows, end - seal_start, end - start
+
+
+if __name__ == '__main__':
+    directory = tempfile.gettempdir()
+    count = 500000
+    distinct_keys = 250000
+    value_size = 256
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        distinct_keys = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        value_size = int(sys.argv[4])
+
+    for name, deferred_index in (("primary key", False), ("deferred index", True)):
+        rows, seal_time, total_time = write_split(directory, deferred_index,
+                count, distinct_keys, value_size)
+        print "%-16s %8d rows  seal %6.2f sec  total %6.2f sec" %(name, rows,
+                seal_time, total_time)
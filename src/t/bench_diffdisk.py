@@ -0,0 +1,111 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: dirdiff of a disk by listing it with find vs the directory
+# snapshot, after a merge has changed a few vbucket directories. Both are
+# run on the same changes and their dirty and deleted lists compared.
+# Usage: bench_diffdisk.py [vbuckets] [files_per_vbucket] [changed_vbuckets]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import shutil
+import tempfile
+import diffdisk
+
+def find_dirdiff(basedir, dirname, manifest):
+    curr_files = diffdisk.list_files(os.path.join(basedir, dirname))
+    recent_list = diffdisk.read_list(os.path.join(basedir, manifest))
+    dirty, deleted = diffdisk.diff_list(recent_list, curr_files)
+    diffdisk.write_list(os.path.join(basedir, manifest), curr_files)
+    return dirty, deleted
+
+def touch(path):
+    open(path, 'w').close()
+
+def vb_path(disk, vb):
+    return os.path.join(disk, "primary", "vb_group_%d" %(vb % 16), "vb_%d" %vb)
+
+def create_vbucket(disk, vb, files):
+    incremental = os.path.join(vb_path(disk, vb), "incremental")
+    os.makedirs(incremental)
+    for i in range(files / 2):
+        touch(os.path.join(incremental, "backup-2013-01-01_%05d-00001.mbb" %i))
+    touch(os.path.join(incremental, "backup-2013-01-01_00000.split"))
+    for day in range(1, 3):
+        daily = os.path.join(vb_path(disk, vb), "daily", "2013-01-%02d" %day)
+        os.makedirs(daily)
+        for i in range(files / 4):
+            touch(os.path.join(daily, "backup-%05d.mbb" %i))
+        touch(os.path.join(daily, "done"))
+
+def merge_vbucket(disk, vb):
+    """
+    What a daily merge leaves behind: a new daily backup and the merged
+    incremental backups listed in manifest.del and removed
+    """
+    incremental = os.path.join(vb_path(disk, vb), "incremental")
+    daily = os.path.join(vb_path(disk, vb), "daily", "2013-01-03")
+    os.makedirs(daily)
+    for i in range(4):
+        touch(os.path.join(daily, "backup-%05d.mbb" %i))
+    touch(os.path.join(daily, "backup.split"))
+    touch(os.path.join(daily, "done"))
+    names = sorted(os.listdir(incremental))[:10]
+    for name in names:
+        os.unlink(os.path.join(incremental, name))
+    touch(os.path.join(incremental, "manifest.del"))
+
+def run(name, fn, disk, manifest):
+    start = time.time()
+    dirty, deleted = fn(disk, "primary", manifest)
+    elapsed = time.time() - start
+    print "%-10s %8.3f sec  dirty %6d deleted %6d" %(name, elapsed, len(dirty), len(deleted))
+    return dirty, sorted(deleted)
+
+
+if __name__ == '__main__':
+    vbuckets = 1000
+    files = 100
+    changed = 8
+    if len(sys.argv) > 1:
+        vbuckets = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        files = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        changed = int(sys.argv[3])
+
+    disk = tempfile.mkdtemp()
+    for vb in range(vbuckets):
+        create_vbucket(disk, vb, files)
+    print "%d vbuckets, %d files" %(vbuckets, len(diffdisk.list_files(disk)))
+    # Directories modified within MTIME_SLACK of a scan are listed again
+    time.sleep(diffdisk.MTIME_SLACK + 1)
+
+    print "Full scan"
+    find_result = run("find", find_dirdiff, disk, ".find")
+    snapshot_result = run("snapshot", diffdisk.dirdiff, disk, ".snapshot")
+    assert find_result == snapshot_result
+
+    for vb in range(0, vbuckets, vbuckets / changed):
+        merge_vbucket(disk, vb)
+    print "After merging %d vbuckets" %changed
+    find_result = run("find", find_dirdiff, disk, ".find")
+    snapshot_result = run("snapshot", diffdisk.dirdiff, disk, ".snapshot")
+    assert find_result == snapshot_result
+
+    shutil.rmtree(disk)
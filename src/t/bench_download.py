@@ -0,0 +1,113 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: MB/sec and peak RSS of one large DOWNLOAD, received into a
+# string and then written (the previous client path) vs streamed to disk
+# Usage: bench_download.py [file_size_mb] [directory]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import shutil
+import signal
+import socket
+import resource
+import tempfile
+import subprocess
+from download_client import download_client
+from bench_file_server import start_disk_mapper, free_port, VBUCKET, FILENAME
+
+def buffered_download(port, output_file):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(("127.0.0.1", port))
+    sock.sendall("DOWNLOAD %d %s" %(VBUCKET, FILENAME))
+    expected = -1
+    received = 0
+    buffer = ""
+    while True:
+        data = sock.recv(65535)
+        if len(data) == 0:
+            break
+        if expected == -1:
+            offset = data.index("\r\n")
+            expected = int(data[:offset])
+            data = data[offset + 2:]
+        received += len(data)
+        buffer += data
+        if received >= expected:
+            break
+    sock.close()
+    f = open(output_file, "w+")
+    f.write(buffer[:expected])
+    f.close()
+
+def streaming_download(port, output_file):
+    client = download_client("127.0.0.1", port)
+    status, msg = client.download(VBUCKET, FILENAME, output_file)
+    if status != 0:
+        raise Exception("Download failed")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--client':
+        method = {'buffered': buffered_download, 'streaming': streaming_download}[sys.argv[2]]
+        start = time.time()
+        method(int(sys.argv[3]), sys.argv[4])
+        elapsed = time.time() - start
+        print elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sys.exit(0)
+
+    size_mb = 1024
+    directory = tempfile.gettempdir()
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        directory = sys.argv[2]
+
+    root = tempfile.mkdtemp(dir=directory)
+    devnull = open(os.devnull, 'w')
+    server = None
+    try:
+        path = os.path.join(root, "primary", "vb_group_0", "vb_%d" %VBUCKET)
+        os.makedirs(path)
+        f = open(os.path.join(path, FILENAME), "w")
+        block = 'v' * 1024 * 1024
+        for i in xrange(size_mb):
+            f.write(block)
+        f.close()
+        output_file = os.path.join(root, "output.mbb")
+
+        disk_mapper = start_disk_mapper(root)
+        port = free_port()
+        server = subprocess.Popen([sys.executable, 'bench_file_server.py', '--server', disk_mapper,
+            str(port), 'threaded', '300'], stdout=devnull, stderr=devnull)
+        time.sleep(1)
+
+        for method in ('buffered', 'streaming'):
+            out = subprocess.Popen([sys.executable, sys.argv[0], '--client', method, str(port),
+                output_file], stdout=subprocess.PIPE).communicate()[0]
+            elapsed, maxrss = out.split()
+            if os.path.getsize(output_file) != size_mb * 1024 * 1024:
+                print "%-10s incomplete download" %method
+            print "%-10s %6d MB %8.2f MB/sec  peak rss %8d KB" %(method, size_mb,
+                    size_mb / float(elapsed), int(maxrss))
+            os.unlink(output_file)
+    finally:
+        if server:
+            os.kill(server.pid, signal.SIGTERM)
+            server.wait()
+        shutil.rmtree(root)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: requests/sec and aggregate MB/sec of the file server modes
+# Each client connects, downloads one file and disconnects, in a loop, or
+# downloads over one kept alive connection. Meanwhile slow clients each
+# hold a download of the file open, reading it at SLOW_CLIENT_RATE.
+# A local disk mapper stub and file server are started for each mode.
+# Usage: bench_file_server.py [clients] [seconds] [file_size_kb] [dm_cache_ttl] [slow_clients]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import json
+import signal
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import consts
+from file_server import FileServer
+from download_client import download_client
+
+VBUCKET = 0
+FILENAME = "backup-00000.mbb"
+SLOW_CLIENT_RATE = 1024 * 1024
+
+class DiskMapperHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        mapping = {"disk": self.server.disk, "type": "primary", "vb_group": "vb_group_0",
+                "path_name": "/%s/primary/vb_group_0/vb_%d" %(self.server.disk, VBUCKET)}
+        if "get_ss_mapping" in self.path:
+            body = json.dumps({"vb_%d" %VBUCKET: mapping})
+        else:
+            body = json.dumps(mapping)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_disk_mapper(root):
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), DiskMapperHandler)
+    server.disk = root.lstrip('/')
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return "127.0.0.1:%d" %server.server_address[1]
+
+def download(port, size):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(("127.0.0.1", port))
+    sock.sendall("DOWNLOAD %d %s" %(VBUCKET, FILENAME))
+    header = len("%d\r\n" %size)
+    expected = header + size + 2
+    received = 0
+    while received < expected:
+        data = sock.recv(65536)
+        if not data:
+            raise Exception("Connection closed after %d bytes" %received)
+        received += len(data)
+    sock.close()
+    return size
+
+def slow_client(port, deadline, received):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(("127.0.0.1", port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+    sock.sendall("DOWNLOAD %d %s" %(VBUCKET, FILENAME))
+    while time.time() < deadline:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received.append(len(data))
+        time.sleep(float(len(data)) / SLOW_CLIENT_RATE)
+    sock.close()
+
+def client(port, size, deadline, results, lock, keepalive):
+    count = 0
+    errors = 0
+    total = 0
+    session = download_client("127.0.0.1", port, True)
+    while time.time() < deadline:
+        try:
+            if keepalive:
+                if len(session.request("DOWNLOAD %d %s" %(VBUCKET, FILENAME), True)) != size:
+                    raise Exception("Short download")
+                total += size
+            else:
+                total += download(port, size)
+            count += 1
+        except Exception, e:
+            errors += 1
+    session.close()
+    lock.acquire()
+    results.append((count, errors, total))
+    lock.release()
+
+def run_load(port, clients, seconds, size, keepalive, slow_clients):
+    results = []
+    lock = threading.Lock()
+    threads = []
+    start = time.time()
+    deadline = start + seconds
+    slow_received = []
+    for i in range(slow_clients):
+        t = threading.Thread(target=slow_client, args=(port, deadline, slow_received))
+        t.start()
+        threads.append(t)
+    # let the slow clients start their downloads first
+    time.sleep(0.5)
+    for i in range(clients):
+        t = threading.Thread(target=client, args=(port, size, deadline, results, lock, keepalive))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    count = sum([r[0] for r in results])
+    errors = sum([r[1] for r in results])
+    total = sum([r[2] for r in results])
+    slow_total = sum(slow_received)
+    return count / elapsed, total / elapsed / 1024 / 1024, errors, slow_total / elapsed / 1024 / 1024
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--server':
+        server = FileServer(sys.argv[2], "127.0.0.1", int(sys.argv[3]), sys.argv[4],
+                dm_cache_ttl=int(sys.argv[5]))
+        server.start()
+        sys.exit(0)
+
+    clients = 8
+    seconds = 10
+    size_kb = 64 * 1024
+    dm_cache_ttl = consts.FILE_SERVER_DM_CACHE_TTL
+    slow_clients = 2 * consts.FILE_SERVER_WORKERS
+    if len(sys.argv) > 1:
+        clients = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        seconds = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        size_kb = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        dm_cache_ttl = int(sys.argv[4])
+    if len(sys.argv) > 5:
+        slow_clients = int(sys.argv[5])
+
+    root = tempfile.mkdtemp()
+    try:
+        directory = os.path.join(root, "primary", "vb_group_0", "vb_%d" %VBUCKET)
+        os.makedirs(directory)
+        f = open(os.path.join(directory, FILENAME), "w")
+        for i in range(size_kb):
+            f.write('v' * 1024)
+        f.close()
+        disk_mapper = start_disk_mapper(root)
+
+        for mode in (FileServer.THREADED, FileServer.EVENT):
+            port = free_port()
+            devnull = open(os.devnull, 'w')
+            server = subprocess.Popen([sys.executable, sys.argv[0], '--server', disk_mapper,
+                str(port), mode, str(dm_cache_ttl)], stdout=devnull, stderr=devnull)
+            time.sleep(1)
+            try:
+                for keepalive in (False, True):
+                    rate, mbps, errors, slow_mbps = run_load(port, clients, seconds, size_kb * 1024,
+                            keepalive, slow_clients)
+                    print "%-10s %-10s %4d clients %8.1f req/sec %8.2f MB/sec %6d errors, %d slow clients %6.2f MB/sec" %(mode,
+                            ["connect", "keepalive"][keepalive], clients, rate, mbps, errors,
+                            slow_clients, slow_mbps)
+            finally:
+                os.kill(server.pid, signal.SIGTERM)
+                server.wait()
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: marking the files of backups and merge jobs for copy, as
+# zbase-backupd and the merge schedulers do.
+# Backups: one append per backup through touch/chown commands (as
+# appendToFile_Locked did), with appendToFile_Locked, and with
+# JournalWriter.write() as record_backup does before recording the
+# checkpoint. Writer threads stand for the backup processes of a disk.
+# Merges: the dirty and to_be_deleted files of the jobs that complete in
+# one poll of the scheduler, written per job with write(), and added and
+# flushed once per poll as markForCopy and waitForProcessSlot do.
+# Every journal is checked to hold every path once.
+# Usage: bench_journal.py [backups] [files_per_backup] [writers] [jobs] [jobs_per_poll]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+import util
+from journal import JournalWriter
+
+def append_commands(filename, data):
+    lockname = "%s.lock" %filename
+    for fl in (lockname, filename):
+        if not os.path.exists(fl):
+            os.system("touch %s && chown storageserver.storageserver %s 2>/dev/null" %(fl, fl))
+    lock = open(lockname, 'w')
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    f = open(filename, 'aw')
+    for d in data:
+        f.write("%s\n" %d)
+    os.system("chown storageserver.storageserver %s 2>/dev/null" %filename)
+    f.close()
+    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    lock.close()
+
+def backup_files(backup, files):
+    paths = ["/data_1/primary/vb_group_0/vb_%d/vbid_%d_last_cpoint" %(backup, backup)]
+    for i in range(files):
+        paths.append("/data_1/primary/vb_group_0/vb_%d/incremental/backup-%05d.mbb" %(backup, i))
+    paths.append("/data_1/primary/vb_group_0/vb_%d/incremental/backup.split" %backup)
+    return paths
+
+def job_files(job, files):
+    base = "/data_1/primary/vb_group_0/vb_%d/daily/2013-07-01" %job
+    dirty = map(lambda x: "%s/backup-%05d.mbb" %(base, x), range(files))
+    dirty += ["%s/backup.split" %base, "%s/done" %base]
+    deleted = map(lambda x: "/data_1/primary/vb_group_0/vb_%d/incremental/backup-%05d.mbb" %(job, x), range(files))
+    return dirty, deleted
+
+def run(filename, backups, files, writers, add):
+    def writer(n):
+        for backup in range(n, backups, writers):
+            add(backup_files(backup, files))
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def run_merges(directory, name, jobs, files, per_poll):
+    dirty = JournalWriter(os.path.join(directory, "dirty-%s" %name), 3600)
+    deleted = JournalWriter(os.path.join(directory, "to_be_deleted-%s" %name), 3600)
+    for job in range(jobs):
+        dirty_files, deleted_files = job_files(job, files)
+        if name == "write":
+            assert dirty.write(dirty_files) and deleted.write(deleted_files)
+        else:
+            dirty.add(dirty_files)
+            deleted.add(deleted_files)
+            if (job + 1) % per_poll == 0:
+                assert dirty.flush() and deleted.flush()
+    assert dirty.flush() and deleted.flush()
+    for writer, count in ((dirty, files + 2), (deleted, files)):
+        entries = open(writer.filename).read().split()
+        assert len(entries) == len(set(entries)) == jobs * count
+    return dirty.flushes + deleted.flushes
+
+
+if __name__ == '__main__':
+    backups = 2000
+    files = 4
+    writers = 4
+    jobs = 500
+    per_poll = 4
+    if len(sys.argv) > 1:
+        backups = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        files = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        writers = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        jobs = int(sys.argv[4])
+    if len(sys.argv) > 5:
+        per_poll = int(sys.argv[5])
+
+    directory = tempfile.mkdtemp()
+    for name in ("commands", "appendToFile_Locked", "JournalWriter.write"):
+        filename = os.path.join(directory, "dirty-%s" %name)
+        start = time.time()
+        if name == "commands":
+            run(filename, backups, files, writers, lambda x: append_commands(filename, x))
+        elif name == "appendToFile_Locked":
+            run(filename, backups, files, writers, lambda x: util.appendToFile_Locked(filename, x))
+        else:
+            writer = JournalWriter(filename)
+            run(filename, backups, files, writers, writer.write)
+        elapsed = time.time() - start
+
+        entries = open(filename).read().split()
+        assert len(entries) == len(set(entries)) == backups * (files + 2)
+        print "backups %-20s %6d backups %6d appends %8.3f sec" %(name, backups, backups, elapsed)
+
+    for name in ("write", "add"):
+        start = time.time()
+        appends = run_merges(directory, name, jobs, files, per_poll)
+        elapsed = time.time() - start
+        print "merges  %-20s %6d jobs    %6d appends %8.3f sec" %("JournalWriter." + name, jobs, appends, elapsed)
+
+    shutil.rmtree(directory)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: time and peak RSS of merge-incremental vs the streaming merge
+# Usage: bench_merge_engines.py [directory] [file_count] [keys_per_file] [value_size]
+# merge-incremental is skipped when consts.PATH_MBMERGE_EXEC is not installed
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import glob
+import shutil
+import resource
+import tempfile
+import subprocess
+import consts
+import backuplib
+import mergelib
+
+class NullLogger:
+    def log(self, msg):
+        pass
+
+def create_inputs(directory, file_count, keys_per_file, value_size):
+    files = []
+    val = 'v' * value_size
+    for n in xrange(file_count):
+        path = os.path.join(directory, "input-%03d.mbb" %n)
+        db = backuplib.create_backup_db(path, 4096, True, False)
+        db.execute("INSERT INTO cpoint_state VALUES (0, ?, ?, 'closed', 'backup', '')", (n + 1, n))
+        writer = backuplib.SplitWriter(db, 4096 * 1024 * 1024)
+        for i in xrange(keys_per_file):
+            # Half of the keys of each file are overwritten by the next file
+            key = "key_%010d" %((n * keys_per_file / 2 + i) * 2654435761 % (1 << 32))
+            writer.add((0, n + 1, i, 'm', key, 0, 0, i, '', buffer(val)), len(key) + len(val))
+        writer.commit()
+        writer.close()
+        db.execute("CREATE INDEX K ON cpoint_op(vbucket_id, key)")
+        db.commit()
+        db.close()
+        files.insert(0, path)
+    return files
+
+def run_engine(engine, files, directory):
+    output = os.path.join(directory, "output-%s-%%.mbb" %engine)
+    buffer_path = os.path.join(directory, "buffer")
+    if engine == 'streaming':
+        args = [sys.executable, sys.argv[0], '--child', output, buffer_path] + files
+    else:
+        list_file = os.path.join(directory, "inputs")
+        f = open(list_file, 'w')
+        f.write("\n".join(files) + "\n")
+        f.close()
+        args = [consts.PATH_MBMERGE_EXEC, '-o', output, '-i', list_file, '-s',
+                str(consts.SPLIT_SIZE), '-b', buffer_path + '/', '-v']
+    start = time.time()
+    status = subprocess.Popen(args, stdout=open(os.devnull, 'w')).wait()
+    elapsed = time.time() - start
+    for path in glob.glob(output.replace('%', '*')):
+        os.unlink(path)
+    return status, elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        sys.exit(mergelib.merge_files(sys.argv[4:], sys.argv[2], consts.SPLIT_SIZE,
+                    sys.argv[3], True, NullLogger()))
+
+    directory = tempfile.gettempdir()
+    file_count = 8
+    keys_per_file = 100000
+    value_size = 256
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    if len(sys.argv) > 2:
+        file_count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        keys_per_file = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        value_size = int(sys.argv[4])
+
+    directory = tempfile.mkdtemp(dir=directory)
+    try:
+        files = create_inputs(directory, file_count, keys_per_file, value_size)
+        for engine in ('merge-incremental', 'streaming'):
+            if engine != 'streaming' and not os.access(consts.PATH_MBMERGE_EXEC, os.X_OK):
+                print "%-18s skipped, %s not found" %(engine, consts.PATH_MBMERGE_EXEC)
+                continue
+            rss_before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            status, elapsed = run_engine(engine, files, directory)
+            rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            # ru_maxrss of children is a high-water mark, only a new peak shows up
+            print "%-18s status %d %8.2f sec  peak rss %8d KB%s" %(engine, status, elapsed,
+                    rss, ['', ' (not above previous run)'][rss == rss_before])
+    finally:
+        shutil.rmtree(directory)
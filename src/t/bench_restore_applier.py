@@ -0,0 +1,122 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: restoring backup files with a process per file sending one add
+# per key vs the in-process RestoreApplier (pipelined quiet adds over one
+# connection), with and without key dedup. hot_fraction of the keys of every
+# file are rewritten in every file of the chain. Each run uses its own keys.
+# Needs a running server.
+# Usage: bench_restore_applier.py [host:port] [files] [keys_per_file] [value_size] [hot_fraction]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import tempfile
+import subprocess
+import backuplib
+from mc_bin_client import MemcachedClient, MemcachedError
+from restorelib import RestoreApplier
+
+VBUCKET = 0
+
+class NullLogger:
+    def log(self, msg):
+        pass
+
+def create_file(path, prefix, file_no, keys, value_size, hot_fraction):
+    db = backuplib.create_backup_db(path, 4096, True, False)
+    writer = backuplib.SplitWriter(db, 4096 * 1024 * 1024)
+    val = 'v' * value_size
+    hot_keys = int(keys * hot_fraction)
+    for i in xrange(keys):
+        if i < hot_keys:
+            key = "%s_hot_%010d" %(prefix, i)
+        else:
+            key = "%s_%d_%010d" %(prefix, file_no, i)
+        writer.add((VBUCKET, 1, i, 'm', key, 0, 0, i, None, buffer(val)), len(key) + len(val))
+    writer.commit()
+    writer.close()
+    db.close()
+
+def apply_file_per_key(path, host, port):
+    mc = MemcachedClient(host, port)
+    mc.vbucketId = VBUCKET
+    db = backuplib.sqlite3.connect(path)
+    db.text_factory = str
+    for key, flg, exp, val in db.execute("SELECT key, flg, exp, val FROM cpoint_op ORDER BY rowid DESC"):
+        try:
+            mc.add(key, exp, flg, str(val))
+        except MemcachedError:
+            pass
+    db.close()
+    mc.close()
+
+def run_process_per_file(files, host, port):
+    for path in files:
+        subprocess.check_call([sys.executable, sys.argv[0], '--child', path, host, str(port)])
+
+def run_applier(files, host, port, dedup=False):
+    applier = RestoreApplier(host, port, NullLogger(), dedup=dedup)
+    for i, path in enumerate(files):
+        applier.apply(path, i == len(files) - 1)
+    applier.close()
+
+def run_applier_dedup(files, host, port):
+    run_applier(files, host, port, True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        apply_file_per_key(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit(0)
+
+    host, port = "127.0.0.1", 11211
+    count = 10
+    keys = 20000
+    value_size = 256
+    hot_fraction = 0.5
+    if len(sys.argv) > 1:
+        host, port = sys.argv[1].split(':')
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        keys = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        value_size = int(sys.argv[4])
+    if len(sys.argv) > 5:
+        hot_fraction = float(sys.argv[5])
+    port = int(port)
+
+    directory = tempfile.mkdtemp()
+    prefix = "bench_restore_%d" %int(time.time())
+    for name, run in (("process per file", run_process_per_file), ("RestoreApplier", run_applier),
+            ("RestoreApplier dedup", run_applier_dedup)):
+        files = []
+        for i in range(count):
+            path = os.path.join(directory, "backup-%05d.mbb" %i)
+            create_file(path, "%s_%s" %(prefix, name.replace(' ', '_')), i, keys, value_size, hot_fraction)
+            files.append(path)
+
+        start = time.time()
+        run(files, host, port)
+        elapsed = time.time() - start
+        print "%-20s %4d files %8d keys %8.2f sec %10d keys/sec" %(name, count,
+                count * keys, elapsed, count * keys / elapsed)
+
+        for path in files:
+            os.unlink(path)
+    os.rmdir(directory)
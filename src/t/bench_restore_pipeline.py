@@ -0,0 +1,120 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: download to restore handoff of zbase-restore, polling the
+# restore queue every second vs the ReorderBuffer, with simulated download
+# and restore times (seconds per file, +-50% jitter).
+# Usage: bench_restore_pipeline.py [files] [buffers] [download_time] [restore_time]
+
+import sys
+sys.path.insert(0,'../')
+import time
+import random
+import Queue
+import threading
+from restorelib import ReorderBuffer
+
+POLL_INTERVAL = 1
+
+def jitter(t):
+    return t * random.uniform(0.5, 1.5)
+
+def run_polling(files, buffers, download_time, restore_time):
+    download_queue = Queue.Queue()
+    free_buffers = Queue.Queue()
+    restore_queue = Queue.Queue()
+    for i in range(files):
+        download_queue.put(i)
+    for i in range(buffers):
+        free_buffers.put(i)
+
+    def download():
+        while True:
+            shard = download_queue.get()
+            b = free_buffers.get()
+            time.sleep(jitter(download_time))
+            restore_queue.put((shard, b))
+
+    for i in range(buffers):
+        t = threading.Thread(target=download)
+        t.setDaemon(True)
+        t.start()
+
+    shard = 0
+    while shard < files:
+        restore_list = list(restore_queue.queue)
+        restore_list.sort()
+        if len(restore_list) > 0 and shard == restore_list[0][0]:
+            restore_queue.queue.remove(restore_list[0])
+            time.sleep(jitter(restore_time))
+            free_buffers.put(restore_list[0][1])
+            shard += 1
+        time.sleep(POLL_INTERVAL)
+    return buffers
+
+def run_reorder(files, buffers, download_time, restore_time):
+    download_queue = Queue.Queue()
+    free_buffers = Queue.Queue()
+    restore_queue = ReorderBuffer(buffers)
+    for i in range(files):
+        download_queue.put(i)
+    for i in range(buffers):
+        free_buffers.put(i)
+
+    def download():
+        while True:
+            shard = download_queue.get()
+            restore_queue.reserve(shard)
+            b = free_buffers.get()
+            start = time.time()
+            time.sleep(jitter(download_time))
+            restore_queue.put(shard, b, time.time() - start)
+
+    for i in range(buffers):
+        t = threading.Thread(target=download)
+        t.setDaemon(True)
+        t.start()
+
+    for shard in range(files):
+        b = restore_queue.get()
+        start = time.time()
+        time.sleep(jitter(restore_time))
+        free_buffers.put(b)
+        window = restore_queue.done(time.time() - start)
+    return window
+
+
+if __name__ == '__main__':
+    files = 20
+    buffers = 4
+    download_time = 0.5
+    restore_time = 1.0
+    if len(sys.argv) > 1:
+        files = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        buffers = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        download_time = float(sys.argv[3])
+    if len(sys.argv) > 4:
+        restore_time = float(sys.argv[4])
+
+    for name, run in (("polling", run_polling), ("reorder buffer", run_reorder)):
+        random.seed(1)
+        start = time.time()
+        window = run(files, buffers, download_time, restore_time)
+        elapsed = time.time() - start
+        print "%-16s %4d files %8.2f sec %6.2f sec/file  window %d" %(name, files,
+                elapsed, elapsed / files, window)
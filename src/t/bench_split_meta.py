@@ -0,0 +1,76 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: reading the checkpoints of backup splits from the files with
+# sqlite vs from their metadata sidecars, as the health check and catalog do.
+# Usage: bench_split_meta.py [files] [keys_per_file] [checkpoints_per_file]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import shutil
+import tempfile
+import backuplib
+import util
+
+def create_file(path, keys, checkpoints):
+    db = backuplib.create_backup_db(path, 4096, True, True)
+    for i in range(checkpoints):
+        db.execute("INSERT into cpoint_state VALUES (0, ?, -1, 'closed', 'bench', '')", (i + 1,))
+    writer = backuplib.SplitWriter(db, 4096 * 1024 * 1024)
+    val = 'v' * 256
+    for i in xrange(keys):
+        key = "bench_%010d" %i
+        writer.add((0, checkpoints, i, 'm', key, 0, 0, i, None, buffer(val)), len(key) + len(val))
+    writer.commit()
+    writer.close()
+    db.close()
+
+def run(files):
+    start = time.time()
+    for path in files:
+        util.get_checkpoints_frombackup(path)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    count = 1000
+    keys = 2000
+    checkpoints = 10
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        keys = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        checkpoints = int(sys.argv[3])
+
+    directory = tempfile.mkdtemp()
+    files = []
+    for i in range(count):
+        path = os.path.join(directory, "backup-%05d.mbb" %i)
+        create_file(path, keys, checkpoints)
+        files.append(path)
+
+    elapsed = run(files)
+    print "%-10s %6d files %8.3f sec %8.3f ms/file" %("sqlite", count, elapsed, elapsed * 1000 / count)
+
+    for path in files:
+        util.write_split_meta(path)
+    elapsed = run(files)
+    print "%-10s %6d files %8.3f sec %8.3f ms/file" %("sidecar", count, elapsed, elapsed * 1000 / count)
+
+    shutil.rmtree(directory)
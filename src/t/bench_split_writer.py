@@ -0,0 +1,105 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: mutations written to a backup split per row, as the backup
+# loop did (execute() per mutation, kept in op_records for a replay, commit
+# every txn_size), vs batched by SplitWriter, with the (vbucket_id, key)
+# primary key and with the deferred index (backup deferred_index).
+# Usage: bench_split_writer.py [directory] [record_count] [distinct_keys] [value_size]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import tempfile
+import backuplib
+
+def mutations(count, distinct_keys, value_size):
+    val = buffer('v' * value_size)
+    for i in xrange(count):
+        # Spread keys the way hashed keys arrive, not in index order
+        key = "key_%010d" %((i * 2654435761) % distinct_keys)
+        yield (0, 1, i, 'm', key, 0, 0, i, '', val)
+
+def write_per_row(db, records):
+    c = db.cursor()
+    op_records = []
+    update_count = 0
+    for record in records:
+        op_records.append(record)
+        backuplib.add_record(c, backuplib.tap_stmt, record)
+        update_count += 1
+        if update_count == backuplib.TXN_SIZE:
+            db.commit()
+            update_count = 0
+            op_records = []
+    db.commit()
+    c.close()
+
+def write_batched(db, records, deferred_index):
+    writer = backuplib.SplitWriter(db, 4096 * 1024 * 1024)
+    for record in records:
+        reserve = 0
+        if deferred_index:
+            reserve = len(record[4]) + backuplib.INDEX_RECORD_OVERHEAD
+        writer.add(record, len(record[4]) + len(record[9]) + backuplib.RECORD_OVERHEAD, reserve)
+    writer.commit()
+    writer.close()
+
+def write_split(directory, batched, deferred_index, count, distinct_keys, value_size):
+    fd, path = tempfile.mkstemp(suffix='.mbb', dir=directory)
+    os.close(fd)
+    os.unlink(path)
+    records = mutations(count, distinct_keys, value_size)
+    start = time.time()
+    db = backuplib.create_backup_db(path, 4096, True, True, deferred_index=deferred_index)
+    if batched:
+        write_batched(db, records, deferred_index)
+    else:
+        write_per_row(db, records)
+    if deferred_index:
+        backuplib.seal_backup_db(db)
+    elapsed = time.time() - start
+    rows = db.execute("SELECT count(*) FROM cpoint_op").fetchone()[0]
+    db.close()
+    os.unlink(path)
+    return rows, elapsed
+
+
+if __name__ == '__main__':
+    directory = tempfile.gettempdir()
+    count = 500000
+    distinct_keys = 250000
+    value_size = 256
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        distinct_keys = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        value_size = int(sys.argv[4])
+
+    baseline = None
+    for name, batched, deferred_index in (("per row", False, False),
+            ("SplitWriter", True, False), ("per row, deferred", False, True),
+            ("SplitWriter, deferred", True, True)):
+        rows, elapsed = write_split(directory, batched, deferred_index,
+                count, distinct_keys, value_size)
+        if baseline == None:
+            baseline = elapsed
+        print "%-22s %8d rows %8.2f sec %8d mutations/sec  x%.2f" %(name, rows,
+                elapsed, count / elapsed, baseline / elapsed)
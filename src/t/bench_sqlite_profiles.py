@@ -0,0 +1,96 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: write throughput and fsync count of each sqlite write profile
+# Usage: bench_sqlite_profiles.py [directory] [record_count] [value_size]
+# fsync counts are collected with strace -c when it is available
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import tempfile
+import subprocess
+import util
+import backuplib
+
+
+def write_backup(profile, directory, count, value_size):
+    fd, path = tempfile.mkstemp(suffix='.mbb', dir=directory)
+    os.close(fd)
+    os.unlink(path)
+    val = 'v' * value_size
+    start = time.time()
+    db = backuplib.create_backup_db(path, 4096, True, False, profile)
+    writer = backuplib.SplitWriter(db, 4096 * 1024 * 1024)
+    for i in xrange(count):
+        key = "key_%010d" %i
+        writer.add((0, 1, i, 'm', key, 0, 0, i, None, buffer(val)), len(key) + len(val))
+    writer.commit()
+    writer.close()
+    db.close()
+    elapsed = time.time() - start
+    size = os.path.getsize(path)
+    os.unlink(path)
+    return size / elapsed / 1024 / 1024
+
+def find_strace():
+    for d in os.environ.get('PATH', '').split(':'):
+        if os.access(os.path.join(d, 'strace'), os.X_OK):
+            return os.path.join(d, 'strace')
+    return None
+
+def run_profile(strace, profile, directory, count, value_size):
+    args = [sys.executable, sys.argv[0], '--child', profile, directory,
+            str(count), str(value_size)]
+    if not strace:
+        out = subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
+        return float(out), None
+
+    fd, trace_file = tempfile.mkstemp()
+    os.close(fd)
+    out = subprocess.Popen([strace, '-f', '-c', '-e', 'trace=fsync,fdatasync',
+        '-o', trace_file] + args, stdout=subprocess.PIPE).communicate()[0]
+    syncs = 0
+    for line in open(trace_file):
+        fields = line.split()
+        if len(fields) >= 5 and fields[-1] in ('fsync', 'fdatasync'):
+            syncs += int(fields[3])
+    os.unlink(trace_file)
+    return float(out), syncs
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print write_backup(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+        sys.exit(0)
+
+    directory = tempfile.gettempdir()
+    count = 200000
+    value_size = 256
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        value_size = int(sys.argv[3])
+
+    strace = find_strace()
+    for profile in sorted(util.SQLITE_WRITE_PROFILES.keys()):
+        mbps, syncs = run_profile(strace, profile, directory, count, value_size)
+        if syncs is None:
+            syncs = 'n/a'
+        print "%-20s %8.2f MB/sec %8s fsyncs" %(profile, mbps, syncs)
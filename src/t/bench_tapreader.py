@@ -0,0 +1,81 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Micro-benchmark: readTap() vs TapStreamReader over a socketpair
+# Usage: bench_tapreader.py [mutation_count] [value_size]
+
+import sys
+sys.path.insert(0,'../')
+import time
+import socket
+import struct
+import threading
+import memcacheConstants
+import mc_bin_client
+from backuplib import readTap, TapStreamReader
+
+
+def make_stream(count, value_size):
+    ext = struct.pack(memcacheConstants.TAP_MUTATION_PKT_FMT, 0, 0, 0, 0, 0, 0) + '\0' * 8
+    frames = []
+    for i in xrange(count):
+        key = "key_%010d" %i
+        val = 'v' * value_size
+        frames.append(struct.pack(memcacheConstants.REQ_PKT_FMT,
+            memcacheConstants.REQ_MAGIC_BYTE, memcacheConstants.CMD_TAP_MUTATION,
+            len(key), len(ext), 0, 0, len(ext) + len(key) + len(val), i, 0) + ext + key + val)
+    return ''.join(frames)
+
+def feed(sock, data):
+    sock.sendall(data)
+    sock.close()
+
+def run(name, stream, count, reader_factory):
+    rsock, wsock = socket.socketpair()
+    t = threading.Thread(target=feed, args=(wsock, stream))
+    t.start()
+    read = reader_factory(rsock)
+    nbytes = 0
+    start = time.time()
+    for i in xrange(count):
+        cmd, opaque, cas, vbucketId, key, ext, val = read()
+        nbytes += len(val)
+    elapsed = time.time() - start
+    t.join()
+    rsock.close()
+    print "%-16s %8d msgs/sec %8.2f MB/sec" %(name, count / elapsed,
+            len(stream) / elapsed / 1024 / 1024)
+
+def readtap_factory(sock):
+    mc = mc_bin_client.MemcachedClient.__new__(mc_bin_client.MemcachedClient)
+    mc.s = sock
+    return lambda: readTap(mc)
+
+def streamreader_factory(sock):
+    return TapStreamReader(sock).read
+
+
+if __name__ == '__main__':
+    count = 200000
+    value_size = 256
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        value_size = int(sys.argv[2])
+
+    stream = make_stream(count, value_size)
+    run("readTap", stream, count, readtap_factory)
+    run("TapStreamReader", stream, count, streamreader_factory)
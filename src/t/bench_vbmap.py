@@ -0,0 +1,99 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Benchmark: the VBS thread handling a vbucket map, parsed into a new dict
+# on every poll vs updated in place in the shared VBucketMap, and a backup
+# process looking up the current server of its vbuckets through a manager
+# dict (IPC) vs reading the shared map.
+# Usage: bench_vbmap.py [vbuckets] [servers] [moved_vbuckets]
+
+import sys
+sys.path.insert(0,'../')
+import os
+import time
+import json
+import multiprocessing
+from vbmap import VBucketMap
+
+def vbs_config(vbuckets, servers, moved):
+    server_list = ["10.0.%d.%d:11211" %(i / 256, i % 256) for i in range(servers)]
+    vb_list = []
+    for vb_id in range(vbuckets):
+        active = vb_id % servers
+        if vb_id < moved:
+            active = (active + 1) % servers
+        vb_list.append([active, (active + 1) % servers])
+    return json.dumps([{'vBucketServerMap': {'vBucketMap': vb_list, 'serverList': server_list}}])
+
+def parse(vbs_map_string):
+    server_config = json.loads(vbs_map_string)[0]['vBucketServerMap']
+    server_list = server_config['serverList']
+    return [server_list[x[1]] for x in server_config['vBucketMap']]
+
+def dict_poll(vbs_map_string):
+    vb_servers = parse(vbs_map_string)
+    return dict((vb_id, server) for vb_id, server in enumerate(vb_servers))
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def lookup_all(lookup, vbuckets):
+    for vb_id in xrange(vbuckets):
+        lookup(vb_id)
+
+def child(name, lookup, vbuckets, results):
+    elapsed, result = timed(lookup_all, lookup, vbuckets)
+    results.put((name, elapsed))
+
+
+if __name__ == '__main__':
+    vbuckets = 16384
+    servers = 64
+    moved = 16
+    if len(sys.argv) > 1:
+        vbuckets = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        servers = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        moved = int(sys.argv[3])
+
+    before = vbs_config(vbuckets, servers, 0)
+    after = vbs_config(vbuckets, servers, moved)
+    vbmap = VBucketMap(max_vbuckets=vbuckets)
+    vbmap.update_servers(parse(before))
+    print "%d vbuckets, %d servers, %d moved, map of %d bytes" %(vbuckets, servers, moved, len(before))
+
+    elapsed, result = timed(dict_poll, before)
+    print "%-28s %8.3f ms" %("poll, dict", elapsed * 1000)
+    elapsed, result = timed(lambda x: x == before, before)
+    print "%-28s %8.3f ms" %("poll unchanged, shared map", elapsed * 1000)
+    elapsed, result = timed(lambda x: vbmap.update_servers(parse(x)), after)
+    assert result == moved
+    print "%-28s %8.3f ms  %d vbuckets written" %("poll moved, shared map", elapsed * 1000, result)
+    assert vbmap.get_servers() == dict_poll(after)
+
+    manager = multiprocessing.Manager()
+    shared_dict = manager.dict(dict_poll(after))
+    results = multiprocessing.Queue()
+    for name, lookup in (("lookups, manager dict", shared_dict.get), ("lookups, shared map", vbmap.lookup)):
+        p = multiprocessing.Process(target=child, args=(name, lookup, vbuckets, results))
+        p.start()
+        p.join()
+        name, elapsed = results.get()
+        print "%-28s %8.3f ms  %8.2f us/lookup" %(name, elapsed * 1000, elapsed * 1000000 / vbuckets)
+    manager.shutdown()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Catalog.plan checked against the rules zbase-restore lists the backup
+# directories of a vbucket with, when the storage server has no catalog.
+# Usage: py.test test_catalog.py
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import sqlite3
+import pytest
+import consts
+import catalog
+from catalog import Catalog, CatalogError, split_index_name, epoch2date, DAY_EPOCH
+from util import natural_sortkey
+
+NOW = time.time()
+
+def write_split(dirname, name, checkpoint, files=2):
+    """
+    Backup files name-0000n.mbb holding one checkpoint and their split index
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    names = []
+    for i in range(1, files + 1):
+        path = os.path.join(dirname, "%s-%05d.mbb" %(name, i))
+        db = sqlite3.connect(path)
+        db.execute("create table cpoint_state (vbucket_id, cpoint_id)")
+        db.execute("create table cpoint_op (vbucket_id, key)")
+        db.execute("insert into cpoint_state values (0, ?)", (checkpoint,))
+        db.execute("insert into cpoint_op values (0, ?)", ("key-%d" %i,))
+        db.commit()
+        db.close()
+        names.append(os.path.basename(path))
+    f = open(os.path.join(dirname, "%s.split" %name), 'w')
+    f.write("\n".join(names) + "\n")
+    f.close()
+    return names
+
+def touch(path):
+    open(path, 'w').close()
+
+def list_backups(vb_path, subdir, complete=True):
+    """
+    Backup files of a directory as Restore._list_s3_files lists them, with
+    the split verification of Restore.verify_split_index
+    """
+    dirname = os.path.join(vb_path, subdir)
+    if not os.path.isdir(dirname):
+        return []
+    names = os.listdir(dirname)
+    if not complete and not "done" in names:
+        return []
+
+    excluded = set()
+    if consts.DEL_MANIFEST in names:
+        lines = open(os.path.join(dirname, consts.DEL_MANIFEST)).readlines()
+        excluded = set(map(lambda x: os.path.basename(x.strip()), lines))
+    files = filter(lambda x: x.endswith(".mbb") and not x in excluded, names)
+
+    indexes = set(filter(lambda x: x.endswith(".split"), names)) - set(map(split_index_name, excluded))
+    listed = []
+    for index in indexes:
+        listed.extend(open(os.path.join(dirname, index)).read().split())
+    if sorted(listed) != sorted(files):
+        raise ValueError("split verification failed in %s" %dirname)
+    return map(lambda x: os.path.join(subdir, x), files)
+
+def walk(vb_path, now=NOW):
+    """
+    Restore.fetch_backuplist over a local vbucket directory
+    """
+    incremental = list_backups(vb_path, consts.INCR_DIRNAME)
+
+    master = []
+    master_epoch = now
+    for attempt in xrange(consts.MAX_BACKUP_SEARCH_TRIES):
+        master = list_backups(vb_path, os.path.join(consts.MASTER_DIRNAME, epoch2date(master_epoch)), False)
+        if len(master):
+            master_epoch += DAY_EPOCH
+            break
+        master_epoch -= DAY_EPOCH
+
+    periodic = []
+    for date_epoch in xrange(int(master_epoch), int(now) + DAY_EPOCH, DAY_EPOCH):
+        periodic.extend(list_backups(vb_path, os.path.join(consts.PERIODIC_DIRNAME, epoch2date(date_epoch)), False))
+
+    plan = {}
+    for name, files in (('incremental', incremental), ('periodic', periodic), ('master', master)):
+        files.sort(key=natural_sortkey)
+        files.reverse()
+        plan[name] = files
+    return plan
+
+def plan_paths(vb_path, now=NOW):
+    plan = Catalog(vb_path).plan(now)
+    result = {}
+    for name, files in plan.items():
+        result[name] = map(lambda x: x[0], files)
+    return result
+
+def day(days_ago):
+    return epoch2date(NOW - days_ago * DAY_EPOCH)
+
+def build_tree(vb_path):
+    incr = os.path.join(vb_path, consts.INCR_DIRNAME)
+    write_split(incr, "backup-2013-07-01_10:00:00", 10)
+    merged = write_split(incr, "backup-2013-07-01_11:00:00", 11)
+    write_split(incr, "backup-2013-07-01_12:00:00", 12, 3)
+    f = open(os.path.join(incr, consts.DEL_MANIFEST), 'w')
+    f.write("\n".join(map(lambda x: os.path.join(incr, x), merged)) + "\n")
+    f.close()
+
+    # The newest master has no done file, the search goes on to the next
+    write_split(os.path.join(vb_path, consts.MASTER_DIRNAME, day(1)), "backup-2013-06-30_00:00:00", 8)
+    master = os.path.join(vb_path, consts.MASTER_DIRNAME, day(3))
+    write_split(master, "backup-2013-06-28_00:00:00", 5, 3)
+    touch(os.path.join(master, "done"))
+
+    for days_ago in (4, 2, 1, 0):
+        daily = os.path.join(vb_path, consts.PERIODIC_DIRNAME, day(days_ago))
+        write_split(daily, "backup-2013-06-%02d_00:00:00" %(30 - days_ago), 6 + days_ago)
+        if days_ago != 0:
+            touch(os.path.join(daily, "done"))
+
+def test_plan_matches_listing(tmpdir):
+    vb_path = str(tmpdir)
+    build_tree(vb_path)
+
+    expected = walk(vb_path)
+    assert len(expected['incremental']) == 5
+    assert len(expected['master']) == 3
+    assert len(expected['periodic']) == 4
+    assert plan_paths(vb_path) == expected
+    # Again from the records of the catalog
+    assert os.path.exists(catalog.catalog_path(vb_path))
+    assert plan_paths(vb_path) == expected
+
+def test_plan_follows_changes(tmpdir):
+    vb_path = str(tmpdir)
+    build_tree(vb_path)
+    plan_paths(vb_path)
+
+    # A merge removes the excluded files, a new incremental backup arrives
+    incr = os.path.join(vb_path, consts.INCR_DIRNAME)
+    for name in os.listdir(incr):
+        if name.startswith("backup-2013-07-01_11:00:00"):
+            os.unlink(os.path.join(incr, name))
+    os.unlink(os.path.join(incr, consts.DEL_MANIFEST))
+    write_split(incr, "backup-2013-07-01_13:00:00", 13)
+    # The newest master is complete now
+    touch(os.path.join(vb_path, consts.MASTER_DIRNAME, day(1), "done"))
+
+    expected = walk(vb_path)
+    assert len(expected['incremental']) == 7
+    assert len(expected['master']) == 2
+    assert plan_paths(vb_path) == expected
+
+def test_exclusion_is_per_file(tmpdir):
+    vb_path = str(tmpdir)
+    incr = os.path.join(vb_path, consts.INCR_DIRNAME)
+    write_split(incr, "backup-2013-07-01_10:00:00", 10)
+    names = write_split(incr, "backup-2013-07-01_11:00:00", 11)
+    f = open(os.path.join(incr, consts.DEL_MANIFEST), 'w')
+    f.write("%s\n" %names[0])
+    f.close()
+
+    with pytest.raises(ValueError):
+        walk(vb_path)
+    with pytest.raises(CatalogError):
+        Catalog(vb_path).plan(NOW)
+
+def test_split_index_with_missing_file(tmpdir):
+    vb_path = str(tmpdir)
+    incr = os.path.join(vb_path, consts.INCR_DIRNAME)
+    names = write_split(incr, "backup-2013-07-01_10:00:00", 10)
+    os.unlink(os.path.join(incr, names[1]))
+
+    with pytest.raises(ValueError):
+        walk(vb_path)
+    with pytest.raises(CatalogError):
+        Catalog(vb_path).plan(NOW)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# dirdiff with directory snapshots checked against diffing the find
+# listings of the tree, as it was done before the snapshots.
+# Usage: py.test test_diffdisk.py
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import diffdisk
+
+DIRNAME = "primary"
+
+class FindDiff:
+    """
+    dirdiff of the find listing of the tree against the previous one
+    """
+
+    def __init__(self, basedir):
+        self.root = os.path.join(basedir, DIRNAME)
+        self.files = []
+
+    def dirdiff(self):
+        current = diffdisk.list_files(self.root)
+        dirty, deleted = diffdisk.diff_list(self.files[:], current)
+        self.files = current
+        return dirty, sorted(deleted)
+
+def touch(path):
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    open(path, 'w').close()
+
+AGED = [0]
+
+def age(*dirs):
+    """
+    Move the mtime of directories past the slack of dirdiff, as if they were
+    last changed a while ago. Every call sets another mtime, one that a
+    snapshot of the directories cannot have seen.
+    """
+    AGED[0] += 1
+    mtime = int(time.time()) - 60 - AGED[0]
+    for path in dirs:
+        os.utime(path, (mtime, mtime))
+
+def check(basedir, find):
+    dirty, deleted = diffdisk.dirdiff(basedir, DIRNAME)
+    expected = find.dirdiff()
+    assert (dirty, sorted(deleted)) == expected
+    return expected
+
+def test_dirdiff_matches_find(tmpdir, monkeypatch):
+    basedir = str(tmpdir)
+    root = os.path.join(basedir, DIRNAME)
+    find = FindDiff(basedir)
+    listed = []
+    list_dir = diffdisk.list_dir
+    def record(path):
+        listed.append(path)
+        return list_dir(path)
+    monkeypatch.setattr(diffdisk, "list_dir", record)
+
+    vb = os.path.join(root, "0", "vb_1")
+    incr = os.path.join(vb, "incremental")
+    daily = os.path.join(vb, "daily", "2013-07-01")
+    touch(os.path.join(incr, "backup-2013-07-01_10:00:00-00001.mbb"))
+    touch(os.path.join(incr, "backup-2013-07-01_10:00:00.split"))
+    touch(os.path.join(incr, "backup-2013-07-01_10:00:00-00001.mbb.meta"))
+    touch(os.path.join(daily, "backup-2013-07-01_00:00:00-00001.mbb"))
+    touch(os.path.join(daily, "backup-2013-07-01_00:00:00.split"))
+    touch(os.path.join(daily, "done"))
+    all_dirs = [root, os.path.join(root, "0"), vb, incr, os.path.dirname(daily), daily]
+    age(*all_dirs)
+    dirty, deleted = check(basedir, find)
+    assert len(dirty) == 5
+    assert dirty[-1].endswith("done")
+    assert sorted(listed) == sorted(all_dirs)
+
+    # Nothing changed, every directory is taken from the snapshot
+    listed[:] = []
+    assert check(basedir, find) == ([], [])
+    assert listed == []
+
+    # A new backup and a manifest.del in an old directory
+    touch(os.path.join(incr, "backup-2013-07-01_11:00:00-00001.mbb"))
+    touch(os.path.join(incr, "backup-2013-07-01_11:00:00.split"))
+    touch(os.path.join(incr, "manifest.del"))
+    age(incr)
+    dirty, deleted = check(basedir, find)
+    assert len(dirty) == 3
+    assert dirty[-1].endswith("manifest.del")
+    assert listed == [incr]
+
+    # manifest.del is always copied again
+    dirty, deleted = check(basedir, find)
+    assert map(os.path.basename, dirty) == ["manifest.del"]
+
+    # The merged files and the manifest.del are removed, a vbucket is added
+    # and is not aged: a directory changed within the slack is listed again
+    os.unlink(os.path.join(incr, "backup-2013-07-01_10:00:00-00001.mbb"))
+    os.unlink(os.path.join(incr, "backup-2013-07-01_10:00:00.split"))
+    os.unlink(os.path.join(incr, "manifest.del"))
+    age(incr)
+    touch(os.path.join(root, "0", "vb_2", "incremental", "backup-2013-07-01_12:00:00-00001.mbb"))
+    dirty, deleted = check(basedir, find)
+    assert len(dirty) == 1
+    assert len(deleted) == 2
+    touch(os.path.join(root, "0", "vb_2", "incremental", "backup-2013-07-01_13:00:00-00001.mbb"))
+    dirty, deleted = check(basedir, find)
+    assert len(dirty) == 1
+
+    # A whole directory goes away
+    for name in os.listdir(daily):
+        os.unlink(os.path.join(daily, name))
+    os.rmdir(daily)
+    age(os.path.dirname(daily))
+    dirty, deleted = check(basedir, find)
+    assert dirty == []
+    assert len(deleted) == 3
+
+def test_dirdiff_from_file_list(tmpdir):
+    basedir = str(tmpdir)
+    root = os.path.join(basedir, DIRNAME)
+    find = FindDiff(basedir)
+
+    incr = os.path.join(root, "0", "vb_1", "incremental")
+    touch(os.path.join(incr, "backup-2013-07-01_10:00:00-00001.mbb"))
+    touch(os.path.join(incr, "backup-2013-07-01_10:00:00.split"))
+    find.dirdiff()
+    # The manifest of the find based dirdiff, read once and replaced
+    diffdisk.write_list(os.path.join(basedir, ".diffdata"), find.files)
+
+    os.unlink(os.path.join(incr, "backup-2013-07-01_10:00:00.split"))
+    touch(os.path.join(incr, "backup-2013-07-01_11:00:00-00001.mbb"))
+    dirty, deleted = check(basedir, find)
+    assert len(dirty) == 1
+    assert len(deleted) == 1
+    assert isinstance(diffdisk.read_snapshot(os.path.join(basedir, ".diffdata")), dict)
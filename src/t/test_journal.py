@@ -0,0 +1,137 @@
+#!/usr/bin/env python26
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# JournalWriter batching and synchronous writes, and JournalReader tailing
+# the journal by offset.
+# Usage: py.test test_journal.py
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import time
+import journal
+from journal import JournalWriter, JournalReader
+
+def read_journal(filename):
+    return open(filename).read().split('\n')[:-1]
+
+def test_add_is_batched(tmpdir):
+    filename = os.path.join(str(tmpdir), "dirty")
+    writer = JournalWriter(filename, 3600)
+    writer.add(["/data_1/a.mbb", "/data_1/b.mbb"])
+    writer.add(["/data_1/b.mbb", "/data_1/done"])
+    assert not os.path.exists(filename)
+    assert writer.has_pending()
+
+    assert writer.flush()
+    assert read_journal(filename) == ["/data_1/a.mbb", "/data_1/b.mbb", "/data_1/done"]
+    assert writer.flushes == 1
+    assert not writer.has_pending()
+    # Nothing pending, nothing appended
+    assert writer.flush()
+    assert writer.flushes == 1
+
+def test_add_is_flushed_every_interval(tmpdir):
+    filename = os.path.join(str(tmpdir), "to_be_deleted")
+    writer = JournalWriter(filename, 0.05)
+    writer.start()
+    try:
+        writer.add(["/data_1/a.mbb"])
+        for i in range(100):
+            if os.path.exists(filename):
+                break
+            time.sleep(0.01)
+        assert read_journal(filename) == ["/data_1/a.mbb"]
+    finally:
+        writer.close()
+
+def test_write_appends_with_pending(tmpdir):
+    filename = os.path.join(str(tmpdir), "dirty")
+    writer = JournalWriter(filename, 3600)
+    writer.add(["/data_1/merged.mbb"])
+    assert writer.write(["/data_1/backup.mbb", "/data_1/vbid_1_last_cpoint"])
+    assert read_journal(filename) == ["/data_1/merged.mbb", "/data_1/backup.mbb",
+            "/data_1/vbid_1_last_cpoint"]
+    assert not writer.has_pending()
+
+def test_failed_write_is_kept(tmpdir):
+    filename = os.path.join(str(tmpdir), "missing", "dirty")
+    writer = JournalWriter(filename, 3600)
+    assert not writer.write(["/data_1/a.mbb", "/data_1/b.mbb"])
+    assert writer.has_pending()
+    writer.discard(["/data_1/a.mbb"])
+
+    os.mkdir(os.path.dirname(filename))
+    assert writer.flush()
+    assert read_journal(filename) == ["/data_1/b.mbb"]
+
+def test_flush_all(tmpdir):
+    dirty = os.path.join(str(tmpdir), "dirty")
+    deleted = os.path.join(str(tmpdir), "to_be_deleted")
+    try:
+        journal.get_writer(dirty, 3600).add(["/data_1/a.mbb"])
+        journal.get_writer(deleted, 3600).add(["/data_1/old.mbb"])
+        assert journal.has_pending(dirty)
+        assert not journal.has_entries(dirty)
+        assert journal.flush_all()
+        assert not journal.has_pending(dirty)
+        assert journal.has_entries(dirty)
+        assert read_journal(deleted) == ["/data_1/old.mbb"]
+    finally:
+        for filename in (dirty, deleted):
+            journal.writers.pop(filename).close()
+
+def test_reader_tails_by_offset(tmpdir):
+    filename = os.path.join(str(tmpdir), "dirty")
+    reader = JournalReader(filename)
+    assert reader.read() == []
+
+    writer = JournalWriter(filename, 3600)
+    assert writer.write(["/data_1/a.mbb", "/data_1/b.mbb"])
+    assert reader.read() == ["/data_1/a.mbb", "/data_1/b.mbb"]
+    assert reader.read() == []
+    assert writer.write(["/data_1/c.mbb"])
+    assert reader.read() == ["/data_1/c.mbb"]
+
+    # A record that is not complete yet is left for the next read
+    f = open(filename, 'a')
+    f.write("/data_1/d.m")
+    f.flush()
+    assert reader.read() == []
+    f.write("bb\n")
+    f.close()
+    assert reader.read() == ["/data_1/d.mbb"]
+
+    # A consumer starts again from the offset it kept
+    assert JournalReader(filename, reader.offset).read() == []
+
+def test_reader_starts_over(tmpdir):
+    filename = os.path.join(str(tmpdir), "dirty")
+    writer = JournalWriter(filename, 3600)
+    reader = JournalReader(filename)
+    assert writer.write(["/data_1/a.mbb", "/data_1/b.mbb"])
+    assert len(reader.read()) == 2
+
+    # Truncated by the copy daemon once processed
+    open(filename, 'w').close()
+    assert writer.write(["/data_1/c.mbb"])
+    assert reader.read() == ["/data_1/c.mbb"]
+
+    # Replaced by a file of the same size
+    tmp_file = "%s.tmp" %filename
+    open(tmp_file, 'w').write("/data_1/e.mbb\n")
+    os.rename(tmp_file, filename)
+    assert reader.read() == ["/data_1/e.mbb"]
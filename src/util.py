@@ -21,9 +21,12 @@ import sqlite3
 import socket
 import time
 import fcntl
+import pwd
 import consts
 import subprocess
 import json
+import hashlib
+import thread
 
 tokenize = re.compile(r'(\d+)|(\D+)').findall
 def natural_sortkey(string):
@@ -36,6 +39,59 @@ def setup_sqlite_lib():
     else:
         os.environ['LD_LIBRARY_PATH'] = ld_path
 
+# Named sets of pragmas applied to sqlite files we produce. Pragmas are
+# applied in order; page_size only takes effect on a file without tables.
+SQLITE_WRITE_PROFILES = {
+    # Default durability, for files that are updated in place
+    'safe': [
+        ('page_size', 4096),
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+        ('cache_size', 2000),
+        ('locking_mode', 'NORMAL'),
+        ('temp_store', 'DEFAULT'),
+    ],
+    # Files written once by a single process and discarded on failure. The
+    # rollback journal is kept in memory so a statement that fails, e.g.
+    # with SQLITE_FULL at max_page_count, still rolls back cleanly.
+    'bulk-once': [
+        ('page_size', 8192),
+        ('journal_mode', 'MEMORY'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', 4096),
+        ('locking_mode', 'EXCLUSIVE'),
+        ('temp_store', 'MEMORY'),
+    ],
+    # bulk-once without a journal: any failed statement or rollback leaves
+    # the file corrupt. Only for writers that never hit max_page_count.
+    'bulk-once-nojournal': [
+        ('page_size', 8192),
+        ('journal_mode', 'OFF'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', 4096),
+        ('locking_mode', 'EXCLUSIVE'),
+        ('temp_store', 'MEMORY'),
+    ],
+    # Files on ramfs/tmpfs buffers where fsync buys nothing
+    'tmpfs': [
+        ('page_size', 4096),
+        ('journal_mode', 'MEMORY'),
+        ('synchronous', 'OFF'),
+        ('cache_size', 2000),
+        ('locking_mode', 'EXCLUSIVE'),
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
+def apply_sqlite_profile(db, profile):
+    """Apply the pragmas of a named write profile to an open db connection"""
+
+    if not SQLITE_WRITE_PROFILES.has_key(profile):
+        raise Exception("ERROR: unknown sqlite write profile: %s" %profile)
+
+    for pragma, value in SQLITE_WRITE_PROFILES[profile]:
+        db.execute("pragma %s=%s" %(pragma, value)).fetchall()
+
 def getcommandoutput(cmd, queue=None):
     """Return (status, output) of executing cmd in a shell."""
     """Add the process object to the queue"""
@@ -67,18 +123,158 @@ def getcommandoutput(cmd, queue=None):
     return sts, output
 
 def get_checkpoints_frombackup(backup_filepath):
+    meta = read_split_meta(backup_filepath)
+    if meta != None:
+        return expand_ranges(meta['checkpoints'])
+
     db = sqlite3.connect(backup_filepath)
     cursor = db.execute('select cpoint_id from cpoint_state')
     cpoint_list = map(lambda x: x[0], cursor.fetchall())
+    db.close()
     return sorted(cpoint_list)
 
-def create_split_db(db_file_name, max_db_size):
+def compress_ranges(values):
+    """
+    Sorted list of integers as [first, last] runs of consecutive values
+    """
+    ranges = []
+    for v in values:
+        if len(ranges) and ranges[-1][1] + 1 == v:
+            ranges[-1][1] = v
+        else:
+            ranges.append([v, v])
+    return ranges
+
+def expand_ranges(ranges):
+    values = []
+    for first, last in ranges:
+        values.extend(range(first, last + 1))
+    return values
+
+CHECKSUM_READ_SIZE = 1024 * 1024
+
+def checksum_path(filepath):
+    return filepath + consts.CHECKSUM_SUFFIX
+
+def read_checksum(filepath):
+    """
+    md5 of a file from its sidecar, None if there is none or it does not
+    belong to the current file
+    """
+    try:
+        st = os.stat(filepath)
+        digest, size, mtime = open(checksum_path(filepath)).read().split()
+        if int(size) == st.st_size and int(mtime) == int(st.st_mtime):
+            return digest
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def write_checksum(filepath):
+    """
+    Compute the md5 of a file and write it to its sidecar as
+    "digest size mtime"
+    """
+    st = os.stat(filepath)
+    md5 = hashlib.md5()
+    f = open(filepath, 'rb')
+    try:
+        while True:
+            data = f.read(CHECKSUM_READ_SIZE)
+            if data == '':
+                break
+            md5.update(data)
+    finally:
+        f.close()
+    digest = md5.hexdigest()
+
+    checksum_file = checksum_path(filepath)
+    tmp_file = "%s.%d.%d" %(checksum_file, os.getpid(), thread.get_ident())
+    f = open(tmp_file, 'w')
+    f.write("%s %d %d\n" %(digest, st.st_size, int(st.st_mtime)))
+    f.close()
+    os.rename(tmp_file, checksum_file)
+    return digest
+
+def split_meta_path(backup_filepath):
+    return backup_filepath + consts.SPLIT_META_SUFFIX
+
+def build_split_meta(backup_filepath, ops=None):
+    """
+    Metadata of a backup split read from the file: vbuckets, checkpoints,
+    op and key count, size and mtime. Every key of a split is stored once,
+    ops is the number of mutations written to it, the key count if not known.
+    """
+    # sqlite would create a missing file
+    st = os.stat(backup_filepath)
+    db = sqlite3.connect(backup_filepath)
+    try:
+        rows = db.execute('select vbucket_id, cpoint_id from cpoint_state').fetchall()
+        keys = db.execute('select count(*) from cpoint_op').fetchone()[0]
+    finally:
+        db.close()
+
+    if ops == None:
+        ops = keys
+    return {'vbuckets': sorted(set(map(lambda x: x[0], rows))),
+            'checkpoints': compress_ranges(sorted(map(lambda x: x[1], rows))),
+            'ops': ops, 'keys': keys, 'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+def write_split_meta(backup_filepath, ops=None):
+    """
+    Write the metadata sidecar of a closed backup split
+    """
+    meta = build_split_meta(backup_filepath, ops)
+    meta_file = split_meta_path(backup_filepath)
+    tmp_file = "%s.%d" %(meta_file, os.getpid())
+    f = open(tmp_file, 'w')
+    f.write(json.dumps(meta))
+    f.close()
+    os.rename(tmp_file, meta_file)
+    return meta
+
+def read_split_meta(backup_filepath):
+    """
+    Metadata sidecar of a backup split, None if there is none or it does
+    not belong to the current file
+    """
+    try:
+        meta = json.loads(open(split_meta_path(backup_filepath)).read())
+        st = os.stat(backup_filepath)
+        if meta['size'] == st.st_size and meta['mtime'] == int(st.st_mtime):
+            return meta
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def sidecar_paths(backup_filepath):
+    """
+    Metadata and checksum sidecars of a backup split, to be removed with it
+    """
+    return [split_meta_path(backup_filepath), checksum_path(backup_filepath)]
+
+def get_split_meta(backup_filepath, create=False):
+    """
+    Metadata of a backup split from its sidecar, read from the file if the
+    sidecar is missing and written out if create is set
+    """
+    meta = read_split_meta(backup_filepath)
+    if meta == None:
+        if create:
+            meta = write_split_meta(backup_filepath)
+        else:
+            meta = build_split_meta(backup_filepath)
+    return meta
+
+def create_split_db(db_file_name, max_db_size, profile=consts.SQLITE_WRITE_PROFILE):
     db = None
     max_db_size = max_db_size * 1024 * 1024 # Convert MB to bytes
 
     try:
         db = sqlite3.connect(db_file_name)
         db.text_factory = str
+        if profile:
+            apply_sqlite_profile(db, profile)
         db.executescript("""
         BEGIN;
         CREATE TABLE cpoint_op
@@ -165,27 +361,49 @@ def markBadDisk(disk_id):
 
     return appendToFile_Locked(consts.BAD_DISK_FILE, ["data_%d" %disk_id])
 
+storageserver_owner = None
+
+def open_storageserver_file(filename, flags):
+    """
+    Open a file, creating it if needed, owned by the storageserver user
+    """
+    global storageserver_owner
+    if storageserver_owner == None:
+        try:
+            pw = pwd.getpwnam('storageserver')
+            storageserver_owner = (pw.pw_uid, pw.pw_gid)
+        except KeyError:
+            storageserver_owner = (-1, -1)
+
+    fd = os.open(filename, flags | os.O_CREAT, 0666)
+    uid, gid = storageserver_owner
+    if uid != -1 and os.fstat(fd).st_uid != uid:
+        try:
+            os.fchown(fd, uid, gid)
+        except OSError:
+            pass
+    return fd
+
 def appendToFile_Locked(filename, data):
     """
     Append to a file after holding an flock
     Create the file if it does not exist
+    The lines are appended with a single write, readers never see part of them.
     """
 
     try:
-        lockname = "%s.lock" %filename
-        for fl in (lockname, filename):
-            if not os.path.exists(fl):
-                os.system("touch %s && chown storageserver.storageserver %s" %(fl, fl))
-
-        lock = open(lockname, 'w')
-        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
-        f = open(filename, 'aw')
-        for d in data:
-            f.write("%s\n" %d)
-        os.system("chown storageserver.storageserver %s" %filename)
-        f.close()
-        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
-        lock.close()
+        lock = open_storageserver_file("%s.lock" %filename, os.O_WRONLY)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fd = open_storageserver_file(filename, os.O_WRONLY | os.O_APPEND)
+            try:
+                buf = "".join(map(lambda x: "%s\n" %x, data))
+                while len(buf):
+                    buf = buf[os.write(fd, buf):]
+            finally:
+                os.close(fd)
+        finally:
+            os.close(lock)
     except:
         return False
 
@@ -0,0 +1,195 @@
+#!/usr/bin/env python26
+#Description: Vbucket map shared by the backup daemon and its backup processes
+
+#   Copyright 2013 Zynga Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import threading
+from multiprocessing import sharedctypes
+import consts
+
+NO_SERVER = -1
+
+class VBucketMap:
+    """
+    Versioned map of vbucket id to the server it is backed up from and its
+    disk path, kept in shared memory
+
+    The map is created by the daemon before the backup processes are forked,
+    they read it in place without any IPC. Writers are threads of the daemon,
+    serialized by a lock. The version is odd while an update is in progress
+    and only moves when an entry changed; a reader retries when it changed
+    under it (seqlock).
+
+    Servers are entries of a table of fixed size slots, vbuckets hold the
+    index of theirs. Disk paths are fixed size slots of each vbucket.
+    """
+
+    def __init__(self, max_vbuckets=consts.VBMAP_MAX_VBUCKETS, max_servers=consts.VBMAP_MAX_SERVERS,
+            server_len=consts.VBMAP_SERVER_LEN, path_len=consts.VBMAP_PATH_LEN):
+        self.max_vbuckets = max_vbuckets
+        self.max_servers = max_servers
+        self.server_len = server_len
+        self.path_len = path_len
+        self.version = sharedctypes.RawValue('L', 0)
+        self.servers = sharedctypes.RawArray('i', [NO_SERVER] * max_vbuckets)
+        self.server_table = sharedctypes.RawArray('c', max_servers * server_len)
+        self.paths = sharedctypes.RawArray('c', max_vbuckets * path_len)
+        # Only used by the writers, in the process that created the map
+        self.write_lock = threading.Lock()
+        self.server_index = {}
+        self.vb_servers = []
+        self.vb_paths = {}
+
+    def get_version(self):
+        return self.version.value
+
+    def _read_slot(self, array, index, length):
+        value = array[index * length:(index + 1) * length]
+        end = value.find('\0')
+        if end >= 0:
+            value = value[:end]
+        return value
+
+    def _write_slot(self, array, index, length, value):
+        array[index * length:(index + 1) * length] = str(value).ljust(length, '\0')
+
+    def _add_server(self, server):
+        index = len(self.server_index)
+        self._write_slot(self.server_table, index, self.server_len, server)
+        self.server_index[server] = index
+        return index
+
+    def lookup(self, vb_id):
+        """
+        Current server and disk path of a vbucket, None for the ones not known
+        """
+        if vb_id < 0 or vb_id >= self.max_vbuckets:
+            return None, None
+        while True:
+            version = self.version.value
+            if version & 1:
+                time.sleep(0)
+                continue
+            index = self.servers[vb_id]
+            server = None
+            if index != NO_SERVER:
+                server = self._read_slot(self.server_table, index, self.server_len)
+            path = self._read_slot(self.paths, vb_id, self.path_len) or None
+            if self.version.value == version:
+                return server, path
+
+    def get_servers(self):
+        """
+        Dict of the vbuckets that have a server, and their servers
+        """
+        while True:
+            version = self.version.value
+            if version & 1:
+                time.sleep(0)
+                continue
+            table = {}
+            vb_servers = {}
+            for vb_id, index in enumerate(self.servers[:]):
+                if index == NO_SERVER:
+                    continue
+                if not index in table:
+                    table[index] = self._read_slot(self.server_table, index, self.server_len)
+                vb_servers[vb_id] = table[index]
+            if self.version.value == version:
+                return vb_servers
+
+    def update_servers(self, vb_servers):
+        """
+        Set the servers of the vbuckets from a list of server names by vbucket
+        id, None for the ones without a server. Only the vbuckets that changed
+        are written, returns their count.
+        """
+        if len(vb_servers) > self.max_vbuckets:
+            raise ValueError("%d vbuckets in the map, at most %d supported"
+                    %(len(vb_servers), self.max_vbuckets))
+
+        self.write_lock.acquire()
+        try:
+            vb_servers = list(vb_servers) + [None] * (len(self.vb_servers) - len(vb_servers))
+            current = self.vb_servers + [None] * (len(vb_servers) - len(self.vb_servers))
+            changed = filter(lambda x: vb_servers[x] != current[x], xrange(len(vb_servers)))
+            if len(changed) == 0:
+                return 0
+
+            servers = set(vb_servers)
+            servers.discard(None)
+            for server in servers:
+                if len(server) > self.server_len:
+                    raise ValueError("Server name %s longer than %d" %(server, self.server_len))
+            new_servers = servers - set(self.server_index)
+            if len(new_servers) > self.max_servers - len(self.server_index):
+                # The table is full of servers that are gone, number them again
+                if len(servers) > self.max_servers:
+                    raise ValueError("%d servers in the map, at most %d supported"
+                            %(len(servers), self.max_servers))
+                self.server_index = {}
+                write = xrange(len(vb_servers))
+            else:
+                write = changed
+
+            self.version.value += 1
+            try:
+                for vb_id in write:
+                    server = vb_servers[vb_id]
+                    if server == None:
+                        self.servers[vb_id] = NO_SERVER
+                        continue
+                    index = self.server_index.get(server)
+                    if index == None:
+                        index = self._add_server(server)
+                    self.servers[vb_id] = index
+            finally:
+                self.version.value += 1
+            self.vb_servers = vb_servers
+            return len(changed)
+        finally:
+            self.write_lock.release()
+
+    def update_paths(self, vb_paths):
+        """
+        Set the disk paths of the vbuckets from a dict by vbucket id, the ones
+        not in it are cleared. Returns the count of paths that changed.
+        """
+        self.write_lock.acquire()
+        try:
+            changed = []
+            for vb_id in set(vb_paths) | set(self.vb_paths):
+                path = vb_paths.get(vb_id)
+                if path == self.vb_paths.get(vb_id):
+                    continue
+                if vb_id < 0 or vb_id >= self.max_vbuckets:
+                    raise ValueError("Vbucket %d out of the map" %vb_id)
+                if path != None and len(path) > self.path_len:
+                    raise ValueError("Path %s longer than %d" %(path, self.path_len))
+                changed.append(vb_id)
+            if len(changed) == 0:
+                return 0
+
+            self.version.value += 1
+            try:
+                for vb_id in changed:
+                    self._write_slot(self.paths, vb_id, self.path_len, vb_paths.get(vb_id, ""))
+            finally:
+                self.version.value += 1
+            self.vb_paths = dict(vb_paths)
+            return len(changed)
+        finally:
+            self.write_lock.release()
@@ -72,6 +72,7 @@ class vbucketRestore:
     def get_checkpoints(self, vb_list):
 
         checkpoint_list = {}
+        server_vbs = {}
         try:
             for vb_id in vb_list:
                 #look up storage server for vb_id
@@ -80,16 +81,22 @@ class vbucketRestore:
                     print ("Failed to get storage server for vb_id %d" %vb_id)
                     checkpoint_list[vb_id] = -1
                     continue
-                #get the last checkpoint id for this vb
+                server_vbs.setdefault(storage_server, []).append(vb_id)
+
+            #get the last checkpoint ids of all the vbuckets of a storage server
+            #over one connection
+            for storage_server, vbs in server_vbs.items():
                 client = download_client(storage_server, consts.SS_PORT)
-                status, checkpoint = client.get_checkpoint(vb_id)
+                checkpoints = client.get_checkpoints(vbs)
 
-                if status == -1 or checkpoint == None:
-                    print ("Failed to get checkpoint id for vb_id %d" %vb_id)
-                    checkpoint_list[vb_id] = -1
-                    continue
+                for vb_id in vbs:
+                    checkpoint = checkpoints[vb_id]
+                    if checkpoint == None:
+                        print ("Failed to get checkpoint id for vb_id %d" %vb_id)
+                        checkpoint_list[vb_id] = -1
+                        continue
 
-                checkpoint_list[vb_id] = int(checkpoint)
+                    checkpoint_list[vb_id] = int(checkpoint)
 
         except Exception, e:
             print "get checkpoints failed with error %s " %str(e)
@@ -97,27 +104,89 @@ class vbucketRestore:
 
         return True, checkpoint_list
 
-    def restore_vbuckets(self, vb_list):
-
-        output_status = []
+    def restore_vbucket(self, vb_id, buffers=None):
+
+        restore_cmd = "python26 " + consts.RESTORE_CMD_ABS + " -v " + str(vb_id) + " -d " + self.diskmapper
+        if buffers != None:
+            restore_cmd += " -b " + ",".join(buffers)
+        print "Executing command %s" %restore_cmd
+        status, output = commands.getstatusoutput(restore_cmd)
+        restore_status = {}
+        restore_status['vb_id'] = vb_id
+        restore_status['status'] = status
+
+        if status != 0:
+            print ("Restore for vb_id %d failed. Output: %s" %(vb_id, output))
+            restore_status['output'] = output
+        else:
+            print ("Restore for vb_id %d successful" %vb_id)
+            restore_status['status'] = "Restore successful"
+
+        return restore_status
+
+    def restore_vbuckets(self, vb_list, parallel=None):
+        """
+        Restore vbuckets running up to parallel zbase-restore processes
+
+        Every running restore gets its own share of the buffers of
+        buffer_list, dealt round robin over them. The next vbucket restored is one of the storage server
+        with the fewest restores running, so that the load is spread over
+        the storage servers.
+        """
+
+        if parallel == None:
+            parallel = self.config.restore_parallel_vbuckets
+        parallel = max(1, min(parallel, len(vb_list)))
+        if parallel == 1:
+            return map(self.restore_vbucket, vb_list)
+
+        buffers = self.config.buffer_list.split(',')
+        slots = []
+        for i in range(parallel):
+            # with fewer buffers than restores, a buffer is shared by slots
+            slots.append(buffers[i::parallel] or [buffers[i % len(buffers)]])
+
+        servers = {}
         for vb_id in vb_list:
-            restore_cmd = "python26 " + consts.RESTORE_CMD_ABS + " -v " + str(vb_id) + " -d " + self.diskmapper
-            print "Executing command %s" %restore_cmd
-            status, output = commands.getstatusoutput(restore_cmd)
-            restore_status = {}
-            restore_status['vb_id'] = vb_id
-            restore_status['status'] = status
-
-            if status != 0:
-                print ("Restore for vb_id %d failed. Output: %s" %(vb_id, output))
-                restore_status['output'] = output
-            else:
-                print ("Restore for vb_id %d successful" %vb_id)
-                restore_status['status'] = "Restore successful"
-
-            output_status.append(restore_status)
-
-        return output_status
+            servers[vb_id] = self.get_storage_server(vb_id)
+
+        pending = list(vb_list)
+        running = {}
+        results = {}
+        lock = threading.Lock()
+
+        def next_vbucket():
+            lock.acquire()
+            vb_id = None
+            if len(pending) > 0:
+                vb_id = min(pending, key=lambda vb: running.get(servers[vb], 0))
+                pending.remove(vb_id)
+                running[servers[vb_id]] = running.get(servers[vb_id], 0) + 1
+            lock.release()
+            return vb_id
+
+        def restore_worker(slot):
+            while True:
+                vb_id = next_vbucket()
+                if vb_id == None:
+                    return
+                restore_status = self.restore_vbucket(vb_id, slot)
+                lock.acquire()
+                results[vb_id] = restore_status
+                running[servers[vb_id]] -= 1
+                lock.release()
+
+        print "Restoring %d vbuckets from %d storage servers, %d at a time" %(len(vb_list),
+                len(set(servers.values())), parallel)
+        threads = []
+        for slot in slots:
+            t = threading.Thread(target=restore_worker, args=(slot,))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        return [results[vb_id] for vb_id in vb_list]
 
 
 if __name__ == '__main__':